@@ -40,7 +40,6 @@ def admin_auth(perm=None, redirect_field_name=REDIRECT_FIELD_NAME, login_url='ad
   return impl_dec
 
 from datetime import *
-import time
 
 from ajax_select import make_ajax_field
 from ajax_select.admin import AjaxSelectAdmin
@@ -376,7 +375,10 @@ class DonationInline(CustomStackedInline):
   readonly_fields = ('edit_link',)
 
 def mass_assign_action(self, request, queryset, field, value):
+  ids = list(queryset.values_list('pk', flat=True))
   queryset.update(**{ field: value })
+  # updates skip the signals that keep the search documents current
+  tracker.models.SearchDocument.refresh(queryset.model, ids)
   self.message_user(request, "Updated %s to %s" % (field, value))
 
 class PrizeTicketInline(CustomStackedInline):
@@ -886,21 +888,10 @@ class PrizeAdmin(CustomModelAdmin):
         s += ' <--> ' + str(obj.endrun.name_with_category())
   def draw_prize_internal(self, request, queryset, limit):
     numDrawn = 0
-    for prize in queryset:
-      if limit is None:
-        limit = prize.maxwinners
-      numToDraw = min(limit, prize.maxwinners - prize.current_win_count())
-      drawingError = False
-      thisDrawn = 0
-      while not drawingError and thisDrawn < numToDraw:
-        drawn, msg = prizeutil.draw_prize(prize)
-        time.sleep(1)
-        if not drawn:
-          self.message_user(request, msg, level=messages.ERROR)
-          drawingError = True
-        else:
-          numDrawn += 1
-          thisDrawn += 1
+    for result in prizeutil.draw_prizes(queryset, limit=limit):
+      numDrawn += len(result['winners'])
+      if result['error']:
+        self.message_user(request, result['error'], level=messages.ERROR)
     if numDrawn > 0:
       self.message_user(request, "%d prizes drawn." % numDrawn)
 
@@ -1206,11 +1197,9 @@ def draw_prize_winners(request):
   if request.method == 'POST':
     form = forms.DrawPrizeWinnersForm(prizes=prizes, data=request.POST)
     if form.is_valid():
-      for prize in form.cleaned_data['prizes']:
-        status = True
-        while status and not prize.maxed_winners():
-          status, data = prizeutil.draw_prize(prize, seed=form.cleaned_data['seed'])
-          prize.error = data['error'] if not status else ''
+      for result in prizeutil.draw_prizes(form.cleaned_data['prizes'], seed=form.cleaned_data['seed']):
+        prize = result['prize']
+        prize.error = result['error'] or ''
         logutil.change(request, prize, 'Prize Drawing')
       return render(request, 'admin/draw_prize_winners_post.html', { 'prizes': form.cleaned_data['prizes'] })
   else:
@@ -0,0 +1,11 @@
+"""Define pagination of the REST API's lists."""
+
+from rest_framework.pagination import CursorPagination
+
+
+class TrackerCursorPagination(CursorPagination):
+    """Page through lists by an opaque cursor on the object id, which stays stable as objects are added."""
+    page_size = 100
+    page_size_query_param = 'limit'
+    max_page_size = 500
+    ordering = 'id'
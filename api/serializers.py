@@ -1,14 +1,73 @@
 """Define serialization of the Django models into the REST framework."""
 
+import functools
 import logging
 
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
 
+from tracker.models.bid import Bid
+from tracker.models.donation import Donation, Donor
 from tracker.models.event import Event, Runner, SpeedRun
+from tracker.models.prize import Prize
 
 log = logging.getLogger(__name__)
 
 
+def query_paths(serializer):
+    """(select_related paths, prefetch_related paths, columns) for a serializer instance: the related objects
+    it nests, and the columns it reads from its own objects and the ones selected along with them, for
+    .only(), or None for the columns if some field reads something that isn't a plain model field.
+    """
+    select, prefetch, columns = [], [], []
+    known = [True]
+
+    def walk(serializer, prefix, many):
+        model = serializer.Meta.model
+        if not many and prefix:
+            columns.append(prefix + model._meta.pk.name)
+        for name, field in serializer.fields.items():
+            if isinstance(field, ClassNameField):
+                continue
+            if name in getattr(serializer, 'columns', {}):
+                columns.extend(prefix + column for column in serializer.columns[name])
+                continue
+            if field.source == '*' or '.' in field.source:
+                known[0] = False
+                continue
+            path = prefix + field.source
+            if isinstance(field, serializers.BaseSerializer):
+                nested = field.child if isinstance(field, serializers.ListSerializer) else field
+                # anything below a to-many relation is fetched along with it
+                if many or nested is not field:
+                    prefetch.append(path)
+                    walk(nested, path + '__', True)
+                else:
+                    select.append(path)
+                    columns.append(path)
+                    walk(nested, path + '__', False)
+            elif isinstance(field, serializers.ManyRelatedField):
+                prefetch.append(path)
+            elif not many:
+                try:
+                    concrete = model._meta.get_field(field.source).concrete
+                except FieldDoesNotExist:
+                    concrete = False
+                if concrete:
+                    columns.append(path)
+                else:
+                    known[0] = False
+
+    walk(serializer, '', False)
+    return tuple(select), tuple(prefetch), tuple(columns) if known[0] else None
+
+
+@functools.lru_cache(maxsize=None)
+def related_paths(serializer_class):
+    """(select_related paths, prefetch_related paths) for the related objects a serializer nests."""
+    return query_paths(serializer_class())[:2]
+
+
 class ClassNameField(serializers.Field):
     """Provide the class name as a lowercase string, to provide it as an extra field.
 
@@ -25,8 +84,32 @@ class ClassNameField(serializers.Field):
         return obj.__class__.__name__.lower()
 
 
+class SparseFieldsMixin(object):
+    """Leave out the private fields unless the serializer context has 'authorized' set, and, given a
+    'fields' argument, every field not named in it other than type and id.
+    """
+    private = ()
+    # the columns a field reads, where that isn't just the model field of the same name
+    columns = {}
+
+    def __init__(self, *args, **kwargs):
+        self.sparse_fields = kwargs.pop('fields', None)
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super(SparseFieldsMixin, self).get_fields()
+        authorized = self.context.get('authorized', False)
+        for name in list(fields):
+            if (name in self.private and not authorized) or \
+                    (self.sparse_fields is not None and name not in self.sparse_fields and name not in ('type', 'id')):
+                del fields[name]
+        return fields
+
+
 class EventSerializer(serializers.ModelSerializer):
     type = ClassNameField()
+    # the name of the zone, rather than the tzinfo object the model field holds
+    timezone = serializers.CharField()
 
     class Meta:
         model = Event
@@ -50,3 +133,89 @@ class SpeedRunSerializer(serializers.ModelSerializer):
         model = SpeedRun
         fields = ('type', 'id', 'event', 'name', 'display_name', 'description', 'category', 'console', 'runners',
                   'commentators', 'starttime', 'endtime', 'order', 'run_time')
+
+
+class DonorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """Donors, with their names hidden as far as their visibility asks, the same as the search API."""
+    type = ClassNameField()
+    public = serializers.SerializerMethodField()
+
+    private = ('email', 'paypalemail', 'solicitemail', 'addressstreet', 'addresscity', 'addressstate', 'addresszip',
+               'addresscountry')
+    columns = {
+        'public': ('visibility', 'alias', 'firstname', 'lastname'),
+        'alias': ('alias', 'visibility'),
+        'firstname': ('firstname', 'visibility'),
+        'lastname': ('lastname', 'visibility'),
+    }
+
+    class Meta:
+        model = Donor
+        fields = ('type', 'id', 'public', 'alias', 'firstname', 'lastname', 'visibility', 'email', 'paypalemail',
+                  'solicitemail', 'addressstreet', 'addresscity', 'addressstate', 'addresszip', 'addresscountry')
+
+    def get_public(self, donor):
+        return donor.visible_name()
+
+    def to_representation(self, donor):
+        data = super(DonorSerializer, self).to_representation(donor)
+        if not self.context.get('authorized', False):
+            hidden = {'FIRST': (), 'ALIAS': ('firstname', 'lastname'),
+                      'ANON': ('firstname', 'lastname', 'alias')}.get(donor.visibility, ())
+            for name in hidden:
+                if name in data:
+                    data[name] = None
+            if donor.visibility == 'FIRST' and data.get('lastname'):
+                data['lastname'] = data['lastname'][0] + '...'
+        return data
+
+
+class DonationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """Donations, with comments only once they have been approved, the same as the search API."""
+    type = ClassNameField()
+    donor = DonorSerializer()
+
+    private = ('fee', 'modcomment', 'testdonation', 'domainId', 'requestedvisibility', 'requestedalias',
+               'requestedemail', 'requestedsolicitemail')
+    columns = {
+        'comment': ('comment', 'commentstate'),
+    }
+
+    class Meta:
+        model = Donation
+        fields = ('type', 'id', 'event', 'donor', 'domain', 'domainId', 'transactionstate', 'bidstate', 'readstate',
+                  'commentstate', 'amount', 'fee', 'currency', 'timereceived', 'comment', 'modcomment',
+                  'commentlanguage', 'testdonation', 'requestedvisibility', 'requestedalias', 'requestedemail',
+                  'requestedsolicitemail')
+
+    def to_representation(self, donation):
+        data = super(DonationSerializer, self).to_representation(donation)
+        if not self.context.get('authorized', False) and 'comment' in data and donation.commentstate != 'APPROVED':
+            data['comment'] = None
+        return data
+
+
+class BidSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """Bids, with their place in their bid tree: the parent, the ids of the options and the depth."""
+    type = ClassNameField()
+    options = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+    class Meta:
+        model = Bid
+        fields = ('type', 'id', 'event', 'speedrun', 'parent', 'options', 'level', 'name', 'state', 'description',
+                  'shortdescription', 'goal', 'istarget', 'allowuseroptions', 'revealedtime', 'biddependency',
+                  'total', 'count')
+
+
+class PrizeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    type = ClassNameField()
+
+    private = ('extrainfo', 'acceptemailsent', 'state', 'reviewnotes', 'creatoremail')
+
+    class Meta:
+        model = Prize
+        fields = ('type', 'id', 'event', 'name', 'category', 'image', 'altimage', 'description', 'shortdescription',
+                  'estimatedvalue', 'minimumbid', 'maximumbid', 'sumdonations', 'randomdraw', 'ticketdraw',
+                  'startrun', 'endrun', 'starttime', 'endtime', 'maxwinners', 'maxmultiwin', 'provider', 'creator',
+                  'creatoremail', 'creatorwebsite', 'requiresshipping', 'extrainfo', 'acceptemailsent', 'state',
+                  'reviewnotes')
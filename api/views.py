@@ -2,12 +2,21 @@
 
 import logging
 
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
 from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
+from tracker import filters, viewutil
+from tracker.models.bid import Bid
+from tracker.models.donation import Donation, Donor
 from tracker.models.event import Event, Runner, SpeedRun
-from tracker.api.serializers import EventSerializer, RunnerSerializer, SpeedRunSerializer
+from tracker.models.prize import Prize
+from tracker.api.pagination import TrackerCursorPagination
+from tracker.api.serializers import BidSerializer, DonationSerializer, DonorSerializer, EventSerializer, \
+    PrizeSerializer, RunnerSerializer, SparseFieldsMixin, SpeedRunSerializer, query_paths
 
 log = logging.getLogger(__name__)
 
@@ -15,16 +24,79 @@ log = logging.getLogger(__name__)
 class FlatteningViewSetMixin(object):
     """Override a view set's data query methods in order to have a flat dictionary of objects
     rather than the REST default of a nested tree.
+
+    Lists are paged with a cursor (see TrackerCursorPagination), and can be narrowed down with the
+    'event' (id or short name) and 'after'/'before' (ISO 8601 times) parameters, for the view sets that
+    set event_field and time_field. View sets with sparse serializers (see SparseFieldsMixin) also take
+    a 'fields' parameter listing the fields to return, and only read the columns those need. Users
+    without the tracker.can_search permission only see the objects and fields the search API shows them.
     """
+    pagination_class = TrackerCursorPagination
+    # the lookups the 'event' and 'after'/'before' parameters filter on, if any
+    event_field = None
+    time_field = None
+    # the filters model whose user_restriction_filter applies to unauthorized users, if any
+    restriction = None
+
+    def authorized(self):
+        return self.request.user.has_perm('tracker.can_search')
+
+    def get_serializer_context(self):
+        context = super(FlatteningViewSetMixin, self).get_serializer_context()
+        context['authorized'] = self.authorized()
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.request.query_params.get('fields', None)
+        if fields and issubclass(self.serializer_class, SparseFieldsMixin):
+            kwargs['fields'] = fields.split(',')
+        return super(FlatteningViewSetMixin, self).get_serializer(*args, **kwargs)
+
+    def get_prefetch(self, path):
+        """The prefetch for one of the to-many relations the serializer nests."""
+        return path
+
+    def get_queryset(self):
+        """Fetch the related objects the serializer nests along with the objects themselves, and, when
+        only some fields were asked for, only the columns they read."""
+        serializer = self.get_serializer()
+        select, prefetch, columns = query_paths(serializer)
+        queryset = self.queryset.select_related(*select).prefetch_related(*map(self.get_prefetch, prefetch))
+        if getattr(serializer, 'sparse_fields', None) is not None and columns is not None:
+            # the paginator reads the ordering column of the last object on the page
+            ordering = self.pagination_class.ordering.lstrip('-')
+            queryset = queryset.only(*set(columns + ('pk', ordering)))
+        if self.restriction and not self.authorized():
+            queryset = queryset.filter(filters.user_restriction_filter(self.restriction))
+            # the restriction on donors goes through their donations
+            if self.restriction == 'donor':
+                queryset = queryset.distinct()
+        return queryset
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        if self.event_field and params.get('event'):
+            queryset = queryset.filter(**{self.event_field: viewutil.get_event(params['event'])})
+            # filtering across a to-many relation can match an object more than once
+            if '__' in self.event_field:
+                queryset = queryset.distinct()
+        if self.time_field:
+            for param, lookup in (('after', 'gte'), ('before', 'lt')):
+                if params.get(param):
+                    value = parse_datetime(params[param])
+                    if value is None:
+                        raise ValidationError({param: 'Expected an ISO 8601 date and time.'})
+                    queryset = queryset.filter(**{'{0}__{1}'.format(self.time_field, lookup): value})
+        return queryset
 
     def list(self, request):
         """Change the response type to be a dictionary if flat related objects have been requested."""
         log.debug("query params: %s", request.query_params)
         flatten = request.query_params.get('include', None)
 
-        serializer = self.serializer_class(self.queryset, many=True)
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        serializer = self.get_serializer(page, many=True)
 
-        log.debug(serializer.data)
         # if we need to flatten, it's time to walk this dictionary
         if flatten:
             targets = flatten.split(',')
@@ -32,18 +104,16 @@ class FlatteningViewSetMixin(object):
         else:
             prepared_data = serializer.data
 
-        log.debug(prepared_data)
-        return Response(prepared_data)
+        return self.get_paginated_response(prepared_data)
 
     def retrieve(self, request, pk=None):
         """Change the response type to be a dictionary if flat related objects have been requested."""
         log.debug("query params: %s", request.query_params)
         flatten = request.query_params.get('include', None)
 
-        obj = get_object_or_404(self.queryset, pk=pk)
-        serializer = self.serializer_class(obj)
+        obj = get_object_or_404(self.get_queryset(), pk=pk)
+        serializer = self.get_serializer(obj)
 
-        log.debug(serializer.data)
         # if we need to flatten, it's time to walk this dictionary
         if flatten:
             targets = flatten.split(',')
@@ -51,42 +121,37 @@ class FlatteningViewSetMixin(object):
         else:
             prepared_data = serializer.data
 
-        log.debug(prepared_data)
         return Response(prepared_data)
 
     @staticmethod
     def _flatten_data(initial_data, targets):
+        """Replace the related objects of each item with their ids, listing each related object once, in
+        the order they are first seen."""
         log.debug("targets for flattening: %s", targets)
 
         primary_objs = list()
         obj_label = None
+        # target -> {id: related object}
+        target_objs = dict((which, dict()) for which in targets)
         for item in initial_data:
             obj_label = '{0:s}s'.format(item['type'])
-            primary_objs.append(dict(item))
-
-        prepared_data = {
-            obj_label: primary_objs
-        }
-
-        for which in targets:
-            log.debug("searching for target %s", which)
-            target_objs = dict()
-            for item in primary_objs:
-                log.debug("searching in %s", item)
+            item = dict(item)
+            for which, seen in target_objs.items():
                 hits = item.get(which, [])
                 if hits:
-                    # winch this into a list if it isn't a many=True field)
+                    # winch this into a list if it isn't a many=True field
                     if not isinstance(hits, list):
-                        log.debug("winching %s into a list", hits)
                         hits = [hits]
-
-                    new_hit_list = list()
                     for hit in hits:
-                        log.debug("found a hit: %s", hit)
-                        target_objs[hit['id']] = hit
-                        new_hit_list.append(hit['id'])
-                    item[which] = new_hit_list
-            prepared_data[which] = list(target_objs.values())
+                        seen.setdefault(hit['id'], hit)
+                    item[which] = [hit['id'] for hit in hits]
+            primary_objs.append(item)
+
+        prepared_data = {
+            obj_label: primary_objs
+        }
+        for which, seen in target_objs.items():
+            prepared_data[which] = list(seen.values())
 
         return prepared_data
 
@@ -94,13 +159,52 @@ class FlatteningViewSetMixin(object):
 class EventViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
+    time_field = 'datetime'
 
 
 class RunnerViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Runner.objects.all()
     serializer_class = RunnerSerializer
+    event_field = 'speedrun__event'
 
 
 class SpeedRunViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = SpeedRun.objects.all()
     serializer_class = SpeedRunSerializer
+    event_field = 'event'
+    time_field = 'starttime'
+
+
+class DonationViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Donation.objects.all()
+    serializer_class = DonationSerializer
+    event_field = 'event'
+    time_field = 'timereceived'
+    restriction = 'donation'
+
+
+class DonorViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Donor.objects.all()
+    serializer_class = DonorSerializer
+    event_field = 'donation__event'
+    restriction = 'donor'
+
+
+class BidViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Bid.objects.all()
+    serializer_class = BidSerializer
+    event_field = 'event'
+    restriction = 'bid'
+
+    def get_prefetch(self, path):
+        # hidden options are left out of their parents along with the rest of the hidden bids
+        if path == 'options' and not self.authorized():
+            return Prefetch(path, queryset=Bid.objects.exclude(state='HIDDEN').only('id', 'parent'))
+        return path
+
+
+class PrizeViewSet(FlatteningViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Prize.objects.all()
+    serializer_class = PrizeSerializer
+    event_field = 'event'
+    restriction = 'prize'
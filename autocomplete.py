@@ -0,0 +1,136 @@
+"""
+Prefix autocomplete for the admin's ajax-select lookups (see lookups.py).
+
+The names of the donors, bids, runs, prizes and runners a lookup can offer are kept in sorted in-memory
+indexes, one per lookup and selected event, so a keystroke is a binary search rather than a general
+search of the database. The indexes belong to the process and are rebuilt, the first time they are
+used, whenever the DataVersion of the data behind them changes. Scopes with more objects than
+TRACKER_AUTOCOMPLETE_MAX_OBJECTS are searched in the database instead.
+"""
+
+import bisect
+import collections
+import itertools
+import threading
+
+from django.conf import settings
+
+import tracker.filters as filters
+from tracker.models import DataVersion, SearchDocument
+from tracker.models.search import normalize
+
+# the fields whose words are matched, by filter model
+FIELDS = {
+    'allbids': ('name', 'speedrun__name'),
+    'bid': ('name', 'speedrun__name'),
+    'bidtarget': ('name', 'speedrun__name'),
+    'donor': ('alias', 'firstname', 'lastname', 'email', 'paypalemail'),
+    'prize': ('name',),
+    'run': ('name',),
+    'runner': ('name',),
+}
+# the kinds of data the index of each filter model is built from
+VERSIONS = {
+    'allbids': ('events', 'bids', 'runs'),
+    'bid': ('events', 'bids', 'runs'),
+    'bidtarget': ('events', 'bids', 'runs'),
+    'donor': ('donors',),
+    'prize': ('events', 'prizes'),
+    'run': ('events', 'runs'),
+    'runner': ('runners',),
+}
+# what str() of the matches reads
+SELECT_RELATED = {
+    'allbids': ('event', 'speedrun__event', 'parent__event', 'parent__speedrun__event'),
+    'bid': ('event', 'speedrun__event'),
+    'bidtarget': ('event', 'speedrun__event', 'parent__event', 'parent__speedrun__event'),
+    'run': ('event',),
+}
+
+LIMIT = 20
+MAX_OBJECTS = 100000
+# the least recently used indexes are dropped beyond this many
+MAX_INDEXES = 64
+
+
+class PrefixIndex(object):
+    def __init__(self, texts):
+        # every run of words at the end of a value, so that 'metr' finds 'Super Metroid'
+        entries = set()
+        for pk, column, value in texts:
+            words = value.split()
+            for i in range(len(words)):
+                entries.add((' '.join(words[i:]), column, pk))
+        self.entries = sorted(entries)
+        self.terms = [term for term, column, pk in self.entries]
+
+    def search(self, prefix, columns, limit=LIMIT):
+        """The ids of up to limit objects with a value in one of the columns starting with the prefix."""
+        ids = []
+        for term, column, pk in itertools.islice(self.entries, bisect.bisect_left(self.terms, prefix), None):
+            if not term.startswith(prefix):
+                break
+            if column in columns and pk not in ids:
+                ids.append(pk)
+                if len(ids) == limit:
+                    break
+        return ids
+
+
+class Indexes(object):
+    def __init__(self, max_indexes=MAX_INDEXES):
+        self.max_indexes = max_indexes
+        self._lock = threading.Lock()
+        # scope -> (version, index, or None if the scope is too large to index)
+        self._indexes = collections.OrderedDict()
+
+    def get(self, scope, version, build):
+        with self._lock:
+            entry = self._indexes.get(scope)
+            if entry is not None and entry[0] == version:
+                self._indexes.move_to_end(scope)
+                return entry[1]
+        index = build()
+        with self._lock:
+            self._indexes.pop(scope, None)
+            while len(self._indexes) >= self.max_indexes:
+                self._indexes.popitem(last=False)
+            self._indexes[scope] = (version, index)
+        return index
+
+    def reset(self):
+        with self._lock:
+            self._indexes.clear()
+
+
+indexes = Indexes()
+
+
+def indexed(model):
+    return filters.normalize_model_param(model) in FIELDS
+
+
+def search(model, text, params, user=None):
+    """
+    Up to LIMIT objects of a filter model that match the lookup filters in params, with a name that has a
+    word starting with the text, in the order of the names.
+    """
+    kind = filters.normalize_model_param(model)
+    prefix = normalize(text)
+    if not prefix:
+        return []
+    queryset = filters.run_model_query(kind, params, mode='admin')
+
+    def build():
+        if queryset.count() > getattr(settings, 'TRACKER_AUTOCOMPLETE_MAX_OBJECTS', MAX_OBJECTS):
+            return None
+        return PrefixIndex(SearchDocument.texts(kind, queryset, FIELDS[kind]))
+
+    scope = (kind,) + tuple(sorted(params.items()))
+    index = indexes.get(scope, DataVersion.key(VERSIONS[kind], params.get('event')), build)
+    if index is None:
+        return list(filters.run_model_query(kind, dict(params, q=text), user=user, mode='admin')[:LIMIT])
+    ids = index.search(prefix, SearchDocument.columns(user))
+    objects = queryset.model.objects.filter(pk__in=ids).select_related(*SELECT_RELATED.get(kind, ()))
+    objects = dict((obj.pk, obj) for obj in objects)
+    return [objects[pk] for pk in ids if pk in objects]
@@ -0,0 +1,197 @@
+"""
+Times the hot paths of the tracker against an existing event (usually one made by the
+generate_benchmark_event command) and reports the wall time and query count of each, so that
+reports from different releases can be compared. Everything a benchmark writes is rolled back.
+"""
+
+import collections
+import platform
+import random
+import statistics
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from paypal.standard.ipn.models import PayPalIPN
+
+import tracker.filters as filters
+import tracker.models as models
+import tracker.paypalutil as paypalutil
+import tracker.prizeutil as prizeutil
+from tracker.views import api, feedviews, public
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+class Context(object):
+    def __init__(self, event, seed=None):
+        self.event = event
+        self.rand = random.Random(seed)
+        self.factory = RequestFactory()
+        # never saved, superusers are allowed everything without touching the permission tables
+        self.user = User(username='benchmark', is_superuser=True, is_staff=True, is_active=True)
+        self.prizes = list(models.Prize.objects.filter(event=event).order_by('id')[:10])
+        # the IPN needs a country to file the donor under, and a bare database has none
+        self.country = models.Country.objects.order_by('id').first() or models.Country.objects.create(
+            name='Benchmark', alpha2='ZZ', alpha3='ZZZ')
+
+    def get(self, path, params=None):
+        request = self.factory.get(path, params or {})
+        request.user = self.user
+        return request
+
+
+def consume(response):
+    # streaming responses do their work while they are iterated
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def uncached(view):
+    return getattr(view, '__wrapped__', view)
+
+
+def search_benchmark(searchType):
+    def run(context):
+        consume(api.search(context.get('/search', {'type': searchType, 'event': context.event.id})))
+    return run
+
+
+for searchType in ('donation', 'donor', 'bid', 'run', 'prize', 'event'):
+    benchmark('search_' + searchType)(search_benchmark(searchType))
+
+
+def feed_benchmark(view):
+    def run(context):
+        consume(view.as_view()(context.get('/feed'), event=context.event.short))
+    return run
+
+
+for feedName, feedView in (('upcoming_runs', feedviews.UpcomingRunsView), ('upcoming_bids', feedviews.UpcomingBidsView),
+                           ('current_donations', feedviews.CurrentDonationsView),
+                           ('recent_donations', feedviews.RecentDonationsView), ('prizes', feedviews.ActivePrizesView)):
+    benchmark('feed_' + feedName)(feed_benchmark(feedView))
+
+
+# a spread of searches for build_filters, which builds each of them FILTER_ROUNDS times per user
+FILTER_SEARCHES = (
+    ('donation', {'q': 'mario', 'event': 1, 'transactionstate': 'COMPLETED', 'comment': 'hype'}),
+    ('donor', {'q': 'mario', 'event': 1}),
+    ('bid', {'q': 'mario', 'event': 1, 'state': 'OPENED'}),
+    ('run', {'q': 'mario', 'event': 1}),
+    ('prize', {'q': 'mario', 'event': 1, 'state': 'ACCEPTED'}),
+)
+FILTER_ROUNDS = 100
+
+
+@benchmark('build_filters')
+def build_filters(context):
+    # only the building of the filters, without running them, to show the overhead of each search
+    for user in (None, context.user):
+        for i in range(FILTER_ROUNDS):
+            for searchType, params in FILTER_SEARCHES:
+                filters.model_general_filter(searchType, params['q'], user=user)
+                filters.model_specific_filter(searchType, params, user=user)
+
+
+@benchmark('bidindex')
+def bidindex(context):
+    consume(uncached(public.bidindex)(context.get('/bids'), event=context.event.short))
+
+
+@benchmark('donorindex')
+def donorindex(context):
+    consume(uncached(public.donorindex)(context.get('/donors'), event=context.event.short))
+
+
+@benchmark('eligible_donors')
+def eligible_donors(context):
+    for prize in context.prizes:
+        prize.eligible_donors()
+
+
+@benchmark('draw_prize')
+def draw_prize(context):
+    for prize in context.prizes:
+        prizeutil.draw_prize(prize, seed=context.rand.getrandbits(64))
+
+
+@benchmark('ipn_donation')
+def ipn_donation(context):
+    # everything the IPN view does after PayPal has verified the notification
+    donation = models.Donation.objects.create(event=context.event, amount=25, domain='PAYPAL', transactionstate='PENDING',
+                                              domainId=str(context.rand.getrandbits(64)))
+    ipnObj = PayPalIPN(custom='{0}:benchmark'.format(donation.id), payer_email='benchmark@example.com',
+                       first_name='Bench', last_name='Mark', txn_id=str(context.rand.getrandbits(64)), mc_gross=25,
+                       mc_currency='USD', payment_status='Completed', residence_country=context.country.alpha2)
+    donation = paypalutil.initialize_paypal_donation(ipnObj)
+    donation.save()
+    models.EventTotal.event_aggregate(donation.event_id)
+    models.PostbackDelivery.enqueue(donation.event, '{}')
+
+
+def run_benchmarks(event, repeat=3, names=None, seed=None):
+    """
+    Runs the named benchmarks (all of them by default) repeat times each against the event, and returns
+    a report of the wall times and query counts along with the size of the data they ran against
+    """
+    results = collections.OrderedDict()
+    with transaction.atomic():
+        context = Context(event, seed)
+        for name, function in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            times = []
+            for i in range(repeat):
+                with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    function(context)
+                    times.append(time.perf_counter() - start)
+                    transaction.set_rollback(True)
+            results[name] = collections.OrderedDict([
+                ('queries', len(queries)),
+                ('min', min(times)),
+                ('median', statistics.median(times)),
+                ('max', max(times)),
+            ])
+        transaction.set_rollback(True)
+    return collections.OrderedDict([
+        ('timestamp', timezone.now().isoformat()),
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('database', connection.vendor),
+        ('event', event.short),
+        ('data', collections.OrderedDict([
+            ('donations', models.Donation.objects.filter(event=event).count()),
+            ('donors', models.Donor.objects.filter(donation__event=event).distinct().count()),
+            ('bids', models.Bid.objects.filter(Q(event=event) | Q(speedrun__event=event)).count()),
+            ('runs', models.SpeedRun.objects.filter(event=event).count()),
+            ('prizes', models.Prize.objects.filter(event=event).count()),
+        ])),
+        ('results', results),
+    ])
+
+
+def compare(old, new):
+    """Returns (name, old median, new median, ratio, old queries, new queries) for the benchmarks in both reports."""
+    rows = []
+    for name, result in new['results'].items():
+        previous = old['results'].get(name)
+        if previous:
+            rows.append((name, previous['median'], result['median'],
+                         result['median'] / previous['median'] if previous['median'] else None,
+                         previous['queries'], result['queries']))
+    return rows
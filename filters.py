@@ -1,4 +1,5 @@
 from datetime import *
+import functools
 
 import dateutil.parser
 import pytz
@@ -303,8 +304,27 @@ _DonorEmailFields = ['email', 'paypalemail']
 _DonorNameFields = ['firstname', 'lastname']
 _SpecialMarkers = ['icontains', 'contains', 'iexact', 'exact', 'lte', 'gte']
 
+# the permissions permission_check looks at, which are all that a compiled filter plan depends on
+_FilterPermissions = ['tracker.view_emails', 'tracker.view_usernames', 'tracker.view_test', 'tracker.view_comments', 'tracker.view_hidden']
+
+def permission_fingerprint(user):
+  if user == None:
+    return frozenset()
+  # kept on the user for the rest of the request, the same way the auth backends keep their permission caches
+  if not hasattr(user, '_filter_permission_fingerprint'):
+    user._filter_permission_fingerprint = frozenset(perm for perm in _FilterPermissions if user.has_perm(perm))
+  return user._filter_permission_fingerprint
+
+class _FingerprintUser(object):
+  # stands in for any user with exactly these permissions while a plan is compiled
+  def __init__(self, perms):
+    self.perms = perms
+  def has_perm(self, perm):
+    return perm in self.perms
+
 # additional considerations for permission related visibility at the 'field' level
-def add_permissions_checks(rootmodel, key, query, user=None):
+# returns None if the query on the key is allowed as is, False if it should be dropped, or a Q to restrict it with
+def permission_check(rootmodel, key, user=None):
   toks = key.split('__')
   leading = ''
   if len(toks) >= 2:
@@ -317,32 +337,42 @@ def add_permissions_checks(rootmodel, key, query, user=None):
     visField = leading + 'visibility'
     if (field in _DonorEmailFields) and (user == None or not user.has_perm('tracker.view_emails')):
       # Here, we just want to remove the query altogether, since there is no circumstance that we want personal contact emails displayed publicly without permissions
-      query = Q()
+      return False
     elif (field in _DonorNameFields) and (user == None or not user.has_perm('tracker.view_usernames')):
-      query &= Q(**{ visField: 'FULL' })
+      return Q(**{ visField: 'FULL' })
     elif (field == 'alias') and (user == None or not user.has_perm('tracker.view_usernames')):
-      query &= Q(Q(**{ visField: 'FULL' }) | Q(**{ visField: 'ALIAS' }))
+      return Q(Q(**{ visField: 'FULL' }) | Q(**{ visField: 'ALIAS' }))
   elif rootmodel == 'donation':
     if (field == 'testdonation') and (user == None or not user.has_perm('tracker.view_test')):
-      query = Q()
+      return False
     if (field == 'comment') and (user == None or not user.has_perm('tracker.view_comments')):
       # only allow searching the textual content of approved comments
       commentStateField = leading + 'commentstate'
-      query &= Q(**{ commentStateField: 'APPROVED' })
+      return Q(**{ commentStateField: 'APPROVED' })
   elif rootmodel == 'bid':
     # Prevent 'hidden' bids from showing up in public queries
     if (field == 'state') and (user == None or not user.has_perm('tracker.view_hidden')):
-      query &= ~Q(**{ key: 'HIDDEN' })
+      return ~Q(**{ key: 'HIDDEN' })
   elif rootmodel == 'prize':
     if field in ['extrainfo', 'acceptemailsent', 'state', 'reviewnotes',]:
-        query = Q()
+      return False
   elif rootmodel == 'prizewinner':
     # this list of blacklisted fields should probably be a global property of the model or something
     if field in ['trackingnumber', 'couriername', 'winnernotes', 'shippingnotes', 'shippingcost', 'shippingstate', 'emailsent', 'acceptemailsentcount', 'shippingemailsent', ]:
-        query = Q()
+      return False
+  return None
+
+def add_permissions_checks(rootmodel, key, query, user=None):
+  check = permission_check(rootmodel, key, user=user)
+  if check is False:
+    return Q()
+  elif check is not None:
+    query &= check
   return query
 
-def recurse_keys(key, fromModels=[]):
+def recurse_keys(key, fromModels=None):
+  if fromModels == None:
+    fromModels = []
   tail = key.split('__')[-1]
   ftail = _FKMap.get(tail,tail)
   if ftail in _GeneralFields:
@@ -370,48 +400,71 @@ def normalize_model_param(model):
     model = _ModelReverseMap[model]
   return model
 
-# This creates a 'q'-esque Q-filter, similar to the search model of the django admin
-def model_general_filter(model, text, user=None):
+# Filter plans are the parts of a filter that only depend on the model, the parameters given and the
+# user's permissions, worked out once for each combination. Only the values are bound on each call.
+
+@functools.lru_cache(maxsize=None)
+def general_filter_plan(model, perms):
+  """(lookup, permission restriction or None) for every field the general filter searches."""
   fields = set()
-  model = normalize_model_param(model)
   fromModels = [model]
   for key in _GeneralFields[model]:
     fields |= set(recurse_keys(key, fromModels=fromModels))
-  fields = list(fields)
-  query = Q()
-  for field in fields:
-    query |= build_general_query_piece(model, field, text, user=user)
-  return query
+  user = _FingerprintUser(perms)
+  plan = []
+  for field in sorted(fields):
+    check = permission_check(model, field, user=user)
+    if check is not False:
+      plan.append((field + '__icontains', check))
+  return tuple(plan)
+
+@functools.lru_cache(maxsize=1024)
+def specific_filter_plan(model, keys, perms):
+  """(parameter, lookups, permission restriction or None) for every parameter the specific filter uses."""
+  modelSpecifics = _SpecificFields[model]
+  user = _FingerprintUser(perms)
+  plan = []
+  for key in sorted(keys):
+    # allows modelspecific to be a single key, or multiple values
+    modelSpecific = modelSpecifics[key]
+    if isinstance(modelSpecific, str) or not hasattr(modelSpecific, '__iter__'):
+      modelSpecific = [modelSpecific]
+    check = permission_check(model, key, user=user)
+    if check is not False:
+      plan.append((key, tuple(modelSpecific), check))
+  return tuple(plan)
+
+# This creates a 'q'-esque Q-filter, similar to the search model of the django admin
+def model_general_filter(model, text, user=None):
+  model = normalize_model_param(model)
+  if not text:
+    return Q()
+  if SearchDocument.enabled() and SearchDocument.kind(model):
+    return Q(id__in=SearchDocument.search(model, text, user=user))
+  return Q(*[(lookup, text) if check is None else Q((lookup, text), check)
+             for lookup, check in general_filter_plan(model, permission_fingerprint(user))], _connector=Q.OR)
 
 # This creates a more specific filter, using UA's json API implementation as a basis
 def model_specific_filter(model, searchDict, user=None):
-  query = Q()
   model = normalize_model_param(model)
   modelSpecifics = _SpecificFields[model]
-  for key in searchDict:
-    if key in modelSpecifics:
-      # A list/tuple of entries implies an 'or'-ing between all specified values
-      # this isn't possible in the current url method, but it could be in the future if we had a way to encode lists (possibly by escaping commas in normal strings)
-      values = searchDict[key]
-      fieldQuery = Q()
-      if isinstance(values, str) or not hasattr(values, '__iter__'):
-        values = [values]
-      for value in values:
-        # allows modelspecific to be a single key, or multiple values
-        modelSpecific = modelSpecifics[key]
-        if isinstance(modelSpecific, str) or not hasattr(modelSpecific, '__iter__'):
-          modelSpecific = [modelSpecific]
-        for searchKey in modelSpecific:
-          fieldQuery |= Q( **{ searchKey: value })
-      fieldQuery = add_permissions_checks(model, key, fieldQuery, user=user)
-      query &= fieldQuery
-  return query
+  keys = frozenset(key for key in searchDict if key in modelSpecifics)
+  fieldQueries = []
+  for key, searchKeys, check in specific_filter_plan(model, keys, permission_fingerprint(user)):
+    # A list/tuple of entries implies an 'or'-ing between all specified values
+    # this isn't possible in the current url method, but it could be in the future if we had a way to encode lists (possibly by escaping commas in normal strings)
+    values = searchDict[key]
+    if isinstance(values, str) or not hasattr(values, '__iter__'):
+      values = [values]
+    fieldQuery = Q(*[(searchKey, value) for value in values for searchKey in searchKeys], _connector=Q.OR)
+    fieldQueries.append(fieldQuery if check is None else Q(fieldQuery, check))
+  return Q(*fieldQueries)
 
 def canonical_bool(b):
   if isinstance(b, str):
-    if b.lower() in ['t', 'True', 'true', 'y', 'yes']:
+    if b.lower() in ['t', 'True', 'true', 'y', 'yes', '1']:
       b = True
-    elif b.lower() in ['f', 'False', 'false', 'n', 'no']:
+    elif b.lower() in ['f', 'False', 'false', 'n', 'no', '0']:
       b = False
     else:
       b = None
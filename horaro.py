@@ -1,18 +1,25 @@
 # Horaro functionality for loading schedule info using their API.
 
+import collections
 import datetime
 import logging
 import re
 
 import requests
-from django.db.models import Min
+from django.conf import settings
+from django.db.models import Case, Min, When, Value
+from django.db.models.functions import Lower
 from django.utils import dateparse
 
-from tracker.models import SpeedRun, Runner
+from tracker.models import DataVersion, PrizeEligibility, SearchDocument, SpeedRun, Runner
 from tracker.models.event import TimestampField
 
-EVENT_URL = 'https://horaro.org/-/api/v1/events/{event_id}'
-SCHEDULES_URL = 'https://horaro.org/-/api/v1/events/{event_id}/schedules'
+# TRACKER_HORARO_URL points the import at a different Horaro instance, i.e. a local stand-in for testing.
+EVENT_URL = '{base}/-/api/v1/events/{event_id}'
+SCHEDULES_URL = '{base}/-/api/v1/events/{event_id}/schedules'
+
+# Fields of a run that are taken from the schedule.
+RUN_FIELDS = ('category', 'commentators', 'order', 'setup_time', 'run_time', 'starttime', 'endtime')
 
 # Ignore games with this text in the name, i.e. setup blocks, preshow, finale.
 IGNORE_LIST = (
@@ -29,6 +36,10 @@ class HoraroError(Exception):
     pass
 
 
+def _base_url():
+    return getattr(settings, 'TRACKER_HORARO_URL', 'https://horaro.org').rstrip('/')
+
+
 def _get_horaro_data(url):
     r = requests.get(url)
 
@@ -52,7 +63,7 @@ def get_event_data(event_id):
     :return: Event data JSON object.
     :rtype: dict
     """
-    return _get_horaro_data(EVENT_URL.format(event_id=event_id))
+    return _get_horaro_data(EVENT_URL.format(base=_base_url(), event_id=event_id))
 
 
 def get_schedule_data(event_id):
@@ -63,39 +74,29 @@ def get_schedule_data(event_id):
     :return: Schedule data JSON array, each element is a JSON object for a schedule.
     :rtype: list[dict]
     """
-    return _get_horaro_data(SCHEDULES_URL.format(event_id=event_id))
+    return _get_horaro_data(SCHEDULES_URL.format(base=_base_url(), event_id=event_id))
 
 
-def merge_event_schedule(event):
-    """Merge schedule from Horaro API with an event in our system.
+def parse_schedule(event, schedules):
+    """Parse Horaro schedule data into the runs to import, in schedule order.
 
-    :param event: Event record to merge.
+    :param event: Event record with the Horaro column settings.
     :type event: tracker.models.Event
-    :return: Number of runs updated.
-    :rtype: int
+    :param schedules: Schedule data from the Horaro API.
+    :type schedules: list[dict]
+    :return: Run data, each element with the run fields and a list of (name, stream) runner pairs.
+    :rtype: list[dict]
     """
-    i = TimestampField.time_string_to_int
-    num_runs = 0
-
-    if not event.horaro_id:
-        raise HoraroError("Event ID not set")
-
     if event.horaro_game_col is None:
         raise HoraroError("Game Column not set")
 
-    # Get schedule data.
-    schedules = get_schedule_data(event.horaro_id)
-
-    # Get existing runs in a single query.  Clear position for all for re-ordering.
-    qs = SpeedRun.objects.select_for_update().filter(event=event)
-    qs.update(order=None)
-    existing_runs = dict([(r.name, r) for r in qs])
+    ms = TimestampField.time_string_to_int
+    items = []
 
     # Track seen games to make sure there aren't any duplicate games on the schedule.
     games_seen = set()
     order = 0
 
-    # Import each run from the Horaro schedules.
     for schedule in schedules:
         setup = dateparse.parse_duration(schedule['setup'])
 
@@ -191,55 +192,258 @@ def merge_event_schedule(event):
                     else:
                         runners.append((r, ''))
 
-            runner_names = set(r[0].lower() for r in runners)
+            setup_time = str(setup)
+            run_time = str(dateparse.parse_duration(item['length']))
+            starttime = dateparse.parse_datetime(item['scheduled'])
+            items.append({
+                'name': game,
+                'category': category,
+                'commentators': commentators,
+                'order': order,
+                'setup_time': setup_time,
+                'run_time': run_time,
+                'starttime': starttime,
+                'endtime': starttime + datetime.timedelta(milliseconds=ms(run_time) + ms(setup_time)),
+                'runners': runners,
+            })
+
+    return items
+
+
+class ScheduleDiff(object):
+    """The changes a Horaro schedule makes to an event, worked out against the runs and runners already
+    in the database. Nothing is written until apply() is called, so it doubles as a dry run report.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.num_runs = 0
+        # (run, fields) for runs to create and (run, {field: (old, new)}) for existing runs
+        self.created_runs = []
+        self.changed_runs = []
+        # runs that are no longer on the schedule, and lose their place in the order
+        self.unscheduled_runs = []
+        self.created_runners = []
+        # (runner, {field: (old, new)})
+        self.changed_runners = []
+        # (run name, runner) pairs
+        self.added_runners = []
+        self.removed_runners = []
+        # existing runs keyed by name, their new field values, and through rows to delete
+        self._runs = {}
+        self._updates = {}
+        self._removed_links = []
+        self._links = []
+
+    def __bool__(self):
+        return bool(self.created_runs or self.changed_runs or self.unscheduled_runs or self.created_runners
+                    or self.changed_runners or self.added_runners or self.removed_runners)
+
+    def lines(self):
+        """Human readable description of the changes, one per line."""
+        for run, fields in self.created_runs:
+            yield 'Create run {0!r} at {1}'.format(run, fields['starttime'])
+        for run, changes in self.changed_runs:
+            yield 'Update run {0!r}: {1}'.format(run, _describe(changes))
+        for run in self.unscheduled_runs:
+            yield 'Unschedule run {0!r}'.format(run)
+        for runner, stream in self.created_runners:
+            yield 'Create runner {0!r}'.format(runner) + (' ({0})'.format(stream) if stream else '')
+        for runner, changes in self.changed_runners:
+            yield 'Update runner {0!r}: {1}'.format(runner, _describe(changes))
+        for run, runner in self.added_runners:
+            yield 'Add runner {0!r} to {1!r}'.format(runner, run)
+        for run, runner in self.removed_runners:
+            yield 'Remove runner {0!r} from {1!r}'.format(runner, run)
+
+    def apply(self):
+        """Write the changes to the database, with a fixed number of queries no matter the schedule size.
+
+        :return: Number of runs updated.
+        :rtype: int
+        """
+        event = self.event
+        through = SpeedRun.runners.through
+
+        # Clear position for all for re-ordering.
+        SpeedRun.objects.filter(event=event).update(order=None)
+
+        runners = {}
+        if self.created_runners:
+            Runner.objects.bulk_create(Runner(name=name, stream=stream) for name, stream in self.created_runners)
+        if self.changed_runners:
+            updates = {}
+            for runner, changes in self.changed_runners:
+                updates[runner.pk] = {field: new for field, (old, new) in changes.items()}
+            _bulk_update(Runner, updates)
+        names = set(name.lower() for run, name in self._links)
+        if names:
+            runners = {r.name.lower(): r for r in
+                       Runner.objects.annotate(lower_name=Lower('name')).filter(lower_name__in=names)}
+
+        if self.created_runs:
+            SpeedRun.objects.bulk_create(SpeedRun(event=event, name=name, **fields)
+                                         for name, fields in self.created_runs)
+        if self._updates:
+            _bulk_update(SpeedRun, {self._runs[name].pk: fields for name, fields in self._updates.items()})
+        runs = dict(self._runs)
+        if self.created_runs:
+            runs.update((r.name, r) for r in
+                        SpeedRun.objects.filter(event=event, name__in=[name for name, fields in self.created_runs]))
+
+        if self._removed_links:
+            through.objects.filter(pk__in=self._removed_links).delete()
+        if self._links:
+            through.objects.bulk_create(through(speedrun_id=runs[run].pk, runner_id=runners[name.lower()].pk)
+                                        for run, name in self._links)
+
+        # Set event start date based on first run.
+        qs = SpeedRun.objects.filter(event=event).aggregate(start_date=Min('starttime'))
+        event.datetime = qs['start_date']
+        event.save()
+
+        # Bulk writes skip the save signals.
+        PrizeEligibility.invalidate(events=[event.pk])
+        DataVersion.bump('runs', [event.pk])
+        if self.created_runs:
+            SearchDocument.build('run', [runs[name].pk for name, fields in self.created_runs])
+        if self.created_runners or self.changed_runners or self._links or self._removed_links:
+            DataVersion.bump('runners')
+
+        return self.num_runs
+
+
+def _describe(changes):
+    return ', '.join('{0} {1!r} -> {2!r}'.format(field, old, new) for field, (old, new) in sorted(changes.items()))
+
+
+def _bulk_update(model, updates):
+    """Set different field values on many rows of a model with a single UPDATE.
+
+    :param updates: New field values keyed by primary key.
+    :type updates: dict[int, dict]
+    """
+    fields = set(field for values in updates.values() for field in values)
+    cases = {}
+    for field in fields:
+        output_field = model._meta.get_field(field)
+        cases[field] = Case(*[When(pk=pk, then=Value(values[field], output_field=output_field))
+                              for pk, values in updates.items() if field in values],
+                            default=field, output_field=output_field)
+    model.objects.filter(pk__in=list(updates)).update(**cases)
 
-            # Check for existing run, or make a new one.
-            logger.debug("Merging run: Game {0!r}, category {1!r}, runners {2!r}".format(game, category, runners))
 
-            if game in existing_runs:
-                run = existing_runs[game]
-            else:
-                run = SpeedRun(event=event, name=game)
-
-            run.category = category
-            run.commentators = commentators
-            run.order = order
-            run.setup_time = str(setup)
-            run.run_time = str(dateparse.parse_duration(item['length']))
-            run.starttime = dateparse.parse_datetime(item['scheduled'])
-            run.endtime = run.starttime + datetime.timedelta(milliseconds=i(run.run_time) + i(run.setup_time))
-            # Use times from the Horaro schedule.
-            run.save(fix_time=False)
-
-            # Make runner records.
-            for u in run.runners.all():
-                if u.name.lower() not in runner_names:
-                    run.runners.remove(u)
-
-            current_runners = run.runners.all()
-            for runner, url in runners:
-                try:
-                    u = Runner.objects.select_for_update().filter(name__iexact=runner).get()
-                except Runner.DoesNotExist:
-                    u = Runner()
-
-                u.name = runner
-                if url:
-                    u.stream = url
-                u.save()
-
-                if u not in current_runners:
-                    run.runners.add(u)
-
-            # Save the run again to update the runners field.
-            run.save(fix_time=False)
-
-            # Increment counter.
-            num_runs += 1
-
-    # Set event start date based on first run.
-    qs = SpeedRun.objects.filter(event=event).aggregate(start_date=Min('starttime'))
-    event.datetime = qs['start_date']
-    event.save()
-
-    return num_runs
+def _changes(model, instance, values):
+    changes = {}
+    for field, value in values.items():
+        prep = model._meta.get_field(field).get_prep_value
+        if prep(getattr(instance, field)) != prep(value):
+            changes[field] = (getattr(instance, field), value)
+    return changes
+
+
+def diff_event_schedule(event, schedules=None):
+    """Work out the changes merging the Horaro schedule would make to an event, from one read of its runs,
+    runners and run/runner links.
+
+    :param event: Event record to merge.
+    :type event: tracker.models.Event
+    :param schedules: Schedule data to merge, fetched from the Horaro API if not given.
+    :type schedules: list[dict]
+    :return: The pending changes.
+    :rtype: ScheduleDiff
+    """
+    if not event.horaro_id:
+        raise HoraroError("Event ID not set")
+
+    if schedules is None:
+        schedules = get_schedule_data(event.horaro_id)
+    items = parse_schedule(event, schedules)
+
+    diff = ScheduleDiff(event)
+    diff._runs = existing_runs = dict((r.name, r) for r in SpeedRun.objects.select_for_update().filter(event=event))
+
+    names = set(name.lower() for item in items for name, url in item['runners'])
+    existing_runners = {}
+    if names:
+        for r in Runner.objects.select_for_update().annotate(lower_name=Lower('name')).filter(lower_name__in=names):
+            existing_runners[r.name.lower()] = r
+
+    current_links = {}
+    for pk, run_id, runner_name in (SpeedRun.runners.through.objects.filter(speedrun__event=event)
+                                    .values_list('pk', 'speedrun_id', 'runner__name')):
+        current_links.setdefault(run_id, {})[runner_name.lower()] = (pk, runner_name)
+
+    # The last mention of a runner in the schedule wins, as when they were saved one by one.
+    runner_values = collections.OrderedDict()
+    for item in items:
+        for name, url in item['runners']:
+            values = runner_values.setdefault(name.lower(), {})
+            values['name'] = name
+            if url:
+                values['stream'] = url
+
+    for item in items:
+        logger.debug("Merging run: Game {0!r}, category {1!r}, runners {2!r}".format(
+            item['name'], item['category'], item['runners']))
+
+        run_runners = []
+        for name, url in item['runners']:
+            if runner_values[name.lower()]['name'] not in run_runners:
+                run_runners.append(runner_values[name.lower()]['name'])
+        fields = dict((field, item[field]) for field in RUN_FIELDS)
+        if run_runners:
+            fields['deprecated_runners'] = ', '.join(sorted(run_runners))
+        wanted = set(name.lower() for name in run_runners)
+        run = existing_runs.get(item['name'])
+        links = {}
+        if run is None:
+            diff.created_runs.append((item['name'], fields))
+        else:
+            links = current_links.get(run.pk, {})
+            changes = _changes(SpeedRun, run, fields)
+            if changes:
+                diff.changed_runs.append((run.name, changes))
+            diff._updates[run.name] = fields
+            for lower_name, (pk, runner_name) in sorted(links.items()):
+                if lower_name not in wanted:
+                    diff._removed_links.append(pk)
+                    diff.removed_runners.append((run.name, runner_name))
+        for name in run_runners:
+            if name.lower() not in links:
+                diff._links.append((item['name'], name))
+                diff.added_runners.append((item['name'], name))
+
+        # Increment counter.
+        diff.num_runs += 1
+
+    for lower_name, values in runner_values.items():
+        runner = existing_runners.get(lower_name)
+        if runner is None:
+            diff.created_runners.append((values['name'], values.get('stream', '')))
+        else:
+            changes = _changes(Runner, runner, values)
+            if changes:
+                diff.changed_runners.append((runner, changes))
+
+    scheduled = set(item['name'] for item in items)
+    diff.unscheduled_runs = sorted(name for name, run in existing_runs.items()
+                                   if name not in scheduled and run.order is not None)
+
+    return diff
+
+
+def merge_event_schedule(event, dry_run=False):
+    """Merge schedule from Horaro API with an event in our system.
+
+    :param event: Event record to merge.
+    :type event: tracker.models.Event
+    :param dry_run: Only work out the changes, without writing them.
+    :type dry_run: bool
+    :return: Number of runs updated.
+    :rtype: int
+    """
+    diff = diff_event_schedule(event)
+    if dry_run:
+        return diff.num_runs
+    return diff.apply()
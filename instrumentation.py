@@ -0,0 +1,250 @@
+"""
+Per view and per event request instrumentation: the query count, database time, serialization time,
+render time and total time of every request, kept in bounded in-memory histograms.
+
+Add 'tracker.instrumentation.InstrumentationMiddleware' to MIDDLEWARE to turn it on. The histograms
+belong to the process, so with several workers each reports its own, the way Prometheus expects to
+scrape them. Set TRACKER_SLOW_REQUEST_SECONDS to log requests slower than that, and
+TRACKER_REPEATED_QUERY_THRESHOLD to log requests that run the same statement at least that many times
+(the usual sign of an N+1 query), both along with their most repeated statements.
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in queries for the query count and seconds for everything else
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = collections.OrderedDict([
+    ('queries', ('Database queries per request', QUERY_BUCKETS)),
+    ('db_time', ('Seconds spent in the database per request', TIME_BUCKETS)),
+    ('serialize_time', ('Seconds spent serializing per request', TIME_BUCKETS)),
+    ('render_time', ('Seconds spent rendering templates per request', TIME_BUCKETS)),
+    ('total_time', ('Seconds per request', TIME_BUCKETS)),
+])
+
+# the least recently seen view/event pairs are dropped beyond this many
+MAX_SERIES = 500
+# how many statements a logged request lists
+TOP_STATEMENTS = 5
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns (upper bound, observations at or below it) pairs, ending with the infinite bucket."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry(object):
+    def __init__(self, max_series=MAX_SERIES):
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self._series = collections.OrderedDict()
+
+    def observe(self, view, event, values):
+        key = (view, event)
+        with self._lock:
+            series = self._series.pop(key, None)
+            if series is None:
+                series = dict((name, Histogram(buckets)) for name, (help, buckets) in METRICS.items())
+                while len(self._series) >= self.max_series:
+                    self._series.popitem(last=False)
+            self._series[key] = series
+            for name, value in values.items():
+                series[name].observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return [(view, event, dict((name, (h.cumulative(), h.count, h.sum)) for name, h in series.items()))
+                    for (view, event), series in self._series.items()]
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def as_json(self):
+        return [{
+            'view': view,
+            'event': event,
+            'metrics': dict((name, {
+                'count': count,
+                'sum': total,
+                'buckets': [['+Inf' if bound == float('inf') else bound, n] for bound, n in buckets],
+            }) for name, (buckets, count, total) in metrics.items()),
+        } for view, event, metrics in self.snapshot()]
+
+    def as_prometheus(self):
+        """Renders the histograms in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, (help, buckets) in METRICS.items():
+            metric = 'tracker_request_' + name
+            lines.append('# HELP {0} {1}'.format(metric, help))
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for view, event, metrics in snapshot:
+                cumulative, count, total = metrics[name]
+                labels = 'view="{0}",event="{1}"'.format(_escape(view), _escape(event))
+                for bound, n in cumulative:
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        metric, labels, '+Inf' if bound == float('inf') else bound, n))
+                lines.append('{0}_sum{{{1}}} {2}'.format(metric, labels, total))
+                lines.append('{0}_count{{{1}}} {2}'.format(metric, labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+class RequestStats(object):
+    """What one request spent its time on. Also a database execute wrapper that counts its queries."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0
+        self.timings = collections.defaultdict(float)
+        # statement -> [count, seconds]
+        self.statements = collections.defaultdict(lambda: [0, 0])
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_time += elapsed
+            statement = self.statements[sql]
+            statement[0] += 1
+            statement[1] += elapsed
+
+    def repeated(self):
+        """Returns the statements run more than once, as (count, seconds, sql), most repeated first."""
+        return sorted(((count, seconds, sql) for sql, (count, seconds) in self.statements.items() if count > 1),
+                      reverse=True)[:TOP_STATEMENTS]
+
+
+_local = threading.local()
+
+
+def current():
+    """The stats of the request being handled on this thread, if it is instrumented."""
+    return getattr(_local, 'stats', None)
+
+
+def record(name, seconds):
+    stats = current()
+    if stats is not None:
+        stats.timings[name] += seconds
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Adds the time spent in the block to the named timing of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def collecting(stats):
+    previous = current()
+    _local.stats = stats
+    wrapped = []
+    try:
+        for connection in connections.all():
+            connection.execute_wrappers.append(stats)
+            wrapped.append(connection)
+        yield
+    finally:
+        for connection in wrapped:
+            connection.execute_wrappers.remove(stats)
+        _local.stats = previous
+
+
+class InstrumentationMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        start = time.perf_counter()
+        with collecting(stats):
+            response = self.get_response(request)
+        # streamed responses do most of their work after the view returns, except for event streams,
+        # which never finish
+        if response.streaming and not response.get('Content-Type', '').startswith('text/event-stream'):
+            response.streaming_content = self.stream(request, response.streaming_content, stats, start)
+        else:
+            self.finish(request, stats, start)
+        return response
+
+    def stream(self, request, content, stats, start):
+        try:
+            with collecting(stats):
+                for chunk in content:
+                    yield chunk
+        finally:
+            self.finish(request, stats, start)
+
+    def finish(self, request, stats, start):
+        elapsed = time.perf_counter() - start
+        view, event = request_labels(request)
+        registry.observe(view, event, {
+            'queries': stats.queries,
+            'db_time': stats.db_time,
+            'serialize_time': stats.timings['serialize'],
+            'render_time': stats.timings['render'],
+            'total_time': elapsed,
+        })
+        slow = getattr(settings, 'TRACKER_SLOW_REQUEST_SECONDS', None)
+        threshold = getattr(settings, 'TRACKER_REPEATED_QUERY_THRESHOLD', None)
+        repeated = stats.repeated()
+        if (slow is not None and elapsed >= slow) or (threshold and repeated and repeated[0][0] >= threshold):
+            logger.warning('%s %s (%s, event %s) took %.3fs with %d queries (%.3fs in the database)%s',
+                           request.method, request.get_full_path(), view, event or '-', elapsed, stats.queries,
+                           stats.db_time, ''.join('\n  %dx %.3fs %s' % statement for statement in repeated))
+
+
+def request_labels(request):
+    """The view name and event a request is filed under."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved', ''
+    event = match.kwargs.get('event') or request.GET.get('event') or ''
+    return match.view_name, str(event)[:64]
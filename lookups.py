@@ -8,6 +8,7 @@ from django.contrib.auth import get_user_model
 from tracker.models import *
 import tracker.viewutil as viewutil
 import tracker.filters as filters
+import tracker.autocomplete as autocomplete
 
 """
 In order to use these lookups properly with the admin, you will need to install/enable the 'ajax_select'
@@ -72,7 +73,7 @@ class CountryRegionLookup(LookupChannel):
 
 class GenericLookup(LookupChannel):
   def get_query(self,q,request):
-    params = {'q': q}
+    params = {}
     event = viewutil.get_selected_event(request)
     if event and self.useEvent:
       params['event'] = event.id
@@ -81,6 +82,9 @@ class GenericLookup(LookupChannel):
       model = self.modelName
     if self.useLock and not request.user.has_perm('tracker.can_edit_locked_events'):
       params['locked'] = False
+    if autocomplete.indexed(model):
+      return autocomplete.search(model, q, params, user=request.user)
+    params['q'] = q
     return filters.run_model_query(model, params, user=request.user, mode='admin')
 
   def get_result(self,obj):
@@ -0,0 +1,34 @@
+import time
+
+import tracker.commandutil as commandutil
+import tracker.postbackutil as postbackutil
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Send the queued donation postbacks, retrying failed ones with backoff'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--concurrency', help='how many postbacks to send at once', type=int, default=8)
+        parser.add_argument('-b', '--batch', help='how many postbacks to claim at a time', type=int, default=100)
+        parser.add_argument('-t', '--timeout', help='seconds to wait for each receiver', type=float, default=5)
+        parser.add_argument('-i', '--interval', help='seconds to wait between polls when the queue is empty',
+                            type=float, default=1)
+        parser.add_argument('--once', help='exit once the queue has no due postbacks instead of polling',
+                            action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        while True:
+            results = postbackutil.deliver_postbacks(limit=options['batch'], concurrency=options['concurrency'],
+                                                     timeout=options['timeout'])
+            for delivery, error in results:
+                if error:
+                    self.message('Postback to {0} failed: {1}'.format(delivery.postback.url, error), 1)
+                else:
+                    self.message('Delivered postback to {0}'.format(delivery.postback.url), 2)
+            if not results:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
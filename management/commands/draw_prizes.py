@@ -23,17 +23,14 @@ class Command(commandutil.TrackerCommand):
         parser.add_argument('-s', '--seed', help='Specify the random seed to use for the drawing.', default=None, required=False)
         parser.add_argument('-d', '--dry-run', help='Run the command, but do not commit any changes to the database.', action='store_true')
 
-    def draw_prize(self, prize):
+    def draw_prizes(self, prizes):
         # TODO: add checks that the prize drawing time has passed
-        status = True
-        self.message('Drawing prize #{0}...'.format(prize.pk))
-        while status and not prize.maxed_winners():
-            status, data = prizeutil.draw_prize(prize, seed=self.rand.getrandbits(256))
-            if not status:
-                self.message('Error drawing prize #{0}: {1}'.format(prize.id, data['error']))
-            else:
-                self.message('Assigned prize #{0} to {1}'.format(prize.id, data['winner']))
-            self.message('{0}'.format(data), 3)
+        for result in prizeutil.draw_prizes(prizes, seed=self.rand.getrandbits(256)):
+            prize = result['prize']
+            for winner in result['winners']:
+                self.message('Assigned prize #{0} to {1}'.format(prize.id, winner))
+            if result['error']:
+                self.message('Error drawing prize #{0}: {1}'.format(prize.id, result['error']))
 
     def handle(self, *args, **options):
         super(Command,self).handle(*args, **options)
@@ -69,8 +66,7 @@ class Command(commandutil.TrackerCommand):
         else:
             try:
                 with transaction.atomic(): 
-                    for prize in prizeSet:
-                        self.draw_prize(prize)
+                    self.draw_prizes(prizeSet)
                     if dryRun:
                         self.message("Rolling back operations...")
                         raise Exception("Cancelled due to dry run.")
@@ -0,0 +1,34 @@
+import random
+import time
+
+from django.db import transaction
+
+import tracker.commandutil as commandutil
+import tracker.randgen as randgen
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Generate a large random event for benchmarking, bulk inserting its donors and donations'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--donors', help='number of donors to create', type=int, default=100000)
+        parser.add_argument('--donations', help='number of donations to create', type=int, default=1000000)
+        parser.add_argument('--runs', help='number of runs to create', type=int, default=150)
+        parser.add_argument('--bids', help='number of top level bids to create', type=int, default=2000)
+        parser.add_argument('--prizes', help='number of prizes to create', type=int, default=1000)
+        parser.add_argument('-s', '--seed', help='the random seed to use', type=int, default=None)
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        rand = random.Random(options['seed'])
+        start = time.time()
+
+        with transaction.atomic():
+            event = randgen.build_benchmark_event(
+                rand, numDonors=options['donors'], numDonations=options['donations'], numRuns=options['runs'],
+                numBids=options['bids'], numPrizes=options['prizes'],
+                progress=lambda message: self.message('{0} ({1:.1f}s)'.format(message, time.time() - start), 2))
+
+        self.message('Generated event {0} (#{1}) in {2:.1f}s.'.format(event.short, event.id, time.time() - start))
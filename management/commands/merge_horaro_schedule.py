@@ -0,0 +1,28 @@
+from django.db import transaction
+
+import tracker.commandutil as commandutil
+import tracker.horaro as horaro
+import tracker.viewutil as viewutil
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Merge the Horaro schedule of an event, listing the changes it makes'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('event', help='the event to merge the schedule into')
+        parser.add_argument('-d', '--dry-run', help='list the changes without writing them', action='store_true')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        event = viewutil.get_event(options['event'])
+
+        with transaction.atomic():
+            diff = horaro.diff_event_schedule(event)
+            for line in diff.lines():
+                self.message(line)
+            if options['dry_run']:
+                self.message('Dry run, {0} runs not merged.'.format(diff.num_runs))
+            else:
+                self.message('Merged {0} runs.'.format(diff.apply()))
@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models import Q
+
+import tracker.commandutil as commandutil
+import tracker.models as models
+import tracker.viewutil as viewutil
+from tracker.models.bid import rebuild_bid_totals
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Recompute bid totals from scratch, reporting (and fixing) any that have drifted'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--event', help='specify an event for which to rebuild bid totals',
+                            type=viewutil.get_event)
+        parser.add_argument('-c', '--check', help='Only report drifted totals, do not correct them.',
+                            action='store_true')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        bids = models.Bid.objects.all()
+
+        if options['event']:
+            event = viewutil.get_event(options['event'])
+            bids = bids.filter(Q(event=event) | Q(speedrun__event=event))
+
+        with transaction.atomic():
+            drifted = rebuild_bid_totals(bids, commit=not options['check'])
+
+        for bid_id, old_total, old_count, total, count in drifted:
+            self.message('Bid #{0}: stored {1} ({2}), actual {3} ({4})'.format(bid_id, old_total, old_count, total,
+                                                                               count), 0)
+
+        if drifted and options['check']:
+            self.message('{0} bid totals have drifted.'.format(len(drifted)), 0)
+        elif drifted:
+            self.message('Corrected {0} bid totals.'.format(len(drifted)))
+        else:
+            self.message('All bid totals are correct.')
@@ -0,0 +1,28 @@
+from django.db import transaction
+
+import tracker.commandutil as commandutil
+import tracker.models as models
+import tracker.viewutil as viewutil
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Recompute the cached donation totals of donors, for one event or for all of them'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--event', help='specify an event for which to rebuild the donor caches',
+                            type=viewutil.get_event)
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        events = None
+
+        if options['event']:
+            event = viewutil.get_event(options['event'])
+            events = models.Event.objects.filter(pk=event.id)
+
+        with transaction.atomic():
+            num_pairs = models.DonorCache.rebuild(events)
+
+        self.message('Rebuilt donor caches for {0} donor/event pairs.'.format(num_pairs))
@@ -0,0 +1,24 @@
+import tracker.commandutil as commandutil
+from tracker.models import SearchDocument
+from tracker.models.search import BATCH_SIZE
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Rebuild the search documents the general (q=) search looks through'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--model', help='only rebuild the documents of this filter model',
+                            choices=sorted(SearchDocument.MODELS), action='append')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        for kind in options['model'] or sorted(SearchDocument.MODELS):
+            model = SearchDocument.MODELS[kind]
+            ids = list(model.objects.order_by('pk').values_list('pk', flat=True))
+            for start in range(0, len(ids), BATCH_SIZE):
+                SearchDocument.build(kind, ids[start:start + BATCH_SIZE])
+            # documents of objects that no longer exist
+            stale, _ = SearchDocument.objects.filter(model=kind).exclude(object_id__in=model.objects.all()).delete()
+            self.message('Rebuilt {0} {1} documents, removed {2} stale ones.'.format(len(ids), kind, stale))
@@ -0,0 +1,38 @@
+from django.db import transaction
+
+import tracker.commandutil as commandutil
+import tracker.models as models
+import tracker.viewutil as viewutil
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Recompute the running donation totals of events, reporting (and fixing) any discrepancies'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--event', help='specify an event for which to reconcile the totals',
+                            type=viewutil.get_event)
+        parser.add_argument('-c', '--check', help='Only report discrepancies, do not correct them.',
+                            action='store_true')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        events = models.Event.objects.all()
+
+        if options['event']:
+            event = viewutil.get_event(options['event'])
+            events = events.filter(pk=event.id)
+
+        with transaction.atomic():
+            drifted = models.EventTotal.reconcile(events, commit=not options['check'])
+
+        for event_id, stored, actual in drifted:
+            self.message('Event #{0}: stored {1}, actual {2} (total, count, max)'.format(event_id, stored, actual), 0)
+
+        if drifted and options['check']:
+            self.message('{0} event totals have drifted.'.format(len(drifted)), 0)
+        elif drifted:
+            self.message('Corrected {0} event totals.'.format(len(drifted)))
+        else:
+            self.message('All event totals are correct.')
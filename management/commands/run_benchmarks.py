@@ -0,0 +1,39 @@
+import json
+
+import tracker.benchmark as benchmark
+import tracker.commandutil as commandutil
+import tracker.viewutil as viewutil
+
+
+class Command(commandutil.TrackerCommand):
+    help = 'Time the hot paths of the tracker against an event and write the results as a JSON report'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--event', help='specify the event to run the benchmarks against',
+                            type=viewutil.get_event, required=True)
+        parser.add_argument('-r', '--repeat', help='how many times to run each benchmark', type=int, default=3)
+        parser.add_argument('-b', '--benchmark', help='only run the named benchmark (may be repeated)', action='append',
+                            choices=list(benchmark.BENCHMARKS.keys()), default=None)
+        parser.add_argument('-s', '--seed', help='the random seed to use for prize draws', type=int, default=None)
+        parser.add_argument('-o', '--output', help='write the report to this file instead of standard output')
+        parser.add_argument('-c', '--compare', help='a previous report to compare the results against')
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+
+        report = benchmark.run_benchmarks(options['event'], repeat=options['repeat'], names=options['benchmark'],
+                                          seed=options['seed'])
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+
+        if options['compare']:
+            with open(options['compare']) as previous:
+                rows = benchmark.compare(json.load(previous), report)
+            for name, oldTime, newTime, ratio, oldQueries, newQueries in rows:
+                self.message('{0:24} {1:9.4f}s -> {2:9.4f}s ({3}) {4:6} -> {5:6} queries'.format(
+                    name, oldTime, newTime, '{0:.2f}x'.format(ratio) if ratio else 'n/a', oldQueries, newQueries))
@@ -23,6 +23,8 @@ class Command(commandutil.TrackerCommand):
                             type=viewutil.get_event)
         parser.add_argument('-d', '--dry-run', help='Run the command, but do not commit any changes to the database.',
                             action='store_true')
+        parser.add_argument('--full', help='Re-sync every donation, not just the ones since the last sync.',
+                            action='store_true')
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
@@ -36,11 +38,11 @@ class Command(commandutil.TrackerCommand):
             event_set = event_set.filter(pk=event.id)
 
         try:
-            with transaction.atomic():
+            with transaction.atomic(), models.DonorCache.deferred():
                 for event in event_set:
                     self.message('Syncing event #{0}...'.format(event.pk))
                     try:
-                        num_donations = tiltify.sync_event_donations(event)
+                        num_donations = tiltify.sync_event_donations(event, full=options['full'])
                     except (ValidationError, requests.exceptions.RequestException) as e:
                         self.message("Error syncing event #{} - {}".format(event.pk, e))
                         raise
@@ -0,0 +1,37 @@
+# Generated by Django 2.1.11 on 2026-10-18 16:58
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_event_totals(apps, schema_editor):
+    Donation = apps.get_model('tracker', 'Donation')
+    EventTotal = apps.get_model('tracker', 'EventTotal')
+    aggregates = Donation.objects.filter(transactionstate='COMPLETED', testdonation=models.F('event__usepaypalsandbox'))\
+        .order_by().values('event').annotate(total=models.Sum('amount'), count=models.Count('id'), max=models.Max('amount'))
+    EventTotal.objects.bulk_create(EventTotal(event_id=a['event'], total=a['total'], count=a['count'], max=a['max'])
+                                   for a in aggregates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventTotal',
+            fields=[
+                ('event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='donationtotal', serialize=False, to='tracker.Event')),
+                ('total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=20)),
+                ('count', models.IntegerField(default=0, editable=False)),
+                ('max', models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=20)),
+            ],
+            options={
+                'verbose_name': 'Event Total',
+            },
+        ),
+        migrations.RunPython(build_event_totals, migrations.RunPython.noop),
+    ]
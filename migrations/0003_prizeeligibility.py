@@ -0,0 +1,27 @@
+# Generated by Django 2.1.11 on 2026-10-18 17:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0002_eventtotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrizeEligibility',
+            fields=[
+                ('prize', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='eligibility', serialize=False, to='tracker.Prize')),
+                ('digest', models.CharField(editable=False, max_length=64)),
+                ('donors', models.TextField(editable=False)),
+                ('timestamp', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Prize Eligibility',
+                'verbose_name_plural': 'Prize Eligibilities',
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.1.11 on 2026-10-18 17:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0003_prizeeligibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostbackDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField(editable=False)),
+                ('state', models.CharField(choices=[('PENDING', 'Pending'), ('DELIVERED', 'Delivered'), ('FAILED', 'Failed')], db_index=True, default='PENDING', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Next Attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last Error')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('delivered', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Postback Delivery',
+                'verbose_name_plural': 'Postback Deliveries',
+                'ordering': ('next_attempt',),
+            },
+        ),
+        migrations.AddField(
+            model_name='postbackurl',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Consecutive Failures'),
+        ),
+        migrations.AddField(
+            model_name='postbackurl',
+            name='disabled_until',
+            field=models.DateTimeField(blank=True, help_text='Deliveries to this URL are paused until then after repeated failures', null=True, verbose_name='Disabled Until'),
+        ),
+        migrations.AddField(
+            model_name='postbackdelivery',
+            name='postback',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='tracker.PostbackURL'),
+        ),
+    ]
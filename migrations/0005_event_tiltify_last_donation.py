@@ -0,0 +1,18 @@
+# Generated by Django 2.1.11 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0004_postbackdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='tiltify_last_donation',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='ID of the newest donation synced, later syncs stop there', null=True, verbose_name='Last Tiltify Donation'),
+        ),
+    ]
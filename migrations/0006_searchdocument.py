@@ -0,0 +1,74 @@
+# Generated by Django 2.1.11 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+COLUMNS = ('public', 'emails', 'usernames', 'comments')
+
+
+def create_text_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for column in COLUMNS:
+            schema_editor.execute('CREATE INDEX tracker_searchdocument_{0}_trgm ON tracker_searchdocument '
+                                  'USING gin ({0} gin_trgm_ops)'.format(column))
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE tracker_searchdocument_fts USING fts5({0}, "
+                               "content='tracker_searchdocument', content_rowid='id', tokenize='trigram')"
+                               .format(', '.join(COLUMNS)))
+            except Exception:
+                # SQLite builds older than 3.34 have no trigram tokenizer, so searches use LIKE instead
+                return
+        columns = ', '.join(COLUMNS)
+        new = ', '.join('new.' + column for column in COLUMNS)
+        old = ', '.join('old.' + column for column in COLUMNS)
+        insert = 'INSERT INTO tracker_searchdocument_fts(rowid, {0}) VALUES (new.id, {1});'.format(columns, new)
+        delete = ("INSERT INTO tracker_searchdocument_fts(tracker_searchdocument_fts, rowid, {0}) "
+                  "VALUES ('delete', old.id, {1});".format(columns, old))
+        for name, when, body in (('ai', 'AFTER INSERT', insert), ('ad', 'AFTER DELETE', delete),
+                                 ('au', 'AFTER UPDATE', delete + ' ' + insert)):
+            schema_editor.execute('CREATE TRIGGER tracker_searchdocument_{0} {1} ON tracker_searchdocument '
+                                  'BEGIN {2} END'.format(name, when, body))
+
+
+def drop_text_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for column in COLUMNS:
+            schema_editor.execute('DROP INDEX IF EXISTS tracker_searchdocument_{0}_trgm'.format(column))
+    elif connection.vendor == 'sqlite':
+        for name in ('ai', 'ad', 'au'):
+            schema_editor.execute('DROP TRIGGER IF EXISTS tracker_searchdocument_{0}'.format(name))
+        schema_editor.execute('DROP TABLE IF EXISTS tracker_searchdocument_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0005_event_tiltify_last_donation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('public', models.TextField(blank=True)),
+                ('emails', models.TextField(blank=True)),
+                ('usernames', models.TextField(blank=True)),
+                ('comments', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'Search Document',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchdocument',
+            unique_together={('model', 'object_id')},
+        ),
+        migrations.RunPython(create_text_indexes, drop_text_indexes),
+    ]
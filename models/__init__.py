@@ -6,22 +6,28 @@ from .event import *
 from .bid import *
 from .donation import *
 from .prize import *
+from .dataversion import *
+from .search import *
 from .country import *
 
 __all__ = [
     'Event',
+    'EventRegistry',
     'PostbackURL',
+    'PostbackDelivery',
     'Bid',
     'DonationBid',
     'BidSuggestion',
     'Donation',
     'Donor',
     'DonorCache',
+    'EventTotal',
     'Prize',
     'PrizeCategory',
     'PrizeTicket',
     'PrizeWinner',
     'DonorPrizeEntry',
+    'PrizeEligibility',
     'SpeedRun',
     'Runner',
     'Submission',
@@ -29,6 +35,8 @@ __all__ = [
     'Log',
     'Country',
     'CountryRegion',
+    'DataVersion',
+    'SearchDocument',
 ]
 
 class UserProfile(models.Model):
@@ -1,14 +1,17 @@
 from django.db import models
-from django.db.models import signals, Sum, Q
+from django.db.models import signals, Sum, Count, Q, F
 from django.core.exceptions import ValidationError
 from django.dispatch import receiver
 
 from tracker.validators import *
 from tracker.models import Event, SpeedRun
+from tracker.pubsub import publish
 
 from decimal import Decimal
 import mptt.models
 from datetime import datetime
+from functools import reduce
+import operator
 import pytz
 
 __all__ = [
@@ -17,6 +20,9 @@ __all__ = [
   'BidSuggestion',
 ]
 
+# options in these states do not count towards their parent's total
+_UNCOUNTED_STATES = ('HIDDEN', 'DENIED', 'PENDING')
+
 class BidManager(models.Manager):
   def get_by_natural_key(self, event, name, speedrun=None, parent=None):
     return self.get(event=Event.objects.get_by_natural_key(*event),
@@ -123,7 +129,7 @@ class Bid(mptt.models.MPTTModel):
       if self.goal and self.state == 'OPENED' and self.total >= self.goal and self.istarget:
         self.state = 'CLOSED'
     else:
-      options = self.options.exclude(state__in=('HIDDEN','DENIED','PENDING')).aggregate(Sum('total'),Sum('count'))
+      options = self.options.exclude(state__in=_UNCOUNTED_STATES).aggregate(Sum('total'),Sum('count'))
       self.total = options['total__sum'] or Decimal('0.00')
       self.count = options['count__sum'] or 0
 
@@ -164,6 +170,23 @@ def BidParentUpdate(sender, instance, created, raw, **kwargs):
   if instance.parent:
     instance.parent.save()
 
+@receiver(signals.post_save, sender=Bid)
+def BidPublish(sender, instance, raw, **kwargs):
+  if raw or not instance.event_id: return
+  publish_bids(instance.event_id, [instance.id])
+
+def publish_bids(event_id, bid_ids):
+  """
+  Pushes the current state of the given bids to the live stream of their event once the transaction commits.
+  Totals are left out for bids that are not public.
+  """
+  def data():
+    bids = Bid.objects.filter(pk__in=bid_ids).values('id', 'parent', 'state', 'goal', 'total', 'count')
+    return [dict(bid, goal=None if bid['goal'] is None else float(bid['goal']), total=float(bid['total']))
+            if bid['state'] in ('OPENED', 'CLOSED') else {'id': bid['id'], 'parent': bid['parent'], 'state': bid['state']}
+            for bid in bids] or None
+  publish(event_id, 'bids', data)
+
 class DonationBid(models.Model):
   bid = models.ForeignKey('Bid',on_delete=models.PROTECT,related_name='bids')
   donation = models.ForeignKey('Donation',on_delete=models.PROTECT,related_name='bids')
@@ -173,6 +196,15 @@ class DonationBid(models.Model):
     verbose_name = 'Donation Bid'
     ordering = [ '-donation__timereceived', 'bid__name' ]
     unique_together = (('bid', 'donation'),)
+  @classmethod
+  def from_db(cls, db, field_names, values):
+    instance = super(DonationBid, cls).from_db(db, field_names, values)
+    instance.track_saved_values()
+    return instance
+  def track_saved_values(self):
+    # remember what this row contributed to its bid, so that edits can be applied as deltas
+    if 'bid_id' in self.__dict__ and 'amount' in self.__dict__:
+      self._saved_bid_id, self._saved_amount = self.bid_id, self.amount
   def clean(self):
     if not self.bid.istarget:
       raise ValidationError('Target bid must be a leaf node')
@@ -190,10 +222,124 @@ class DonationBid(models.Model):
   def __str__(self):
     return str(self.bid) + ' -- ' + str(self.donation)
 
+@receiver(signals.pre_save, sender=DonationBid)
+def DonationBidTrack(sender, instance, raw, **kwargs):
+  if raw or instance._state.adding or hasattr(instance, '_saved_bid_id'):
+    return
+  instance._saved_bid_id, instance._saved_amount = DonationBid.objects.filter(pk=instance.pk).values_list('bid_id', 'amount').first() or (None, None)
+
 @receiver(signals.post_save, sender=DonationBid)
 def DonationBidParentUpdate(sender, instance, created, raw, **kwargs):
   if raw: return
-  if instance.donation.transactionstate == 'COMPLETED': instance.bid.save()
+  deltas = {}
+  if instance.donation.transactionstate == 'COMPLETED':
+    saved_bid_id = getattr(instance, '_saved_bid_id', None)
+    if not created and saved_bid_id:
+      add_bid_total_delta(deltas, saved_bid_id, -instance._saved_amount, -1)
+    add_bid_total_delta(deltas, instance.bid_id, Decimal(str(instance.amount)), 1)
+  applied = apply_bid_total_deltas(deltas)
+  # keep an already loaded target in sync with what was just written to the database
+  if instance.bid_id in applied and DonationBid.bid.is_cached(instance):
+    bid = instance.bid
+    amount, count = applied[bid.id]
+    bid.total += amount
+    bid.count += count
+    if bid.goal and bid.state == 'OPENED' and bid.total >= bid.goal and bid.istarget:
+      bid.state = 'CLOSED'
+  instance.track_saved_values()
+
+@receiver(signals.post_delete, sender=DonationBid)
+def DonationBidDeleteUpdate(sender, instance, **kwargs):
+  if instance.donation.transactionstate == 'COMPLETED':
+    saved_bid_id = getattr(instance, '_saved_bid_id', instance.bid_id)
+    saved_amount = getattr(instance, '_saved_amount', instance.amount)
+    apply_bid_total_deltas({saved_bid_id: (-Decimal(str(saved_amount)), -1)})
+
+def add_bid_total_delta(deltas, bid_id, amount, count):
+  old_amount, old_count = deltas.get(bid_id, (Decimal('0.00'), 0))
+  deltas[bid_id] = (old_amount + amount, old_count + count)
+
+def donation_bid_total_deltas(donation, sign=1):
+  """
+  Returns the {bid id: (amount, count)} deltas that a donation's bid allocations contribute
+  to their targets, negated if sign is -1 (i.e. when a completed donation is reversed)
+  """
+  deltas = {}
+  for bid_id, amount in DonationBid.objects.filter(donation=donation).values_list('bid_id', 'amount'):
+    add_bid_total_delta(deltas, bid_id, sign * amount, sign)
+  return deltas
+
+def apply_bid_total_deltas(deltas):
+  """
+  Applies {target bid id: (amount, count)} deltas to the target bids and every ancestor that
+  counts them, using F() expressions so that concurrent donations cannot overwrite each other.
+  This replaces re-aggregating (and re-saving) the whole chain of parents for every donation.
+  Returns the deltas that were applied to each bid in the affected trees.
+  """
+  deltas = dict((k, v) for k, v in deltas.items() if v[0] or v[1])
+  if not deltas:
+    return {}
+  targets = list(Bid.objects.filter(pk__in=deltas.keys()).values('id', 'parent_id', 'tree_id', 'lft', 'rght', 'state', 'event_id'))
+  nodes = dict((t['id'], t) for t in targets)
+  ancestorsQuery = reduce(operator.or_, (Q(tree_id=t['tree_id'], lft__lt=t['lft'], rght__gt=t['rght']) for t in targets if t['parent_id']), Q(pk__in=[]))
+  for ancestor in Bid.objects.filter(ancestorsQuery).values('id', 'parent_id', 'state', 'event_id'):
+    nodes[ancestor['id']] = ancestor
+  applied = {}
+  for target in targets:
+    amount, count = deltas[target['id']]
+    node = target
+    while True:
+      add_bid_total_delta(applied, node['id'], amount, count)
+      if node['state'] in _UNCOUNTED_STATES or not node['parent_id']:
+        break
+      node = nodes[node['parent_id']]
+  grouped = {}
+  for bid_id, delta in applied.items():
+    grouped.setdefault(delta, []).append(bid_id)
+  for (amount, count), ids in grouped.items():
+    Bid.objects.filter(pk__in=ids).update(total=F('total') + amount, count=F('count') + count)
+  # auto close any challenges whose goal has now been met, same as Bid.update_total
+  Bid.objects.filter(pk__in=deltas.keys(), istarget=True, state='OPENED', goal__isnull=False, total__gte=F('goal')).update(state='CLOSED')
+  byEvent = {}
+  for bid_id in applied:
+    if nodes[bid_id]['event_id']:
+      byEvent.setdefault(nodes[bid_id]['event_id'], []).append(bid_id)
+  for event_id, bid_ids in byEvent.items():
+    publish_bids(event_id, bid_ids)
+  from .dataversion import DataVersion
+  DataVersion.bump('bids', byEvent.keys())
+  return applied
+
+def rebuild_bid_totals(bids=None, commit=True):
+  """
+  Recomputes the totals of every bid in the trees of the given bids (all bids by default) from
+  scratch, with one grouped aggregate over the donation bids and a single pass over each tree.
+  Returns a list of (bid id, stored total, stored count, actual total, actual count) for every
+  bid whose stored totals had drifted. If commit is set, the drifted bids are corrected.
+  """
+  if bids is None:
+    bids = Bid.objects.all()
+  trees = bids.values('tree_id').distinct()
+  sums = DonationBid.objects.filter(bid__tree_id__in=trees, donation__transactionstate='COMPLETED').order_by().values('bid').annotate(total=Sum('amount'), count=Count('id'))
+  computed = dict((s['bid'], (s['total'], s['count'])) for s in sums)
+  drifted = []
+  # descendants always have a higher lft than their ancestors, so this visits children first
+  for node in Bid.objects.filter(tree_id__in=trees).order_by('tree_id', '-lft').values('id', 'parent_id', 'istarget', 'state', 'total', 'count'):
+    if node['istarget']:
+      total, count = computed.get(node['id'], (Decimal('0.00'), 0))
+    else:
+      total, count = computed.pop(('children', node['id']), (Decimal('0.00'), 0))
+    if node['parent_id'] and node['state'] not in _UNCOUNTED_STATES:
+      add_bid_total_delta(computed, ('children', node['parent_id']), total, count)
+    if total != node['total'] or count != node['count']:
+      drifted.append((node['id'], node['total'], node['count'], total, count))
+  if commit:
+    for bid_id, old_total, old_count, total, count in drifted:
+      Bid.objects.filter(pk=bid_id).update(total=total, count=count)
+    if drifted:
+      from .dataversion import DataVersion
+      DataVersion.bump('bids', Bid.objects.filter(pk__in=[d[0] for d in drifted]).values_list('event_id', flat=True).distinct())
+  return drifted
 
 class BidSuggestion(models.Model):
   bid = models.ForeignKey('Bid', related_name='suggestions', null=False,on_delete=models.PROTECT)
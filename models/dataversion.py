@@ -0,0 +1,128 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import signals
+from django.dispatch import receiver
+
+from .bid import Bid
+from .donation import Donation, Donor
+from .event import Event, Runner, SpeedRun
+from .prize import Prize, PrizeCategory, PrizeWinner
+
+__all__ = [
+    'DataVersion',
+]
+
+
+class DataVersion(object):
+    """
+    Counters kept in the default cache that go up whenever the data behind the public pages changes,
+    so that cached pages and fragments can be keyed on the versions of the data they show, and are
+    rebuilt exactly when it changes. Donations, bids, prizes and runs are counted per event (and for
+    all events together), everything else only as a whole.
+    """
+    EVENT_KINDS = ('donations', 'bids', 'prizes', 'runs')
+    GLOBAL_KINDS = ('events', 'donors', 'runners', 'prizecategories')
+
+    @staticmethod
+    def _key(kind, event_id=None):
+        return 'tracker.version.%s.%s' % (kind, event_id or 'all')
+
+    @staticmethod
+    def _initial():
+        # a counter that was evicted starts again above any value it could have had before
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def get(kinds, event_id=None):
+        """Returns the current {kind: version} of the event (or of all events) for the given kinds."""
+        keys = dict((kind, DataVersion._key(kind, event_id if kind in DataVersion.EVENT_KINDS else None))
+                    for kind in kinds)
+        versions = cache.get_many(keys.values())
+        result = {}
+        for kind, key in keys.items():
+            if key not in versions:
+                cache.add(key, DataVersion._initial(), None)
+                versions[key] = cache.get(key)
+            result[kind] = versions[key]
+        return result
+
+    @staticmethod
+    def key(kinds, event_id=None):
+        """A string that changes whenever any of the kinds of data of the event changes."""
+        versions = DataVersion.get(kinds, event_id)
+        return '%s:%s' % (event_id or 'all', '.'.join('%s%s' % (kind, versions[kind]) for kind in sorted(kinds)))
+
+    @staticmethod
+    def bump(kind, event_ids=()):
+        """Marks a kind of data as changed for the given events, and for all events."""
+        keys = [DataVersion._key(kind)]
+        if kind in DataVersion.EVENT_KINDS:
+            keys += [DataVersion._key(kind, event_id) for event_id in set(event_ids) if event_id]
+
+        def increment():
+            for key in keys:
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    cache.add(key, DataVersion._initial(), None)
+        increment()
+        # pages rebuilt before the change committed would otherwise be cached under the new version
+        transaction.on_commit(increment)
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Event)
+    @receiver(signals.post_delete, sender=Event)
+    def event_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        DataVersion.bump('events')
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Donation)
+    @receiver(signals.post_delete, sender=Donation)
+    def donation_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        saved = getattr(instance, '_saved_values', None) or {}
+        DataVersion.bump('donations', [instance.event_id, saved.get('event_id')])
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Bid)
+    @receiver(signals.post_delete, sender=Bid)
+    def bid_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        DataVersion.bump('bids', [instance.event_id])
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Prize)
+    @receiver(signals.post_delete, sender=Prize)
+    @receiver(signals.post_save, sender=PrizeWinner)
+    @receiver(signals.post_delete, sender=PrizeWinner)
+    def prize_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        prize = instance if sender is Prize else instance.prize
+        DataVersion.bump('prizes', [prize.event_id])
+
+    @staticmethod
+    @receiver(signals.post_save, sender=SpeedRun)
+    @receiver(signals.post_delete, sender=SpeedRun)
+    def run_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        DataVersion.bump('runs', [instance.event_id])
+
+    @staticmethod
+    @receiver(signals.m2m_changed, sender=SpeedRun.runners.through)
+    def runners_update(sender, instance, action, reverse, **kwargs):
+        if action.startswith('post_'):
+            DataVersion.bump('runners')
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Donor)
+    @receiver(signals.post_delete, sender=Donor)
+    @receiver(signals.post_save, sender=Runner)
+    @receiver(signals.post_delete, sender=Runner)
+    @receiver(signals.post_save, sender=PrizeCategory)
+    @receiver(signals.post_delete, sender=PrizeCategory)
+    def global_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        DataVersion.bump({Donor: 'donors', Runner: 'runners', PrizeCategory: 'prizecategories'}[sender])
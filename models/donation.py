@@ -1,18 +1,21 @@
 from decimal import Decimal
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import signals
-from django.db.models import Count,Sum,Max,Avg
+from django.db.models import Count,Sum,Max,Avg,F,Subquery,Case,When,Value
+from django.db.models.functions import Coalesce, Greatest
 from django.core.exceptions import ValidationError
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
 
-from .event import LatestEvent
+from .event import Event, LatestEvent
 from .fields import OneToOneOrNoneField
 from ..validators import *
+from ..pubsub import publish
 from functools import reduce
+from contextlib import contextmanager
 
 try:
   import cld
@@ -21,11 +24,13 @@ except ImportError:
   warnings.warn('Could not import cld, chromium_compact_language_detector not installed, language detection will not function')
   cld = None
 import calendar
+import threading
 
 __all__ = [
   'Donation',
   'Donor',
   'DonorCache',
+  'EventTotal',
 ]
 
 _currencyChoices = (('USD','US Dollars'),('CAD', 'Canadian Dollars'))
@@ -76,6 +81,19 @@ class Donation(models.Model):
     get_latest_by = 'timereceived'
     ordering = [ '-timereceived' ]
 
+  @classmethod
+  def from_db(cls, db, field_names, values):
+    instance = super(Donation, cls).from_db(db, field_names, values)
+    instance.track_saved_values()
+    return instance
+
+  _TRACKED_FIELDS = ('transactionstate', 'amount', 'event_id', 'testdonation', 'donor_id')
+
+  def track_saved_values(self):
+    # remember what this row contributed to the cached totals, so that changes can be applied as deltas
+    if all(f in self.__dict__ for f in Donation._TRACKED_FIELDS):
+      self._saved_values = dict((f, self.__dict__[f]) for f in Donation._TRACKED_FIELDS)
+
   def bid_total(self):
     return reduce(lambda a, b: a + b, [b.amount for b in self.bids.all()], Decimal('0.00'))
 
@@ -139,12 +157,43 @@ class Donation(models.Model):
   def __str__(self):
     return str(self.donor.visible_name() if self.donor else self.donor) + ' (' + str(self.amount) + ') (' + str(self.timereceived) + ')'
 
+@receiver(signals.pre_save, sender=Donation)
+def DonationTrack(sender, instance, raw, **kwargs):
+  if raw or instance._state.adding or hasattr(instance, '_saved_values'):
+    return
+  instance._saved_values = Donation.objects.filter(pk=instance.pk).values(*Donation._TRACKED_FIELDS).first()
+
 @receiver(signals.post_save, sender=Donation)
 def DonationBidsUpdate(sender, instance, created, raw, **kwargs):
   if raw: return
-  if instance.transactionstate == 'COMPLETED':
-    for b in instance.bids.all():
-      b.save()
+  from .bid import apply_bid_total_deltas, donation_bid_total_deltas
+  saved = getattr(instance, '_saved_values', None) or {}
+  wasCompleted = saved.get('transactionstate') == 'COMPLETED'
+  isCompleted = instance.transactionstate == 'COMPLETED'
+  # bid totals only change when the donation moves into or out of the completed state
+  if isCompleted != wasCompleted and not created:
+    apply_bid_total_deltas(donation_bid_total_deltas(instance, 1 if isCompleted else -1))
+
+@receiver(signals.post_save, sender=Donation)
+def DonationPublish(sender, instance, raw, **kwargs):
+  # completed donations go out again on every save, so that live viewers also see their state changes
+  if raw: return
+  publish_donation(instance)
+
+def publish_donation(instance):
+  # only the donations that count towards the event total, which leaves out test donations on live events
+  if not EventTotal.counted(instance.event, instance.transactionstate, instance.testdonation):
+    return
+  publish(instance.event_id, 'donation', lambda: {
+    'id': instance.id,
+    'donor': instance.donor.visible_name() if instance.donor else Donor.ANONYMOUS,
+    'comment': instance.comment if instance.commentstate == 'APPROVED' else '',
+    'amount': float(instance.amount),
+    'timereceived': instance.timereceived,
+    'readstate': instance.readstate,
+    'commentstate': instance.commentstate,
+    'bidstate': instance.bidstate,
+  })
 
 class DonorManager(models.Manager):
   def get_by_natural_key(self, email):
@@ -226,6 +275,9 @@ class Donor(models.Model):
       ret += ' (' + str(self.alias) + ')'
     return ret
 
+# (donor id, event id) pairs touched inside DonorCache.deferred(), None outside of it
+_donorcache_deferred = threading.local()
+
 class DonorCache(models.Model):
   event = models.ForeignKey('Event', blank=True, null=True, on_delete=models.PROTECT)  # null event = all events
   donor = models.ForeignKey('Donor', on_delete=models.PROTECT)
@@ -237,21 +289,100 @@ class DonorCache(models.Model):
   @staticmethod
   @receiver(signals.post_save, sender=Donation)
   @receiver(signals.post_delete, sender=Donation)
-  def donation_update(sender, instance, **args):
-    if not instance.donor:
+  def donation_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    pairs = set()
+    if instance.donor_id:
+      pairs.add((instance.donor_id, instance.event_id))
+    saved = getattr(instance, '_saved_values', None)
+    if saved and saved['donor_id']:
+      pairs.add((saved['donor_id'], saved['event_id']))
+    if not pairs:
       return
-    cache,c = DonorCache.objects.get_or_create(event=instance.event,donor=instance.donor)
-    cache.update()
-    if cache.donation_count:
-      cache.save()
-    else:
-      cache.delete()
-    cache,c = DonorCache.objects.get_or_create(event=None,donor=instance.donor)
-    cache.update()
-    if cache.donation_count:
-      cache.save()
+    if getattr(_donorcache_deferred, 'pairs', None) is not None:
+      _donorcache_deferred.pairs.update(pairs)
     else:
-      cache.delete()
+      DonorCache.recompute(pairs)
+
+  @staticmethod
+  @contextmanager
+  def deferred():
+    """
+    Defers cache maintenance for donations saved inside the block to the end of the block,
+    recomputing every touched (donor, event) pair at once. The block runs in a transaction.
+    """
+    if getattr(_donorcache_deferred, 'pairs', None) is not None:
+      yield
+      return
+    _donorcache_deferred.pairs = set()
+    try:
+      with transaction.atomic():
+        yield
+        pairs, _donorcache_deferred.pairs = _donorcache_deferred.pairs, None
+        DonorCache.recompute(pairs)
+    finally:
+      _donorcache_deferred.pairs = None
+
+  @staticmethod
+  def recompute(pairs):
+    """
+    Recomputes the per-event and all-events caches for the given (donor id, event id) pairs with one
+    grouped aggregate per kind, creating, updating or deleting cache rows as needed.
+    """
+    donorIds = set(d for d,e in pairs)
+    if not donorIds:
+      return
+    eventIds = set(e for d,e in pairs if e)
+    keys = set((d,e) for d,e in pairs if e) | set((d,None) for d in donorIds)
+    completed = Donation.objects.filter(donor__in=donorIds, transactionstate='COMPLETED').order_by()
+    fields = dict(total=Sum('amount'),count=Count('amount'),max=Max('amount'),avg=Avg('amount'))
+    actual = {}
+    if eventIds:
+      for a in completed.filter(event__in=eventIds).values('donor','event').annotate(**fields):
+        actual[(a['donor'],a['event'])] = a
+    for a in completed.values('donor').annotate(**fields):
+      actual[(a['donor'],None)] = a
+    existing = dict(((c.donor_id,c.event_id),c) for c in DonorCache.objects.filter(donor__in=donorIds))
+    created, updated, deleted = [], [], []
+    for key in keys:
+      cache = existing.get(key)
+      a = actual.get(key)
+      if not a:
+        if cache: deleted.append(cache.id)
+        continue
+      values = (a['total'], a['count'], a['max'], a['avg'])
+      if not cache:
+        created.append(DonorCache(donor_id=key[0], event_id=key[1]))
+        cache = created[-1]
+      elif (cache.donation_total, cache.donation_count, cache.donation_max, cache.donation_avg) == values:
+        continue
+      else:
+        updated.append(cache)
+      cache.donation_total, cache.donation_count, cache.donation_max, cache.donation_avg = values
+    if deleted:
+      DonorCache.objects.filter(id__in=deleted).delete()
+    if created:
+      DonorCache.objects.bulk_create(created)
+    if updated:
+      cases = lambda field: Case(*[When(id=c.id, then=Value(getattr(c, field))) for c in updated], output_field=DonorCache._meta.get_field(field))
+      DonorCache.objects.filter(id__in=[c.id for c in updated]).update(**dict((f, cases(f)) for f in ('donation_total','donation_count','donation_max','donation_avg')))
+
+  @staticmethod
+  def rebuild(events=None):
+    """
+    Recomputes every cache row for the given events' donors (all donors by default)
+    """
+    donations = Donation.objects.exclude(donor=None)
+    caches = DonorCache.objects.all()
+    if events is not None:
+      donations = donations.filter(event__in=events)
+      caches = caches.filter(event__in=events)
+    pairs = set(donations.order_by().values_list('donor','event').distinct())
+    pairs |= set(caches.exclude(event=None).values_list('donor','event'))
+    if events is None:
+      pairs |= set(caches.filter(event=None).values_list('donor','event'))
+    DonorCache.recompute(pairs)
+    return len(pairs)
 
   def update(self):
     aggregate = Donation.objects.filter(donor=self.donor,transactionstate='COMPLETED')
@@ -294,3 +425,117 @@ class DonorCache(models.Model):
     ordering = ('donor', )
     unique_together = ('event', 'donor')
 
+
+class EventTotal(models.Model):
+  """
+  A running ledger of the counted (completed, non-test) donations of an event, maintained as
+  donations move in and out of the completed state, so that tickers can read the event total
+  from a single row instead of aggregating every donation.
+  """
+  event = models.OneToOneField('Event', primary_key=True, on_delete=models.CASCADE, related_name='donationtotal')
+  total = models.DecimalField(decimal_places=2,max_digits=20,editable=False,default=Decimal('0.00'))
+  count = models.IntegerField(editable=False,default=0)
+  max = models.DecimalField(decimal_places=2,max_digits=20,editable=False,default=Decimal('0.00'))
+
+  @staticmethod
+  def counted(event, transactionstate, testdonation):
+    return transactionstate == 'COMPLETED' and testdonation == event.usepaypalsandbox
+
+  @staticmethod
+  @receiver(signals.post_save, sender=Donation)
+  def donation_update(sender, instance, raw, **kwargs):
+    if raw: return
+    saved = getattr(instance, '_saved_values', None)
+    old = new = None
+    if saved and EventTotal.counted(instance.event if saved['event_id'] == instance.event_id else Event.objects.get(pk=saved['event_id']), saved['transactionstate'], saved['testdonation']):
+      old = (saved['event_id'], saved['amount'])
+    if EventTotal.counted(instance.event, instance.transactionstate, instance.testdonation):
+      new = (instance.event_id, Decimal(str(instance.amount)))
+    if old != new:
+      if old:
+        EventTotal.apply(old[0], -old[1], -1)
+      if new:
+        EventTotal.apply(new[0], new[1], 1)
+
+  @staticmethod
+  @receiver(signals.post_delete, sender=Donation)
+  def donation_delete(sender, instance, **kwargs):
+    saved = getattr(instance, '_saved_values', None)
+    # the ledger counted the donation under its saved values, even if the instance was changed since
+    if saved and EventTotal.counted(instance.event if saved['event_id'] == instance.event_id else Event.objects.get(pk=saved['event_id']), saved['transactionstate'], saved['testdonation']):
+      EventTotal.apply(saved['event_id'], -saved['amount'], -1)
+
+  @staticmethod
+  def apply(event_id, amount, count):
+    updated = EventTotal.objects.filter(event_id=event_id).update(total=F('total') + amount, count=F('count') + count, max=Greatest(F('max'), amount))
+    if not updated:
+      # first donation for this event (or the ledger was never built), so start it from scratch
+      EventTotal.reconcile(Event.objects.filter(pk=event_id))
+    elif amount < 0:
+      # the maximum cannot be reversed as a delta, so recompute it if we removed the largest donation
+      EventTotal.objects.filter(event_id=event_id, max__lte=-amount).update(
+        max=Coalesce(Subquery(EventTotal.counted_donations().filter(event_id=event_id).order_by('-amount').values('amount')[:1]), Decimal('0.00')))
+    publish(event_id, 'total', lambda: EventTotal.stream_data(event_id))
+
+  @staticmethod
+  def stream_data(event_id):
+    ledger = EventTotal.objects.filter(event_id=event_id).first()
+    return {'total': float(ledger.total if ledger else Decimal('0.00')), 'count': ledger.count if ledger else 0}
+
+  @staticmethod
+  def counted_donations():
+    return Donation.objects.filter(transactionstate='COMPLETED', testdonation=F('event__usepaypalsandbox'))
+
+  @staticmethod
+  def reconcile(events=None, commit=True):
+    """
+    Recomputes the ledger for the given events (all events by default) with one grouped aggregate.
+    Returns a list of (event id, stored (total, count, max), actual (total, count, max)) for every
+    event whose ledger had drifted. If commit is set, the drifted ledgers are corrected.
+    """
+    if events is None:
+      events = Event.objects.all()
+    eventIds = list(events.values_list('id', flat=True))
+    aggregates = EventTotal.counted_donations().filter(event__in=eventIds).order_by().values('event').annotate(total=Sum('amount'), count=Count('id'), max=Max('amount'))
+    actual = dict((a['event'], (a['total'], a['count'], a['max'])) for a in aggregates)
+    stored = dict((t.event_id, t) for t in EventTotal.objects.filter(event__in=eventIds))
+    drifted = []
+    for eventId in eventIds:
+      values = actual.get(eventId, (Decimal('0.00'), 0, Decimal('0.00')))
+      ledger = stored.get(eventId)
+      current = (ledger.total, ledger.count, ledger.max) if ledger else None
+      if current != values and (ledger or values[1]):
+        drifted.append((eventId, current, values))
+        if commit:
+          EventTotal.objects.update_or_create(event_id=eventId, defaults=dict(total=values[0], count=values[1], max=values[2]))
+    return drifted
+
+  @staticmethod
+  def event_aggregate(event_id=None):
+    """
+    Returns the same amount/count/max/avg dictionary that aggregating over the counted donations
+    would, for a single event or for all events if event_id is None
+    """
+    ledgers = EventTotal.objects.all()
+    if event_id:
+      ledgers = ledgers.filter(event_id=event_id)
+    agg = ledgers.aggregate(amount=Sum('total'), count=Sum('count'), max=Max('max'))
+    agg['count'] = agg['count'] or 0
+    agg['avg'] = agg['amount'] / agg['count'] if agg['count'] else None
+    return agg
+
+  @property
+  def avg(self):
+    return (self.total / self.count).quantize(Decimal('0.01')) if self.count else Decimal('0.00')
+
+  def __str__(self):
+    return str(self.event)
+
+  class Meta:
+    app_label = 'tracker'
+    verbose_name = 'Event Total'
+
+# registered last, so that every other receiver still sees the values from before this save
+@receiver(signals.post_save, sender=Donation)
+def DonationTrackReset(sender, instance, raw, **kwargs):
+  instance.track_saved_values()
@@ -1,14 +1,22 @@
 import datetime
 import decimal
 import re
+import threading
+import time
+import uuid
 
 import post_office.models
 import pytz
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import validators
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.utils import OperationalError
+from django.db import connection, models, transaction
+from django.db.models import Case, When, Value, signals
+from django.db.utils import OperationalError, ProgrammingError
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.html import format_html
 from timezone_field import TimeZoneField
 
@@ -17,7 +25,9 @@ from ..validators import *
 
 __all__ = [
     'Event',
+    'EventRegistry',
     'PostbackURL',
+    'PostbackDelivery',
     'SpeedRun',
     'Runner',
     'Submission',
@@ -195,6 +205,9 @@ class Event(models.Model):
     tiltify_enable_sync = models.BooleanField(default=False, verbose_name='Enable Tiltify Sync',
                                               help_text='Sync donations for this event via the Tiltify API')
     tiltify_api_key = models.CharField(max_length=100, verbose_name='Tiltify Campaign API Key', blank=True, default='')
+    tiltify_last_donation = models.BigIntegerField(verbose_name='Last Tiltify Donation', blank=True, null=True,
+                                                   editable=False,
+                                                   help_text='ID of the newest donation synced, later syncs stop there')
 
     # Fields for Twitch chat announcements
     twitch_channel = models.CharField(max_length=100, verbose_name='Channel Name', blank=True, default='',
@@ -270,23 +283,134 @@ class Event(models.Model):
 
 
 def LatestEvent():
-    if Event.objects.exists():
-        try:
-            return Event.objects.latest()
-        except (Event.DoesNotExist, OperationalError):
+    try:
+        return EventRegistry.latest()
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+class EventRegistry(object):
+    """
+    A process-local copy of the event table, which changes rarely but is read by nearly every page, for
+    the event lookups, the event list and the latest event. The copy is reloaded after
+    TRACKER_EVENT_REGISTRY_TTL seconds, or as soon as an event is saved or deleted anywhere, which
+    changes a version stamp kept in the default cache. Every lookup returns fresh instances.
+    """
+    VERSION_KEY = 'tracker.event_registry.version'
+    _lock = threading.Lock()
+    # (version, expiry, field names, rows in Event ordering)
+    _state = None
+
+    @staticmethod
+    def _rows():
+        version = cache.get(EventRegistry.VERSION_KEY)
+        state = EventRegistry._state
+        if state and state[0] == version and state[1] > time.monotonic():
+            return state[2], state[3]
+        names = [f.attname for f in Event._meta.concrete_fields]
+        rows = list(Event.objects.values_list(*names))
+        state = (version, time.monotonic() + getattr(settings, 'TRACKER_EVENT_REGISTRY_TTL', 60), names, rows)
+
+        def store():
+            with EventRegistry._lock:
+                EventRegistry._state = state
+        # what a transaction reads is only shared once it commits, and never if it rolls back
+        transaction.on_commit(store)
+        return names, rows
+
+    @staticmethod
+    def events():
+        """Every event, in the default ordering."""
+        names, rows = EventRegistry._rows()
+        return [Event.from_db(connection.alias, names, row) for row in rows]
+
+    @staticmethod
+    def get(key):
+        """Looks up an event by id (as an int or a string of digits) or by short name."""
+        names, rows = EventRegistry._rows()
+        # only ASCII digits, as str.isdigit() also takes the likes of '²', which int() rejects
+        if isinstance(key, int) or (isinstance(key, str) and re.match(r'[0-9]+\Z', key)):
+            index, key = names.index('id'), int(key)
+        else:
+            index = names.index('short')
+        for row in rows:
+            if row[index] == key:
+                return Event.from_db(connection.alias, names, row)
+        raise Event.DoesNotExist('Event matching %r does not exist.' % (key,))
+
+    @staticmethod
+    def latest():
+        """The event with the latest start, or None."""
+        names, rows = EventRegistry._rows()
+        if not rows:
             return None
-    return None
+        index = names.index('datetime')
+        return Event.from_db(connection.alias, names, max(reversed(rows), key=lambda row: row[index]))
+
+    @staticmethod
+    def invalidate():
+        with EventRegistry._lock:
+            EventRegistry._state = None
+        cache.set(EventRegistry.VERSION_KEY, uuid.uuid4().hex, None)
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Event)
+    @receiver(signals.post_delete, sender=Event)
+    def event_update(sender, instance, raw=False, **kwargs):
+        EventRegistry.invalidate()
+        # readers that loaded the table before this transaction committed get the change too
+        transaction.on_commit(EventRegistry.invalidate)
+
+    @staticmethod
+    @receiver(signals.post_migrate)
+    def table_update(sender, **kwargs):
+        # flush (which test cases use to clear the database between tests) skips the model signals
+        EventRegistry.invalidate()
 
 
 class PostbackURL(models.Model):
     event = models.ForeignKey('Event', on_delete=models.PROTECT, verbose_name='Event', null=False, blank=False,
                               related_name='postbacks')
     url = models.URLField(blank=False, null=False, verbose_name='URL')
+    consecutive_failures = models.IntegerField(default=0, editable=False, verbose_name='Consecutive Failures')
+    disabled_until = models.DateTimeField(null=True, blank=True, verbose_name='Disabled Until',
+                                          help_text='Deliveries to this URL are paused until then after repeated failures')
 
     class Meta:
         app_label = 'tracker'
 
 
+class PostbackDelivery(models.Model):
+    """
+    A postback waiting to be sent (or already sent) to one URL. Rows are queued by the IPN handler and
+    delivered by the deliver_postbacks command, so that slow receivers never hold up the IPN itself.
+    """
+    postback = models.ForeignKey('PostbackURL', on_delete=models.CASCADE, related_name='deliveries')
+    payload = models.TextField(editable=False)
+    state = models.CharField(max_length=16, default='PENDING', db_index=True,
+                             choices=(('PENDING', 'Pending'), ('DELIVERED', 'Delivered'), ('FAILED', 'Failed')))
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True, verbose_name='Next Attempt')
+    last_error = models.TextField(blank=True, verbose_name='Last Error')
+    created = models.DateTimeField(auto_now_add=True)
+    delivered = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'tracker'
+        verbose_name = 'Postback Delivery'
+        verbose_name_plural = 'Postback Deliveries'
+        ordering = ('next_attempt',)
+
+    @staticmethod
+    def enqueue(event, payload):
+        """Queues the (already encoded) payload for every postback URL of the event."""
+        return PostbackDelivery.objects.bulk_create(
+            PostbackDelivery(postback=postback, payload=payload) for postback in PostbackURL.objects.filter(event=event))
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.postback.url, self.state)
+
+
 class SpeedRunManager(models.Manager):
     def get_by_natural_key(self, name, event):
         return self.get(name=name, event=Event.objects.get_by_natural_key(*event))
@@ -354,18 +478,6 @@ class SpeedRun(models.Model):
             self.order = None
 
     def save(self, fix_time=True, fix_runners=True, *args, **kwargs):
-        i = TimestampField.time_string_to_int
-        can_fix_time = self.order is not None and (i(self.run_time) != 0 or i(self.setup_time) != 0)
-
-        # fix our own time
-        if fix_time and can_fix_time:
-            prev = SpeedRun.objects.filter(event=self.event, order__lt=self.order).last()
-            if prev:
-                self.starttime = prev.starttime + datetime.timedelta(milliseconds=i(prev.run_time) + i(prev.setup_time))
-            else:
-                self.starttime = self.event.datetime
-            self.endtime = self.starttime + datetime.timedelta(milliseconds=i(self.run_time) + i(self.setup_time))
-
         if fix_runners and self.id:
             if not self.runners.exists():
                 try:
@@ -378,28 +490,56 @@ class SpeedRun(models.Model):
 
         super(SpeedRun, self).save(*args, **kwargs)
 
-        # fix up all the others if requested
+        # fix up our own time and the ones after it if requested
         if fix_time:
-            if can_fix_time:
-                next = SpeedRun.objects.filter(event=self.event, order__gt=self.order).first()
-                starttime = self.starttime + datetime.timedelta(milliseconds=i(self.run_time) + i(self.setup_time))
-                if next and next.starttime != starttime:
-                    return [self] + next.save(*args, **kwargs)
-            elif self.starttime:
-                prev = SpeedRun.objects.filter(event=self.event, starttime__lte=self.starttime).exclude(
-                    order=None).last()
-                if prev:
-                    self.starttime = prev.starttime + datetime.timedelta(
-                        milliseconds=i(prev.run_time) + i(prev.setup_time))
-                else:
-                    self.starttime = self.event.timezone.localize(
-                        datetime.datetime.combine(self.event.date, datetime.time(12)))
-                next = SpeedRun.objects.filter(event=self.event, starttime__gte=self.starttime).exclude(
-                    order=None).first()
-                if next and next.starttime != self.starttime:
-                    return [self] + next.save(*args, **kwargs)
+            start = self.order
+            if start is None and self.starttime:
+                # a run taken out of the schedule leaves a hole before the next run that was after it
+                start = SpeedRun.objects.filter(event=self.event, starttime__gte=self.starttime).exclude(
+                    order=None).order_by('order').values_list('order', flat=True).first()
+            if start is None:
+                return [self]
+            changed = SpeedRun.recalculate_schedule(self.event, start)
+            for run in changed:
+                if run.pk == self.pk:
+                    self.starttime, self.endtime = run.starttime, run.endtime
+            return [self] + [run for run in changed if run.pk != self.pk]
         return [self]
 
+    @staticmethod
+    def recalculate_schedule(event, start_order=None):
+        """
+        Recomputes the start and end times of every ordered run of the event in one pass, starting from the
+        event start, and writes the ones that changed with a single update. Given start_order, only the runs
+        from that order on are recomputed, starting from the stored end time of the last scheduled run before
+        it, so that gaps earlier in the schedule are kept. Runs without a run or setup time keep their times
+        and take up no time in the schedule. Returns the runs that changed, in order.
+        """
+        i = TimestampField.time_string_to_int
+        changed = []
+        starttime = event.datetime
+        runs = SpeedRun.objects.filter(event=event).exclude(order=None)
+        if start_order is not None:
+            previous = runs.filter(order__lt=start_order).exclude(endtime=None).order_by('-order').first()
+            if previous:
+                starttime = previous.endtime
+            runs = runs.filter(order__gte=start_order)
+        for run in runs.order_by('order'):
+            duration = datetime.timedelta(milliseconds=i(run.run_time) + i(run.setup_time))
+            if duration:
+                endtime = starttime + duration
+                if run.starttime != starttime or run.endtime != endtime:
+                    run.starttime, run.endtime = starttime, endtime
+                    changed.append(run)
+                starttime = endtime
+        if changed:
+            cases = lambda field: Case(*[When(pk=run.pk, then=Value(getattr(run, field), output_field=models.DateTimeField()))
+                                         for run in changed], output_field=models.DateTimeField())
+            SpeedRun.objects.filter(pk__in=[run.pk for run in changed]).update(starttime=cases('starttime'), endtime=cases('endtime'))
+            from .dataversion import DataVersion
+            DataVersion.bump('runs', [event.id])
+        return changed
+
     def name_with_category(self):
         categoryString = ' ' + self.category if self.category else ''
         return '{0}{1}'.format(self.name, categoryString)
@@ -1,5 +1,10 @@
+import collections
 import datetime
+import hashlib
+import json
+import operator
 from decimal import Decimal
+from functools import reduce
 
 import pytz
 from django.conf import settings
@@ -7,24 +12,53 @@ from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.db import models
-from django.db.models import Sum, Q
+from django.db.models import signals, Sum, Max, Q
+from django.dispatch import receiver
 
 import tracker.util as util
 from .event import LatestEvent, TimestampField
 from ..irc import TwitchAnnouncer
-from ..models import Event, Donation, SpeedRun
+from ..models import Event, Donation, Donor, SpeedRun
 from ..validators import *
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 __all__ = [
   'Prize',
   'PrizeTicket',
   'PrizeWinner',
   'PrizeCategory',
   'DonorPrizeEntry',
+  'PrizeEligibility',
 ]
 
 USER_MODEL_NAME = getattr(settings, 'AUTH_USER_MODEL', User)
 
+def draw_weights(amounts, minimumbid, maximumbid):
+  """
+  The drawing weight of each amount, in units of the minimum bid and capped at the maximum bid, with 0 for
+  amounts below the minimum. Uses numpy for large lists when it is available.
+  """
+  if numpy is not None and len(amounts) >= 1000:
+    # amounts have two decimal places, so dividing whole cents gives the same correctly rounded
+    # quotients as the Decimal arithmetic below
+    cents = lambda v: numpy.rint(numpy.array(v, dtype=float) * 100)
+    a = cents(amounts)
+    mn = cents(minimumbid)
+    weights = numpy.minimum(a, cents(maximumbid)) if maximumbid != None else a.copy()
+    weights /= mn
+    weights[a < mn] = 0.0
+    return weights.tolist()
+  def weight(a):
+    if a < minimumbid: return 0.0
+    if maximumbid != None and a > maximumbid: return float(maximumbid/minimumbid)
+    return float(a/minimumbid)
+  return [weight(a) for a in amounts]
+
+
 class PrizeManager(models.Manager):
   def get_by_natural_key(self, name, event):
     return self.get(name=name,event=Event.objects.get_by_natural_key(*event))
@@ -107,9 +141,12 @@ class Prize(models.Model):
     if self.image and self.imagefile:
       raise ValidationError('Cannot have both an Image URL and an Image File')
 
-  def eligible_donors(self):
-    donationSet = Donation.objects.filter(event=self.event, transactionstate='COMPLETED',
-                                          donor__isnull=False).select_related('donor')
+  def eligible_amounts(self):
+    """
+    Returns parallel lists of the ids of the donors eligible for this prize and the amount each one qualifies
+    with, computed with one grouped query over the donations (plus one for the direct entries)
+    """
+    donationSet = Donation.objects.filter(event=self.event, transactionstate='COMPLETED', donor__isnull=False)
     # remove all donations from donors who have won a prize under the same category for this event
     if self.category != None:
       donationSet = donationSet.exclude(Q(donor__prizewinner__prize__category=self.category, donor__prizewinner__prize__event=self.event))
@@ -117,56 +154,54 @@ class Prize(models.Model):
     # Apply the country/regiop filter to the drawing
     if self.custom_country_filter:
       countryFilter = self.allowed_prize_countries.all()
-      regionBlacklist = self.disallowed_prize_regions.all()
+      regionBlacklist = list(self.disallowed_prize_regions.all())
     else:
       countryFilter = self.event.allowed_prize_countries.all()
-      regionBlacklist = self.event.disallowed_prize_regions.all()
+      regionBlacklist = list(self.event.disallowed_prize_regions.all())
 
     if countryFilter.exists():
       # Allow null countries in the draw because we don't know if they should be excluded or not.
       # Prize acceptance form will make sure they enter a valid country.
       donationSet = donationSet.filter(Q(donor__addresscountry__in=countryFilter) |
                                        Q(donor__addresscountry__isnull=True))
-    if regionBlacklist.exists():
-      for region in regionBlacklist:
-        donationSet = donationSet.exclude(donor__addresscountry=region.country, donor__addressstate__iexact=region.name)
+    if regionBlacklist:
+      donationSet = donationSet.exclude(reduce(operator.or_, [Q(donor__addresscountry=region.country_id, donor__addressstate__iexact=region.name) for region in regionBlacklist]))
 
-    fullDonors = PrizeWinner.objects.filter(prize=self,sumcount=self.maxmultiwin)
-    donationSet = donationSet.exclude(donor__in=[x.winner for x in fullDonors])
+    fullDonors = PrizeWinner.objects.filter(prize=self,sumcount=self.maxmultiwin).values('winner')
+    donationSet = donationSet.exclude(donor__in=fullDonors)
+    amountField = 'amount'
     if self.ticketdraw and not self.auto_tickets:
+      # a donation has at most one ticket per prize, so this join does not duplicate donations
       donationSet = donationSet.filter(tickets__prize=self)
-    elif self.has_draw_time():
-      donationSet = donationSet.filter(timereceived__gte=self.start_draw_time(),timereceived__lte=self.end_draw_time())
-    donors = {}
-    for donation in donationSet:
-      if self.sumdonations:
-        donors.setdefault(donation.donor, Decimal('0.0'))
-        if self.ticketdraw:
-          donors[donation.donor] += donation.prize_ticket_amount(self)
-        else:
-          donors[donation.donor] += donation.amount
-      else:
-        if self.ticketdraw:
-          donors[donation.donor] = max(donation.prize_ticket_amount(self),donors.get(donation.donor,Decimal('0.0')))
-        else:
-          donors[donation.donor] = max(donation.amount,donors.get(donation.donor,Decimal('0.0')))
-    directEntries = DonorPrizeEntry.objects.filter(prize=self).exclude(Q(donor__in=[x.winner for x in fullDonors]))
-    for entry in directEntries:
-      donors.setdefault(entry.donor, Decimal('0.0'))
-      donors[entry.donor] = max(entry.weight*self.minimumbid, donors[entry.donor])
+      amountField = 'tickets__amount'
+    else:
+      start, end = self.start_draw_time(), self.end_draw_time()
+      if start and end:
+        donationSet = donationSet.filter(timereceived__gte=start,timereceived__lte=end)
+    # donors are listed in the order their latest donation would have been seen, which only matters for ties
+    donationSet = donationSet.order_by().values('donor').annotate(
+      value=Sum(amountField) if self.sumdonations else Max(amountField), latest=Max('timereceived')).order_by('-latest')
+    donors = collections.OrderedDict((d['donor'], d['value']) for d in donationSet)
+    directEntries = DonorPrizeEntry.objects.filter(prize=self).exclude(donor__in=fullDonors).order_by().values_list('donor', 'weight')
+    for donor, weight in directEntries:
+      donors[donor] = max(weight*self.minimumbid, donors.get(donor, Decimal('0.0')))
       if self.maximumbid:
-        donors[entry.donor] = min(donors[entry.donor], self.maximumbid)
-    if not donors:
+        donors[donor] = min(donors[donor], self.maximumbid)
+    return list(donors.keys()), list(donors.values())
+
+  def eligible_donors(self):
+    donorIds, amounts = self.eligible_amounts()
+    if not donorIds:
       return []
     elif self.randomdraw:
-      def weight(mn,mx,a):
-        if a < mn: return 0.0
-        if mx != None and a > mx: return float(mx/mn)
-        return float(a/mn)
-      return sorted([d for d in [{'donor':d[0].id,'amount':d[1],'weight':weight(self.minimumbid,self.maximumbid,d[1])} for d in list(donors.items())] if d['weight'] >= 1.0],key=lambda d: d['donor'])
+      weights = draw_weights(amounts, self.minimumbid, self.maximumbid)
+      return sorted([{'donor':d,'amount':a,'weight':w} for d,a,w in zip(donorIds, amounts, weights) if w >= 1.0],key=lambda d: d['donor'])
     else:
-      m = max(list(donors.items()), key=lambda d: d[1])
-      return [{'donor':m[0].id,'amount':m[1],'weight':1.0}]
+      m = max(range(len(amounts)), key=lambda i: amounts[i])
+      return [{'donor':donorIds[m],'amount':amounts[m],'weight':1.0}]
+
+  def eligibility_snapshot(self):
+    return PrizeEligibility.for_prize(self)
 
   def is_donor_allowed_to_receive(self, donor):
     return self.is_country_region_allowed(donor.addresscountry, donor.addressstate)
@@ -439,3 +474,105 @@ class DonorPrizeEntry(models.Model):
   def __str__(self):
     return str(self.donor) + ' entered to win ' + str(self.prize)
 
+
+
+class PrizeEligibility(models.Model):
+  """
+  A stored copy of Prize.eligible_donors(), keyed by a digest of its contents, so that the drawing key
+  handshake and the drawing itself work from the same list in every process. Rows are deleted whenever
+  anything that feeds into the eligibility of their prize changes, and recomputed on next use.
+  """
+  prize = models.OneToOneField('Prize', primary_key=True, on_delete=models.CASCADE, related_name='eligibility')
+  digest = models.CharField(max_length=64, editable=False)
+  donors = models.TextField(editable=False)  # json list of {donor, amount, weight}
+  timestamp = models.DateTimeField(auto_now=True)
+
+  class Meta:
+    app_label = 'tracker'
+    verbose_name = 'Prize Eligibility'
+    verbose_name_plural = 'Prize Eligibilities'
+
+  @staticmethod
+  def for_prize(prize):
+    snapshot = PrizeEligibility.objects.filter(prize=prize).first()
+    if snapshot is None:
+      donors = json.dumps([{'donor': d['donor'], 'amount': str(d['amount']), 'weight': float(d['weight'])}
+                           for d in prize.eligible_donors()], sort_keys=True, separators=(',', ':'))
+      snapshot, created = PrizeEligibility.objects.update_or_create(
+        prize=prize, defaults=dict(digest=hashlib.sha256(donors.encode('utf-8')).hexdigest(), donors=donors))
+    return snapshot
+
+  def eligible_donors(self):
+    return json.loads(self.donors)
+
+  @staticmethod
+  def invalidate(prizes=None, events=None):
+    q = Q()
+    if prizes is not None:
+      q |= Q(prize__in=prizes)
+    if events is not None:
+      q |= Q(prize__event__in=events)
+    if q:
+      PrizeEligibility.objects.filter(q).delete()
+
+  @staticmethod
+  @receiver(signals.pre_save, sender=Donation)
+  def donation_moved(sender, instance, raw=False, **kwargs):
+    saved = getattr(instance, '_saved_values', None)
+    if not raw and saved and saved['event_id'] != instance.event_id:
+      PrizeEligibility.invalidate(events=[saved['event_id']])
+
+  @staticmethod
+  @receiver(signals.post_save, sender=Donation)
+  @receiver(signals.post_delete, sender=Donation)
+  @receiver(signals.post_save, sender=SpeedRun)
+  @receiver(signals.post_delete, sender=SpeedRun)
+  def event_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    PrizeEligibility.invalidate(events=[instance.event_id])
+
+  @staticmethod
+  @receiver(signals.post_save, sender=PrizeTicket)
+  @receiver(signals.post_delete, sender=PrizeTicket)
+  @receiver(signals.post_save, sender=DonorPrizeEntry)
+  @receiver(signals.post_delete, sender=DonorPrizeEntry)
+  def entry_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    PrizeEligibility.invalidate(prizes=[instance.prize_id])
+
+  @staticmethod
+  @receiver(signals.post_save, sender=Prize)
+  def prize_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    PrizeEligibility.invalidate(prizes=[instance.pk])
+
+  @staticmethod
+  @receiver(signals.post_save, sender=PrizeWinner)
+  @receiver(signals.post_delete, sender=PrizeWinner)
+  def winner_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    # a win also excludes the donor from the other prizes in the same category
+    PrizeEligibility.invalidate(events=Prize.objects.filter(pk=instance.prize_id).values('event'))
+
+  @staticmethod
+  @receiver(signals.post_save, sender=Donor)
+  def donor_update(sender, instance, raw=False, **kwargs):
+    if raw: return
+    # the address of a donor decides which country and region filters they pass
+    PrizeEligibility.invalidate(
+      prizes=DonorPrizeEntry.objects.filter(donor=instance.pk).values('prize'),
+      events=Donation.objects.filter(donor=instance.pk).values('event'))
+
+  @staticmethod
+  @receiver(signals.m2m_changed, sender=Prize.allowed_prize_countries.through)
+  @receiver(signals.m2m_changed, sender=Prize.disallowed_prize_regions.through)
+  @receiver(signals.m2m_changed, sender=Event.allowed_prize_countries.through)
+  @receiver(signals.m2m_changed, sender=Event.disallowed_prize_regions.through)
+  def filter_update(sender, instance, action, reverse, **kwargs):
+    if not action.startswith('post_'): return
+    if reverse:
+      PrizeEligibility.objects.all().delete()
+    elif isinstance(instance, Prize):
+      PrizeEligibility.invalidate(prizes=[instance.pk])
+    else:
+      PrizeEligibility.invalidate(events=[instance.pk])
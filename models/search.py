@@ -0,0 +1,284 @@
+import unicodedata
+
+from django.conf import settings
+from django.db import connections, models
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.db.models import signals
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+
+from .bid import Bid
+from .donation import Donation, Donor
+from .event import Event, SpeedRun
+from .prize import Prize
+
+__all__ = [
+    'SearchDocument',
+]
+
+# the column of the text that each permission lets a user search, beyond the public column
+TIERS = (
+    ('tracker.view_emails', 'emails'),
+    ('tracker.view_usernames', 'usernames'),
+    ('tracker.view_comments', 'comments'),
+)
+
+# how many objects a document rebuild reads and writes at a time
+BATCH_SIZE = 500
+
+FTS_TABLE = 'tracker_searchdocument_fts'
+
+
+def normalize(text):
+    return ' '.join(unicodedata.normalize('NFKC', str(text)).casefold().split())
+
+
+class SearchDocument(models.Model):
+    """
+    The text the general (q=) search of an object looks through, gathered from the same fields
+    filters.model_general_filter searches, normalized, and split into columns by the permission it takes
+    to search it, so that the privacy rules of filters.permission_check still hold. A value that is only
+    public under a condition, like the name of a donor who chose to show it, goes in the public column
+    while the condition holds.
+
+    Kept up to date by signals (and by the bulk writers that skip them), and searched in place of the
+    fields themselves when TRACKER_SEARCH_DOCUMENTS is set, which should happen once the
+    rebuild_search_documents command has built the documents of the existing data. On Postgres the
+    columns have trigram indexes (which takes the pg_trgm extension), on SQLite they are mirrored in an
+    FTS5 trigram table when the SQLite build supports one.
+    """
+    # the filter models with documents
+    MODELS = {
+        'bid': Bid,
+        'donation': Donation,
+        'donor': Donor,
+        'prize': Prize,
+        'run': SpeedRun,
+    }
+    # filter models that search the same fields as one of the above
+    ALIASES = {
+        'allbids': 'bid',
+        'bidtarget': 'bid',
+    }
+    # (model, field, filter model, path) for fields of other models that the documents of the filter
+    # model include through path, checked against the filter plans in the tests
+    DEPENDENCIES = (
+        (Donor, 'email', 'donation', 'donor'),
+        (Event, 'short', 'bid', 'event'),
+        (SpeedRun, 'name', 'bid', 'speedrun'),
+    )
+
+    model = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    public = models.TextField(blank=True)
+    emails = models.TextField(blank=True)
+    usernames = models.TextField(blank=True)
+    comments = models.TextField(blank=True)
+
+    class Meta:
+        app_label = 'tracker'
+        unique_together = (('model', 'object_id'),)
+        verbose_name = 'Search Document'
+
+    def __str__(self):
+        return '{0} #{1}'.format(self.model, self.object_id)
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'TRACKER_SEARCH_DOCUMENTS', False)
+
+    @staticmethod
+    def kind(model):
+        """The filter model whose documents a general search of the given filter model uses, or None."""
+        model = SearchDocument.ALIASES.get(model, model)
+        return model if model in SearchDocument.MODELS else None
+
+    @staticmethod
+    def plan(kind):
+        """
+        (field, column, condition) for every field in the documents of a filter model. Values of the field go
+        in the column, or in the public column if the condition is set and holds for their object.
+        """
+        import tracker.filters as filters
+        perms = frozenset(perm for perm, column in TIERS)
+        public = dict(filters.general_filter_plan(kind, frozenset()))
+        unlocked = [(column, dict(filters.general_filter_plan(kind, frozenset([perm])))) for perm, column in TIERS]
+        plan = []
+        for lookup, check in filters.general_filter_plan(kind, perms):
+            field = lookup[:-len('__icontains')]
+            if lookup in public and public[lookup] is None:
+                plan.append((field, 'public', None))
+                continue
+            column = next((column for column, checks in unlocked if lookup in checks and checks[lookup] is None), None)
+            # fields it takes more than one permission to search are left out
+            if column is not None:
+                plan.append((field, column, public.get(lookup)))
+        return plan
+
+    @staticmethod
+    def texts(kind, queryset, fields=None):
+        """
+        (pk, column, normalized value) for the values of the fields (all of them by default) in the documents of
+        the objects of a queryset of a filter model.
+        """
+        plan = [entry for entry in SearchDocument.plan(kind) if fields is None or entry[0] in fields]
+        # every field, and whether its condition holds, as one row per object (or more, across to-many joins)
+        names = ['pk'] + [field for field, column, condition in plan]
+        conditions = {}
+        for i, (field, column, condition) in enumerate(plan):
+            if condition is not None:
+                conditions['search_public_%d' % i] = Case(When(condition, then=Value(True)), default=Value(False),
+                                                          output_field=BooleanField())
+        names += sorted(conditions)
+        for row in queryset.order_by().annotate(**conditions).values_list(*names):
+            row = dict(zip(names, row))
+            for i, (field, column, condition) in enumerate(plan):
+                if row[field] is None or row[field] == '':
+                    continue
+                if condition is not None and row['search_public_%d' % i]:
+                    column = 'public'
+                yield row['pk'], column, normalize(row[field])
+
+    @staticmethod
+    def build(kind, ids):
+        """(Re)builds the documents of the objects of a filter model with the given ids."""
+        ids = list(ids)
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = ids[start:start + BATCH_SIZE]
+            texts = {}
+            objects = SearchDocument.MODELS[kind].objects.filter(pk__in=batch)
+            for pk, column, value in SearchDocument.texts(kind, objects):
+                texts.setdefault(pk, {}).setdefault(column, set()).add(value)
+            SearchDocument.objects.filter(model=kind, object_id__in=batch).delete()
+            SearchDocument.objects.bulk_create(
+                SearchDocument(model=kind, object_id=pk, **dict((column, '\n'.join(sorted(values)))
+                                                               for column, values in columns.items()))
+                for pk, columns in texts.items())
+
+    @staticmethod
+    def columns(user):
+        """The columns of the documents the user may search."""
+        import tracker.filters as filters
+        perms = filters.permission_fingerprint(user)
+        return ['public'] + [column for perm, column in TIERS if perm in perms]
+
+    @staticmethod
+    def search(kind, text, user=None):
+        """
+        The ids of the objects of a filter model with the text in a column of their documents that the user
+        may search, as a subquery.
+        """
+        columns = SearchDocument.columns(user)
+        text = normalize(text)
+        documents = SearchDocument.objects.filter(model=SearchDocument.kind(kind))
+        # trigrams only match text of three characters or more
+        if len(text) >= 3 and _has_fts_table(documents.db):
+            match = '{%s} : "%s"' % (' '.join(columns), text.replace('"', '""'))
+            documents = documents.filter(
+                id__in=_RawSubquery('SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(FTS_TABLE), (match,)))
+        else:
+            query = Q()
+            for column in columns:
+                query |= Q(**{column + '__contains': text})
+            documents = documents.filter(query)
+        return documents.values('object_id')
+
+    @staticmethod
+    def refresh(model, ids):
+        """Rebuilds the documents of objects of a model class that were changed without signals."""
+        for kind, documentModel in SearchDocument.MODELS.items():
+            if documentModel is model:
+                SearchDocument.build(kind, ids)
+
+    @staticmethod
+    def watched(model):
+        """
+        {filter model: attnames} of the fields of a model class that its documents are built from (including the
+        fields their conditions check), and under None the fields the documents of other models take from it.
+        """
+        if model not in _watched:
+            watched = {}
+            for kind, documentModel in SearchDocument.MODELS.items():
+                if documentModel is model:
+                    lookups = []
+                    for field, column, condition in SearchDocument.plan(kind):
+                        lookups.append(field)
+                        if condition is not None:
+                            lookups += _condition_lookups(condition)
+                    watched[kind] = set(model._meta.get_field(lookup.split('__')[0]).attname for lookup in lookups)
+            for dependency, field, kind, path in SearchDocument.DEPENDENCIES:
+                if dependency is model:
+                    watched.setdefault(None, set()).add(field)
+            _watched[model] = watched
+        return _watched[model]
+
+    @staticmethod
+    @receiver(signals.pre_save, sender=Bid)
+    @receiver(signals.pre_save, sender=Donation)
+    @receiver(signals.pre_save, sender=Donor)
+    @receiver(signals.pre_save, sender=Event)
+    @receiver(signals.pre_save, sender=Prize)
+    @receiver(signals.pre_save, sender=SpeedRun)
+    def object_pre_save(sender, instance, raw=False, **kwargs):
+        instance._search_previous = None
+        if raw or not instance.pk:
+            return
+        fields = set().union(*SearchDocument.watched(sender).values())
+        instance._search_previous = sender.objects.filter(pk=instance.pk).values(*fields).first()
+
+    @staticmethod
+    @receiver(signals.post_save, sender=Bid)
+    @receiver(signals.post_save, sender=Donation)
+    @receiver(signals.post_save, sender=Donor)
+    @receiver(signals.post_save, sender=Event)
+    @receiver(signals.post_save, sender=Prize)
+    @receiver(signals.post_save, sender=SpeedRun)
+    def object_update(sender, instance, raw=False, **kwargs):
+        if raw: return
+        previous = getattr(instance, '_search_previous', None)
+        instance._search_previous = None
+        for kind, fields in SearchDocument.watched(sender).items():
+            if kind is not None and (previous is None or any(previous[f] != getattr(instance, f) for f in fields)):
+                SearchDocument.build(kind, [instance.pk])
+        if previous is None:
+            return
+        for model, field, kind, path in SearchDocument.DEPENDENCIES:
+            if model is sender and previous[field] != getattr(instance, field):
+                SearchDocument.build(kind, SearchDocument.MODELS[kind].objects.filter(**{path: instance.pk})
+                                     .values_list('pk', flat=True))
+
+    @staticmethod
+    @receiver(signals.post_delete, sender=Bid)
+    @receiver(signals.post_delete, sender=Donation)
+    @receiver(signals.post_delete, sender=Donor)
+    @receiver(signals.post_delete, sender=Prize)
+    @receiver(signals.post_delete, sender=SpeedRun)
+    def object_delete(sender, instance, **kwargs):
+        kinds = [kind for kind, model in SearchDocument.MODELS.items() if model is sender]
+        SearchDocument.objects.filter(model__in=kinds, object_id=instance.pk).delete()
+
+
+class _RawSubquery(RawSQL):
+    # lookups parenthesize their right hand side themselves, and SQLite reads IN ((SELECT ...)) as a single value
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+_watched = {}
+_fts_tables = {}
+
+
+def _condition_lookups(condition):
+    for child in condition.children:
+        if isinstance(child, Q):
+            yield from _condition_lookups(child)
+        else:
+            yield child[0]
+
+
+def _has_fts_table(alias):
+    # the migration only makes the table on SQLite builds with the FTS5 trigram tokenizer
+    if alias not in _fts_tables:
+        connection = connections[alias]
+        _fts_tables[alias] = connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+    return _fts_tables[alias]
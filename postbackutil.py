@@ -0,0 +1,80 @@
+import concurrent.futures
+import datetime
+import urllib.request
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tracker.models import PostbackDelivery, PostbackURL
+
+# retries back off exponentially from the base delay up to the maximum, and a delivery gives up after max_attempts
+BASE_DELAY = datetime.timedelta(seconds=15)
+MAX_DELAY = datetime.timedelta(hours=1)
+MAX_ATTEMPTS = 10
+# a URL is skipped for the cooldown once this many deliveries to it have failed in a row
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = datetime.timedelta(minutes=5)
+# how long a claimed batch is reserved for the worker that claimed it
+LEASE = datetime.timedelta(minutes=2)
+
+
+def retry_delay(attempts):
+    return min(BASE_DELAY * 2 ** (attempts - 1), MAX_DELAY)
+
+
+def claim_deliveries(limit):
+    """
+    Reserves up to limit due deliveries to URLs whose circuit is closed, by pushing their next attempt out
+    by the lease, so that concurrent workers never send the same delivery at the same time.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        deliveries = list(PostbackDelivery.objects.select_for_update(skip_locked=True, of=('self',))
+                          .filter(state='PENDING', next_attempt__lte=now)
+                          .exclude(postback__disabled_until__gt=now)
+                          .select_related('postback')[:limit])
+        PostbackDelivery.objects.filter(pk__in=[d.pk for d in deliveries]).update(next_attempt=now + LEASE)
+    return deliveries
+
+
+def send(delivery, timeout):
+    """Posts one delivery, returning None on success or a description of the error."""
+    request = urllib.request.Request(delivery.postback.url, delivery.payload.encode('utf-8'),
+                                     headers={'Content-Type': 'application/json; charset=utf-8'})
+    try:
+        with urllib.request.build_opener().open(request, timeout=timeout):
+            return None
+    except Exception as e:
+        return '{0}: {1}'.format(type(e).__name__, e)
+
+
+def record_result(delivery, error):
+    now = timezone.now()
+    if error is None:
+        PostbackDelivery.objects.filter(pk=delivery.pk).update(
+            state='DELIVERED', delivered=now, attempts=F('attempts') + 1, last_error='')
+        PostbackURL.objects.filter(pk=delivery.postback_id).update(consecutive_failures=0, disabled_until=None)
+        return
+    attempts = delivery.attempts + 1
+    PostbackDelivery.objects.filter(pk=delivery.pk).update(
+        state='FAILED' if attempts >= MAX_ATTEMPTS else 'PENDING', attempts=attempts,
+        next_attempt=now + retry_delay(attempts), last_error=error)
+    PostbackURL.objects.filter(pk=delivery.postback_id).update(consecutive_failures=F('consecutive_failures') + 1)
+    PostbackURL.objects.filter(pk=delivery.postback_id, consecutive_failures__gte=CIRCUIT_THRESHOLD).update(
+        disabled_until=now + CIRCUIT_COOLDOWN)
+
+
+def deliver_postbacks(limit=100, concurrency=8, timeout=5):
+    """
+    Sends one batch of due postbacks, concurrency at a time, and records the results. Failed deliveries
+    are retried with exponential backoff. Returns the (delivery, error) pairs that were attempted.
+    """
+    deliveries = claim_deliveries(limit)
+    if not deliveries:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(zip(deliveries, executor.map(lambda d: send(d, timeout), deliveries)))
+    for delivery, error in results:
+        record_result(delivery, error)
+    return results
@@ -1,3 +1,4 @@
+import collections
 import datetime
 import pytz
 import random
@@ -6,8 +7,9 @@ from . import util
 from .models import *
 from functools import reduce
 
-def draw_prize(prize, seed=None):
-    eligible = prize.eligible_donors()
+def draw_prize(prize, seed=None, eligible=None):
+    if eligible is None:
+        eligible = prize.eligible_donors()
     if prize.maxed_winners():
         if prize.maxwinners == 1:
             return False, {"error": "Prize: " + prize.name + " already has a winner."}
@@ -44,6 +46,136 @@ def draw_prize(prize, seed=None):
         return False, {"error": "Prize drawing algorithm failed."}
 
 
+class WeightedSampler(object):
+    """
+    Draws indices with probability proportional to their (integer) weights, with O(log n) draws and
+    removals, using a Fenwick tree over the weights. Integer weights keep the draws exact, so they are
+    reproducible for a given seed.
+    """
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.size = len(self.weights)
+        self.tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+        self.step = 1
+        while self.step * 2 <= self.size:
+            self.step *= 2
+
+    def draw(self, rand):
+        if self.total <= 0:
+            return None
+        target = rand.randrange(self.total)
+        pos = 0
+        step = self.step
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] <= target:
+                pos += step
+                target -= self.tree[pos]
+            step //= 2
+        return pos
+
+    def remove(self, index):
+        weight, self.weights[index] = self.weights[index], 0
+        self.total -= weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] -= weight
+            i += i & -i
+
+
+def _draw_order(prize, amounts, rand):
+    """
+    Yields indices into amounts in the order they win. After each one, send whether that donor may win again.
+    """
+    if prize.randomdraw:
+        # weights are the amounts capped at the maximum bid, in the smallest unit any of them uses
+        capped = [min(a, prize.maximumbid) if prize.maximumbid != None else a for a in amounts]
+        places = max([-a.as_tuple().exponent for a in capped] + [0])
+        sampler = WeightedSampler([int(a.scaleb(places)) if a >= prize.minimumbid else 0 for a in capped])
+        while True:
+            index = sampler.draw(rand)
+            if index is None:
+                return
+            if not (yield index):
+                sampler.remove(index)
+    else:
+        # largest amount first, ties going to whoever eligible_donors() would have picked
+        for index in sorted(range(len(amounts)), key=lambda i: amounts[i], reverse=True):
+            while (yield index):
+                pass
+
+
+def draw_prizes(prizes, seed=None, limit=None):
+    """
+    Draws all of the remaining winners (or at most limit more) for each of the given prizes, computing the
+    eligible donors once per prize. Winners are written in bulk after each prize, so category exclusions
+    carry over to the prizes drawn after it. Returns a list with a {'prize', 'winners', 'error'} dictionary
+    per prize, where winners lists a donor id per win.
+    """
+    try:
+        rand = random.Random(seed)
+    except TypeError:
+        return [{'prize': prize, 'winners': [], 'error': 'Seed parameter was unhashable'} for prize in prizes]
+    results = []
+    for prize in prizes:
+        result = {'prize': prize, 'winners': [], 'error': None}
+        results.append(result)
+        remaining = prize.maxwinners - prize.current_win_count()
+        if limit is not None:
+            remaining = min(remaining, limit)
+        if remaining <= 0:
+            if prize.maxwinners == 1:
+                result['error'] = "Prize: " + prize.name + " already has a winner."
+            else:
+                result['error'] = "Prize: " + prize.name + " already has the maximum number of winners allowed."
+            continue
+        donorIds, amounts = prize.eligible_amounts()
+        existing = dict((w.winner_id, w) for w in PrizeWinner.objects.filter(prize=prize))
+        wins = collections.Counter()
+        order = _draw_order(prize, amounts, rand)
+        try:
+            index = next(order)
+            while True:
+                donor = donorIds[index]
+                wins[donor] += 1
+                result['winners'].append(donor)
+                if len(result['winners']) == remaining:
+                    break
+                sumcount = wins[donor] + (existing[donor].sumcount if donor in existing else 0)
+                index = order.send(prize.category is None and sumcount < prize.maxmultiwin)
+        except StopIteration:
+            pass
+        if not result['winners']:
+            result['error'] = "Prize: " + prize.name + " has no eligible donors."
+            continue
+        try:
+            acceptDeadline = datetime.datetime.today().replace(tzinfo=util.anywhere_on_earth_tz(), hour=23,
+                                                               minute=59, second=59) + datetime.timedelta(days=prize.event.prize_accept_deadline_delta)
+            created = []
+            for donor, count in wins.items():
+                if donor in existing:
+                    winRecord = existing[donor]
+                    winRecord.pendingcount += count
+                    winRecord.save()
+                else:
+                    created.append(PrizeWinner(prize=prize, winner_id=donor, pendingcount=count, sumcount=count,
+                                               acceptdeadline=acceptDeadline))
+            PrizeWinner.objects.bulk_create(created)
+            # the bulk write skips the save signals, and a win changes who the rest of the category is open to
+            PrizeEligibility.invalidate(events=[prize.event_id])
+            DataVersion.bump('prizes', [prize.event_id])
+            if prize.announce_winners_to_chat:
+                for winRecord in PrizeWinner.objects.filter(prize=prize, winner__in=list(wins.keys())).select_related('winner'):
+                    winRecord.announce_to_chat()
+        except Exception as e:
+            result['error'] = "Error drawing prize: " + prize.name + ", " + str(e)
+    return results
+
 def get_past_due_prize_winners(event):
     now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
     return PrizeWinner.objects.filter(acceptdeadline__lte=now, pendingcount__gte=1)
@@ -0,0 +1,114 @@
+"""
+Publish/subscribe for live event updates (new donations, totals, bid totals and state changes),
+so that stream viewers get pushed changes instead of polling the database.
+
+Every event has its own channel, and messages are already encoded server-sent event frames, so a
+message is encoded once no matter how many viewers receive it. The default broker only reaches
+subscribers in the same process; set TRACKER_PUBSUB_BROKER to the dotted path of a class with the
+same subscribe/publish interface to fan messages out between processes.
+"""
+
+import collections
+import json
+import queue
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+_DEFAULT_BROKER = 'tracker.pubsub.LocalBroker'
+
+
+class Subscription(object):
+    """
+    A bounded queue of the messages published to one channel since it was opened. A viewer that
+    falls too far behind loses its oldest messages rather than holding up the publisher.
+    """
+
+    def __init__(self, broker, channel, maxsize=1000):
+        self.broker = broker
+        self.channel = channel
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, message):
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """Returns the next message, or None if nothing was published within timeout seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = collections.defaultdict(set)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'TRACKER_PUBSUB_BROKER', _DEFAULT_BROKER))()
+    return _broker
+
+
+def event_channel(event_id):
+    return 'event.%d' % event_id
+
+
+def encode(kind, data):
+    return 'event: %s\ndata: %s\n\n' % (kind, json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False))
+
+
+def publish(event_id, kind, data):
+    """
+    Publishes a message to the channel of an event once the current transaction commits, so that
+    viewers never see changes that get rolled back. data may be a callable, which is evaluated at
+    commit time and may return None to publish nothing.
+    """
+    def send():
+        payload = data() if callable(data) else data
+        if payload is not None:
+            get_broker().publish(event_channel(event_id), encode(kind, payload))
+    transaction.on_commit(send)
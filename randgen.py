@@ -192,7 +192,8 @@ def chain_insert_bid(bid, children):
     chain_insert_bid(child[0], child[1])
 
 def generate_donation(rand, donor=None, domain=None, event=None, minAmount=Decimal('0.01'), maxAmount=Decimal('1000.00'), minTime=None, maxTime=None, donors=None):
-  donation = Donation()
+  # passing the event up front skips the LatestEvent default, which costs a query per donation
+  donation = Donation(event=event) if event else Donation()
   donation.amount = random_amount(rand, minAmount=minAmount, maxAmount=maxAmount)
   if event:
     donation.event = event
@@ -350,3 +351,84 @@ def build_random_event(rand, startTime=None, numDonors=0, numDonations=0, numRun
 
   return event
 
+
+_BULK_BATCH_SIZE = 5000
+
+def bulk_insert(model, objs):
+  """
+  bulk_create that also fills in the primary keys on backends that cannot return them from a bulk insert,
+  by reading back the newest rows, so it must not run concurrently with other inserts into the same table
+  """
+  created = model.objects.bulk_create(objs)
+  if created and created[0].pk is None:
+    ids = list(model.objects.order_by('-pk').values_list('pk', flat=True)[:len(created)])
+    for obj, pk in zip(created, reversed(ids)):
+      obj.pk = pk
+  return created
+
+def generate_donation_bids(rand, donation, fromSet):
+  """
+  Same split as assign_bids, but returns unsaved rows (one per bid) for bulk insertion
+  """
+  amounts = {}
+  amount = random_amount(rand, maxAmount=donation.amount)
+  while amount > Decimal('0.00') and len(fromSet) > 0:
+    if amount < Decimal('1.00') or rand.getrandbits(1) == 1:
+      useAmount = amount
+    else:
+      useAmount = random_amount(rand, minAmount=Decimal('1.00'), maxAmount=amount)
+    amount = amount - useAmount
+    bid = rand.choice(fromSet)
+    amounts[bid] = amounts.get(bid, Decimal('0.00')) + useAmount
+  return [DonationBid(donation=donation, bid=bid, amount=amount) for bid, amount in amounts.items()]
+
+def build_benchmark_event(rand, startTime=None, numDonors=0, numDonations=0, numRuns=0, numBids=0, numPrizes=0, progress=None):
+  """
+  Like build_random_event, but bulk inserts the donors, donations and donation bids so that events with
+  hundreds of thousands of rows can be built in minutes, and then rebuilds the bid totals, the event total
+  ledger and the donor caches that saving them one at a time would have maintained.
+  progress, if given, is called with a message after every batch.
+  """
+  from tracker.models.bid import rebuild_bid_totals
+  progress = progress or (lambda message: None)
+  if not PrizeCategory.objects.all().exists() and numPrizes > 0:
+    PrizeCategory.objects.create(name='Game')
+    PrizeCategory.objects.create(name='Grand')
+    PrizeCategory.objects.create(name='Grab Bag')
+
+  event = generate_event(rand, startTime=startTime)
+  if not startTime:
+    startTime = datetime.datetime.combine(event.date, datetime.time()).replace(tzinfo = pytz.utc)
+  event.save()
+
+  listOfRuns = generate_runs(rand, event=event, numRuns=numRuns, scheduled=True)
+  lastRunTime = listOfRuns[-1].endtime if listOfRuns else startTime + datetime.timedelta(days=7)
+  progress('Created {0} runs'.format(len(listOfRuns)))
+  topBidsList, bidTargetsList = generate_bids(rand, event=event, numBids=numBids, listOfRuns=listOfRuns)
+  progress('Created {0} bids'.format(len(topBidsList)))
+  generate_prizes(rand, event=event, numPrizes=numPrizes, listOfRuns=listOfRuns)
+  progress('Created {0} prizes'.format(numPrizes))
+
+  listOfDonors = []
+  for start in range(0, numDonors, _BULK_BATCH_SIZE):
+    listOfDonors.extend(bulk_insert(Donor, [generate_donor(rand) for i in range(start, min(numDonors, start + _BULK_BATCH_SIZE))]))
+    progress('Created {0} donors'.format(len(listOfDonors)))
+
+  for start in range(0, numDonations, _BULK_BATCH_SIZE):
+    donations = bulk_insert(Donation, [generate_donation(rand, event=event, minTime=startTime, maxTime=lastRunTime, donors=listOfDonors)
+                                       for i in range(start, min(numDonations, start + _BULK_BATCH_SIZE))])
+    if bidTargetsList:
+      DonationBid.objects.bulk_create([d for donation in donations for d in generate_donation_bids(rand, donation, bidTargetsList)])
+    progress('Created {0} donations'.format(start + len(donations)))
+
+  rebuild_bid_totals(Bid.objects.filter(pk__in=[bid.pk for bid in topBidsList]))
+  events = Event.objects.filter(pk=event.pk)
+  EventTotal.reconcile(events)
+  donorIds = list(Donation.objects.filter(event=event).exclude(donor=None).order_by().values_list('donor', flat=True).distinct())
+  for start in range(0, len(donorIds), 500):
+    DonorCache.recompute(set((d, event.id) for d in donorIds[start:start + 500]))
+  SearchDocument.build('donor', [donor.pk for donor in listOfDonors])
+  SearchDocument.build('donation', Donation.objects.filter(event=event).values_list('pk', flat=True))
+  progress('Rebuilt totals, donor caches and search documents')
+
+  return event
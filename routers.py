@@ -0,0 +1,168 @@
+"""
+Read replica routing for the read-only parts of the tracker.
+
+Views wrapped in read_replica read from one of the database aliases in TRACKER_READ_REPLICAS when they
+are handling a GET or HEAD request, and everything else reads and writes the default database. To turn
+it on, list the replicas in DATABASES and TRACKER_READ_REPLICAS, and add
+
+    DATABASE_ROUTERS = ['tracker.routers.ReplicaRouter']
+
+along with 'tracker.routers.ReplicaMiddleware' in MIDDLEWARE, after the authentication middleware.
+
+A request goes back to the default database for the rest of its reads as soon as it writes anything,
+and a staff user who wrote something keeps reading from it for TRACKER_PRIMARY_PIN_SECONDS, so that
+they see their own changes. Replicas further behind than TRACKER_REPLICA_MAX_LAG seconds (as far as
+the database can tell, which only Postgres can) are passed over until they catch up. Anything cached
+from what a replica returned (see cache_timeout) is kept no longer than that either, since the data
+versions it is cached under are bumped as soon as a write commits, before the replica has it.
+
+A replica that is another alias of the same database (with {'TEST': {'MIRROR': 'default'}} in its
+DATABASES entry, so that the tests see the same data) is enough to try it out locally.
+"""
+
+import contextlib
+import functools
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# seconds behind the primary, on the replica itself
+LAG_QUERIES = {
+    'postgresql': 'SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+                  'THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END',
+}
+# how long a measured lag is trusted for, in seconds
+LAG_CHECK_INTERVAL = 5
+
+PIN_COOKIE = 'tracker_primary'
+
+_local = threading.local()
+# alias -> (time checked, lag)
+_lags = {}
+
+
+def replicas():
+    return getattr(settings, 'TRACKER_READ_REPLICAS', ())
+
+
+def replica_lag(alias):
+    """How many seconds the replica is behind the primary, or infinity if it can't be reached."""
+    now = time.monotonic()
+    checked = _lags.get(alias)
+    if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+        return checked[1]
+    connection = connections[alias]
+    lag = 0
+    if connection.vendor in LAG_QUERIES:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(LAG_QUERIES[connection.vendor])
+                lag = float(cursor.fetchone()[0] or 0)
+        except DatabaseError:
+            lag = float('inf')
+    _lags[alias] = (now, lag)
+    return lag
+
+
+def choose_replica(request):
+    """The replica to serve a request from, or None to serve it from the default database."""
+    if request.method not in ('GET', 'HEAD') or PIN_COOKIE in request.COOKIES:
+        return None
+    candidates = [alias for alias in replicas() if replica_lag(alias) <= max_lag()]
+    return random.choice(candidates) if candidates else None
+
+
+def current():
+    """The replica the current thread reads from, if it hasn't written anything yet."""
+    if getattr(_local, 'wrote', False):
+        return None
+    return getattr(_local, 'replica', None)
+
+
+def max_lag():
+    return getattr(settings, 'TRACKER_REPLICA_MAX_LAG', 5)
+
+
+def cache_timeout(timeout, response=None):
+    """The timeout to cache something with, capped at the maximum lag if it was read from a replica, by
+    the current thread or for the given response."""
+    if current() is not None or getattr(response, 'replica', None) is not None:
+        return min(timeout, max_lag())
+    return timeout
+
+
+@contextlib.contextmanager
+def using_replica(alias):
+    previous = getattr(_local, 'replica', None), getattr(_local, 'wrote', False)
+    _local.replica, _local.wrote = alias, False
+    try:
+        yield
+    finally:
+        # writes made while reading from a replica still pin the rest of the request
+        _local.replica, _local.wrote = previous[0], previous[1] or _local.wrote
+
+
+def _stream(alias, content):
+    with using_replica(alias):
+        for chunk in content:
+            yield chunk
+
+
+def read_replica(view):
+    """Serves the reads of a view from a replica, where it can."""
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        alias = choose_replica(request)
+        if alias is None:
+            return view(request, *args, **kwargs)
+        with using_replica(alias):
+            response = view(request, *args, **kwargs)
+        response.replica = alias
+        # streamed responses do most of their reading after the view returns
+        if response.streaming:
+            response.streaming_content = _stream(alias, response.streaming_content)
+        return response
+    return wrapped
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        replica = current()
+        if replica is not None:
+            return replica
+        # objects read from a replica earlier in the request go back to the default database too
+        return DEFAULT_DB_ALIAS if getattr(_local, 'replica', None) else None
+
+    def db_for_write(self, model, **hints):
+        _local.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS}.union(replicas())
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaMiddleware(object):
+    """Keeps staff users who just wrote something on the default database for a while."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.wrote = False
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if _local.wrote and user is not None and user.is_staff:
+            response.set_cookie(PIN_COOKIE, '1', max_age=getattr(settings, 'TRACKER_PRIMARY_PIN_SECONDS', 10),
+                                httponly=True)
+        return response
@@ -7,8 +7,9 @@ import datetime
 import locale
 import urllib.request, urllib.parse, urllib.error
 
+import tracker.routers as routers
 import tracker.viewutil as viewutil
-from tracker.models import Donor
+from tracker.models import DataVersion, Donor
 
 register = template.Library()
 
@@ -196,6 +197,16 @@ def negate(value):
 def admin_url(obj):
   return viewutil.admin_url(obj)
 
+@register.simple_tag
+def data_version(event, *kinds):
+  """A key for {% cache %} fragments that changes along with the given kinds of the event's data."""
+  return DataVersion.key(('events',) + kinds, event.id if event else None)
+
+@register.simple_tag
+def fragment_timeout(timeout):
+  """The timeout for a {% cache %} fragment keyed on data_version, capped while reading from a replica."""
+  return routers.cache_timeout(int(timeout))
+
 @register.simple_tag
 def settings_value(name):
   return getattr(settings, name, None)
@@ -1,6 +1,8 @@
 import tracker.models as models
 
+from django.db import connection
 from django.test import TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.admin.models import LogEntry, ADDITION as LogEntryADDITION, CHANGE as LogEntryCHANGE, DELETION as LogEntryDELETION
@@ -27,11 +29,12 @@ class APITestCase(TransactionTestCase):
     model_name = None
 
     def parseJSON(self, response, status_code=200):
-        self.assertEqual(response.status_code, status_code, msg='Status code is not %d\n"""%s"""' % (status_code, response.content))
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertEqual(response.status_code, status_code, msg='Status code is not %d\n"""%s"""' % (status_code, content))
         try:
-            return json.loads(response.content)
+            return json.loads(content)
         except Exception as e:
-            raise AssertionError('Could not parse json: %s\n"""%s"""' % (e, response.content))
+            raise AssertionError('Could not parse json: %s\n"""%s"""' % (e, content))
 
     def assertModelPresent(self, expected_model, data):
         found_model = None
@@ -339,6 +342,96 @@ class TestSpeedRun(APITestCase):
         self.assertEqual(data[0], expected)
 
 
+class TestSearch(APITestCase):
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.donor = models.Donor.objects.create(firstname='John', lastname='Doe', alias='JDoe',
+                                                 email='johndoe@example.com', visibility='FIRST')
+        self.donation = models.Donation.objects.create(
+            event=self.event, donor=self.donor, amount=5, domainId='123456', transactionstate='COMPLETED',
+            commentstate='APPROVED', comment='Hello', timereceived=today_noon.replace(tzinfo=pytz.utc))
+        self.run = models.SpeedRun.objects.create(name='Test Run', run_time='0:45:00', setup_time='0:05:00', order=1)
+        self.run.runners.add(models.Runner.objects.create(name='trihex'), models.Runner.objects.create(name='PJ'))
+        self.bid = models.Bid.objects.create(name='Test Bid', speedrun=self.run, istarget=True, state='OPENED')
+
+    def test_donation_search(self):
+        request = self.factory.get('/api/v1/search', dict(type='donation'))
+        request.user = self.user
+        response = tracker.views.api.search(request)
+        self.assertTrue(response.streaming)
+        data = self.parseJSON(response)
+        self.assertEqual(len(data), 1)
+        fields = data[0]['fields']
+        self.assertEqual(fields['amount'], '5.00')
+        self.assertEqual(fields['timereceived'], format_time(self.donation.timereceived))
+        self.assertEqual(fields['comment'], 'Hello')
+        self.assertEqual(fields['donor__lastname'], 'D...')
+        self.assertEqual(fields['donor__public'], self.donor.visible_name())
+        self.assertNotIn('domainId', fields)
+        self.assertNotIn('donor__email', fields)
+
+    def test_bid_search(self):
+        request = self.factory.get('/api/v1/search', dict(type='bid'))
+        request.user = self.user
+        data = self.parseJSON(tracker.views.api.search(request))
+        self.assertEqual(len(data), 1)
+        fields = data[0]['fields']
+        self.assertEqual(fields['speedrun'], self.run.id)
+        self.assertEqual(fields['speedrun__name'], 'Test Run')
+        self.assertEqual(list(fields).index('speedrun__description'), list(fields).index('speedrun__public') - 3)
+
+    def test_run_search(self):
+        request = self.factory.get('/api/v1/search', dict(type='run'))
+        request.user = self.user
+        data = self.parseJSON(tracker.views.api.search(request))
+        self.assertEqual(data[0]['fields']['runners'], [r.id for r in self.run.runners.all()])
+
+    def test_empty_search(self):
+        request = self.factory.get('/api/v1/search', dict(type='donation', amount_gte=100))
+        request.user = self.user
+        self.assertEqual(self.parseJSON(tracker.views.api.search(request)), [])
+
+
+    def test_paged_donation_search(self):
+        donations = [self.donation]
+        for i in range(4):
+            donations.append(models.Donation.objects.create(
+                event=self.event, amount=i + 1, domainId='paged%d' % i, transactionstate='COMPLETED',
+                timereceived=self.donation.timereceived - datetime.timedelta(minutes=i % 2)))
+        expected = [d.id for d in sorted(donations, key=lambda d: (d.timereceived, d.id), reverse=True)]
+        seen = []
+        params = dict(type='donation', limit=2, withcount=1)
+        while True:
+            request = self.factory.get('/api/v1/search', params)
+            request.user = self.user
+            data = self.parseJSON(tracker.views.api.search(request))
+            self.assertEqual(data['count'], 5)
+            seen.extend(d['pk'] for d in data['results'])
+            if not data['next']:
+                break
+            params['after'] = data['next']
+        self.assertEqual(seen, expected)
+
+    def test_paged_search_without_count(self):
+        request = self.factory.get('/api/v1/search', dict(type='run', limit=10))
+        request.user = self.user
+        data = self.parseJSON(tracker.views.api.search(request))
+        self.assertNotIn('count', data)
+        self.assertEqual([d['pk'] for d in data['results']], [self.run.id])
+        self.assertIsNone(data['next'])
+        for withcount in ('0', 'false'):
+            request = self.factory.get('/api/v1/search', dict(type='run', limit=10, withcount=withcount))
+            request.user = self.user
+            with CaptureQueriesContext(connection) as queries:
+                data = self.parseJSON(tracker.views.api.search(request))
+            self.assertNotIn('count', data)
+            self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+
+    def test_malformed_cursor(self):
+        request = self.factory.get('/api/v1/search', dict(type='donation', after='yesterday'))
+        request.user = self.user
+        self.parseJSON(tracker.views.api.search(request), status_code=400)
+
 class TestPrize(APITestCase):
     model_name = 'prize'
 
@@ -370,6 +463,25 @@ class TestPrize(APITestCase):
         self.assertEqual('Foreign Key relation could not be found', data['error'])
 
 
+    def test_draw_prize_key(self):
+        donor = models.Donor.objects.create(email='donor@example.com')
+        models.Donation.objects.create(event=self.event, donor=donor, amount=10, domainId='1',
+                                       transactionstate='COMPLETED', timereceived=today_noon)
+        prize = models.Prize.objects.create(event=self.event, name='Drawn Prize', minimumbid=5, maximumbid=None)
+        request = self.factory.get('/api/v1/draw_prize', dict(id=prize.id))
+        request.user = self.add_user
+        key = self.parseJSON(tracker.views.api.draw_prize(request))['key']
+        self.assertEqual(key, prize.eligibility_snapshot().digest)
+        request = self.factory.post('/api/v1/draw_prize', dict(id=prize.id, key='stale'))
+        request.user = self.add_user
+        self.assertEqual('Key field did not match expected value',
+                         self.parseJSON(tracker.views.api.draw_prize(request), status_code=400)['error'])
+        request = self.factory.post('/api/v1/draw_prize', dict(id=prize.id, key=key))
+        request.user = self.add_user
+        data = self.parseJSON(tracker.views.api.draw_prize(request))
+        self.assertEqual(donor.id, data['success'][0]['winner'])
+
+
 class TestEvent(APITestCase):
     model_name = 'event'
 
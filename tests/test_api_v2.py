@@ -0,0 +1,153 @@
+import datetime
+import json
+
+from django.contrib.auth.models import Permission, User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import tracker.models as models
+from tracker.api.serializers import SpeedRunSerializer, related_paths
+
+
+class TestSpeedRunViewSet(TestCase):
+    def setUp(self):
+        start = timezone.now().replace(microsecond=0)
+        self.start = start
+        self.event = models.Event.objects.create(short='ev', name='Event', targetamount=5, datetime=start)
+        self.other = models.Event.objects.create(short='other', name='Other', targetamount=5,
+                                                 datetime=start + datetime.timedelta(days=1))
+        self.runners = [models.Runner.objects.create(name='Runner %d' % i) for i in range(2)]
+        self.runs = []
+        for i in range(4):
+            run = models.SpeedRun.objects.create(event=self.event, name='Run %d' % i, run_time='1:00:00', order=i + 1)
+            run.runners.add(*self.runners)
+            self.runs.append(run)
+        models.SpeedRun.objects.create(event=self.other, name='Other Run', run_time='1:00:00', order=1)
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_related_paths(self):
+        self.assertEqual((('event',), ('runners',)), related_paths(SpeedRunSerializer))
+
+    def test_queries(self):
+        # the runs with their events, then their runners, however many runs there are
+        with self.assertNumQueries(2):
+            data = self.get('/tracker/api/v2/runs/')
+        self.assertEqual(5, len(data['results']))
+        self.assertEqual(['Runner 0', 'Runner 1'], [r['name'] for r in data['results'][0]['runners']])
+
+    def test_paging(self):
+        data = self.get('/tracker/api/v2/runs/', limit=2)
+        names = [run['name'] for run in data['results']]
+        while data['next']:
+            data = json.loads(self.client.get(data['next']).content.decode('utf-8'))
+            names += [run['name'] for run in data['results']]
+        self.assertEqual(['Run 0', 'Run 1', 'Run 2', 'Run 3', 'Other Run'], names)
+
+    def test_filters(self):
+        data = self.get('/tracker/api/v2/runs/', event='other')
+        self.assertEqual(['Other Run'], [run['name'] for run in data['results']])
+        data = self.get('/tracker/api/v2/runs/', event=self.event.id,
+                        after=(self.start + datetime.timedelta(hours=1)).isoformat(),
+                        before=(self.start + datetime.timedelta(hours=3)).isoformat())
+        self.assertEqual(['Run 1', 'Run 2'], [run['name'] for run in data['results']])
+        data = self.get('/tracker/api/v2/runners/', event='other')
+        self.assertEqual([], data['results'])
+        self.assertEqual(400, self.client.get('/tracker/api/v2/runs/', {'after': 'yesterday'}).status_code)
+        self.assertEqual(404, self.client.get('/tracker/api/v2/runs/', {'event': 'missing'}).status_code)
+
+    def test_flatten(self):
+        data = self.get('/tracker/api/v2/runs/', event='ev', include='runners,event')['results']
+        self.assertEqual([self.event.id], [event['id'] for event in data['event']])
+        self.assertEqual([r.id for r in self.runners], [runner['id'] for runner in data['runners']])
+        self.assertEqual([[r.id for r in self.runners]] * 4, [run['runners'] for run in data['speedruns']])
+        self.assertEqual([[self.event.id]] * 4, [run['event'] for run in data['speedruns']])
+
+
+class TestTrackerViewSets(TestCase):
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', name='Event', targetamount=5,
+                                                 datetime=timezone.now())
+        self.other = models.Event.objects.create(short='other', name='Other', targetamount=5,
+                                                 datetime=timezone.now())
+        self.donor = models.Donor.objects.create(email='anon@example.com', alias='Hidden', firstname='First',
+                                                 lastname='Last', visibility='ANON')
+        self.named = models.Donor.objects.create(email='named@example.com', alias='Named', firstname='Some',
+                                                 lastname='Body', visibility='FIRST')
+        self.donations = [
+            models.Donation.objects.create(event=self.event, donor=self.donor, amount=5, domain='LOCAL',
+                                           domainId='5', transactionstate='COMPLETED', comment='secret',
+                                           commentstate='PENDING'),
+            models.Donation.objects.create(event=self.event, donor=self.named, amount=10, domain='LOCAL',
+                                           domainId='10', transactionstate='COMPLETED', comment='hello',
+                                           commentstate='APPROVED'),
+            models.Donation.objects.create(event=self.other, donor=self.named, amount=15, domain='LOCAL',
+                                           domainId='15', transactionstate='PENDING'),
+        ]
+        self.bid = models.Bid.objects.create(event=self.event, name='Choice', state='OPENED')
+        self.option = models.Bid.objects.create(event=self.event, parent=self.bid, name='Option', state='OPENED',
+                                                istarget=True)
+        self.hidden = models.Bid.objects.create(event=self.event, parent=self.bid, name='Hidden', state='HIDDEN',
+                                                istarget=True)
+        self.prize = models.Prize.objects.create(event=self.event, name='Prize', state='ACCEPTED')
+        models.Prize.objects.create(event=self.event, name='Pending Prize', state='PENDING')
+        self.staff = User.objects.create_user('staff', password='password')
+        self.staff.user_permissions.add(Permission.objects.get(codename='can_search'))
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content.decode('utf-8'))['results']
+
+    def test_donation_privacy(self):
+        data = self.get('/tracker/api/v2/donations/')
+        self.assertEqual([d.id for d in self.donations[:2]], [d['id'] for d in data])
+        self.assertEqual([None, 'hello'], [d['comment'] for d in data])
+        self.assertEqual([None, 'Some'], [d['donor']['firstname'] for d in data])
+        self.assertEqual(['(Anonymous)', 'B..., Some (Named)'], [d['donor']['public'] for d in data])
+        self.assertNotIn('email', data[0]['donor'])
+        self.assertNotIn('modcomment', data[0])
+        self.client.force_login(self.staff)
+        data = self.get('/tracker/api/v2/donations/')
+        self.assertEqual(3, len(data))
+        self.assertEqual(['secret', 'hello'], [d['comment'] for d in data[:2]])
+        self.assertEqual('anon@example.com', data[0]['donor']['email'])
+
+    def test_donors(self):
+        data = self.get('/tracker/api/v2/donors/', event='ev')
+        self.assertEqual({self.donor.id, self.named.id}, {d['id'] for d in data})
+        self.assertEqual([{self.named.id: 'B...', self.donor.id: None}[d['id']] for d in data],
+                         [d['lastname'] for d in data])
+        self.assertEqual([self.named.id], [d['id'] for d in self.get('/tracker/api/v2/donors/', event='other')])
+
+    def test_sparse_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get('/tracker/api/v2/donations/', fields='amount,comment')
+        self.assertEqual([{'type': 'donation', 'id': self.donations[0].id, 'amount': '5.00', 'comment': None},
+                          {'type': 'donation', 'id': self.donations[1].id, 'amount': '10.00', 'comment': 'hello'}],
+                         data)
+        sql = queries[-1]['sql']
+        self.assertIn('"amount"', sql)
+        self.assertNotIn('"modcomment"', sql)
+        self.assertNotIn('"requestedemail"', sql)
+
+    def test_bid_tree(self):
+        data = self.get('/tracker/api/v2/bids/')
+        self.assertEqual([self.bid.id, self.option.id], [b['id'] for b in data])
+        self.assertEqual([[self.option.id], []], [b['options'] for b in data])
+        self.assertEqual([None, self.bid.id], [b['parent'] for b in data])
+        self.assertEqual([0, 1], [b['level'] for b in data])
+        self.client.force_login(self.staff)
+        data = self.get('/tracker/api/v2/bids/', fields='options')
+        self.assertEqual({self.option.id, self.hidden.id}, set(data[0]['options']))
+
+    def test_prizes(self):
+        data = self.get('/tracker/api/v2/prizes/', event='ev')
+        self.assertEqual([self.prize.id], [p['id'] for p in data])
+        self.assertNotIn('state', data[0])
+        self.assertEqual([], self.get('/tracker/api/v2/prizes/', event='other'))
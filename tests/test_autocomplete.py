@@ -0,0 +1,70 @@
+from django.contrib.auth.models import Permission, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import tracker.autocomplete as autocomplete
+import tracker.lookups as lookups
+import tracker.models as models
+import tracker.viewutil as viewutil
+
+
+class TestAutocomplete(TestCase):
+    def setUp(self):
+        cache.clear()
+        autocomplete.indexes.reset()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.other = models.Event.objects.create(short='other', targetamount=5, datetime=timezone.now())
+        self.metroid = models.SpeedRun.objects.create(event=self.event, name='Super Metroid', run_time='0:10:00',
+                                                      order=1)
+        self.mario = models.SpeedRun.objects.create(event=self.event, name='Super Mario World',
+                                                    run_time='0:10:00', order=2)
+        models.SpeedRun.objects.create(event=self.other, name='Metroid Prime', run_time='0:10:00', order=1)
+        self.donor = models.Donor.objects.create(alias='Samus', visibility='ANON', email='samus@example.com')
+        self.user = User.objects.create_user('staff', password='password', is_staff=True)
+        self.user.user_permissions.add(*Permission.objects.filter(codename='can_edit_locked_events'))
+        self.user = User.objects.get(id=self.user.id)
+
+    def lookup(self, channel, term, event=None):
+        request = RequestFactory().get('/lookups', {'term': term})
+        SessionMiddleware().process_request(request)
+        request.user = self.user
+        if event:
+            viewutil.set_selected_event(request, event)
+        return list(channel().get_query(term, request))
+
+    def test_prefix(self):
+        self.assertEqual([self.mario, self.metroid], self.lookup(lookups.RunLookup, 'super m', self.event))
+        self.assertEqual([self.metroid], self.lookup(lookups.RunLookup, ' METR', self.event))
+        self.assertEqual(['Metroid Prime', 'Super Metroid'],
+                         sorted(run.name for run in self.lookup(lookups.RunLookup, 'metr')))
+
+    def test_cached(self):
+        self.lookup(lookups.RunLookup, 'metr', self.event)
+        # the index is reused, leaving the query for the matches themselves
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([self.metroid], self.lookup(lookups.RunLookup, 'super met', self.event))
+        self.assertEqual(1, len([query for query in queries if 'tracker_speedrun' in query['sql']]))
+
+    def test_invalidated(self):
+        self.assertEqual([self.metroid], self.lookup(lookups.RunLookup, 'metr', self.event))
+        self.metroid.name = 'Metroid Fusion'
+        self.metroid.save()
+        self.assertEqual(['Metroid Fusion'], [run.name for run in self.lookup(lookups.RunLookup, 'fus', self.event)])
+
+    def test_permissions(self):
+        self.assertEqual([], self.lookup(lookups.DonorLookup, 'samus'))
+        self.user.user_permissions.add(*Permission.objects.filter(codename='view_usernames'))
+        self.user = User.objects.get(id=self.user.id)
+        self.assertEqual([self.donor.id], [donor.id for donor in self.lookup(lookups.DonorLookup, 'samus')])
+        self.assertEqual([], self.lookup(lookups.DonorLookup, 'samus@'))
+        self.user.user_permissions.add(*Permission.objects.filter(codename='view_emails'))
+        self.user = User.objects.get(id=self.user.id)
+        self.assertEqual([self.donor.id], [donor.id for donor in self.lookup(lookups.DonorLookup, 'samus@')])
+
+    @override_settings(TRACKER_AUTOCOMPLETE_MAX_OBJECTS=1)
+    def test_large_scope(self):
+        self.assertEqual([self.metroid], self.lookup(lookups.RunLookup, 'metroid', self.event))
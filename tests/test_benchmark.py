@@ -0,0 +1,37 @@
+import random
+
+from django.test import TransactionTestCase
+
+import tracker.benchmark as benchmark
+import tracker.models as models
+import tracker.randgen as randgen
+from tracker.models.bid import rebuild_bid_totals
+
+
+class TestBenchmarkEvent(TransactionTestCase):
+    def setUp(self):
+        self.rand = random.Random(516273)
+        self.event = randgen.build_benchmark_event(self.rand, numDonors=40, numDonations=300, numRuns=10, numBids=10, numPrizes=5)
+
+    def test_derived_totals(self):
+        self.assertEqual(300, models.Donation.objects.filter(event=self.event).count())
+        self.assertTrue(models.DonationBid.objects.filter(donation__event=self.event).exists())
+        self.assertEqual([], rebuild_bid_totals(commit=False))
+        self.assertEqual([], models.EventTotal.reconcile(commit=False))
+        donations = models.Donation.objects.filter(event=self.event).exclude(donor=None)
+        self.assertEqual(donations.values('donor').distinct().count(),
+                         models.DonorCache.objects.filter(event=self.event).count())
+
+    def test_run_benchmarks(self):
+        report = benchmark.run_benchmarks(self.event, repeat=1, seed=1)
+        self.assertEqual(list(benchmark.BENCHMARKS.keys()), list(report['results'].keys()))
+        self.assertEqual(300, report['data']['donations'])
+        for name, result in report['results'].items():
+            # building filters doesn't run them
+            if name != 'build_filters':
+                self.assertGreater(result['queries'], 0)
+        # nothing the benchmarks wrote was kept
+        self.assertEqual(300, models.Donation.objects.filter(event=self.event).count())
+        self.assertFalse(models.PrizeWinner.objects.exists())
+        self.assertEqual([('bidindex', 1.0, 2.0, 2.0, 3, 4)], benchmark.compare(
+            {'results': {'bidindex': {'median': 1.0, 'queries': 3}}}, {'results': {'bidindex': {'median': 2.0, 'queries': 4}}}))
@@ -2,7 +2,8 @@ import datetime
 
 from django.core.urlresolvers import reverse
 
-from tracker import models
+from tracker import models, viewutil
+from tracker.models.bid import rebuild_bid_totals
 
 from django.test import TransactionTestCase, RequestFactory
 from django.contrib.auth.models import User, Permission
@@ -69,6 +70,84 @@ class TestBid(TransactionTestCase):
         self.assertEqual(self.pending_bid.total, self.donation.amount, msg='pending bid total is wrong')
         self.assertEqual(self.parent_bid.total, 0, msg='parent bid total is wrong')
 
+    def test_cancelled_donation(self):
+        models.DonationBid.objects.create(donation=self.donation, bid=self.opened_bid, amount=self.donation.amount)
+        self.donation.transactionstate = 'CANCELLED'
+        self.donation.save()
+        self.opened_bid.refresh_from_db()
+        self.parent_bid.refresh_from_db()
+        self.assertEqual(self.opened_bid.total, 0, msg='opened bid total is wrong')
+        self.assertEqual(self.opened_bid.count, 0, msg='opened bid count is wrong')
+        self.assertEqual(self.parent_bid.total, 0, msg='parent bid total is wrong')
+        self.donation.transactionstate = 'COMPLETED'
+        self.donation.save()
+        self.parent_bid.refresh_from_db()
+        self.assertEqual(self.parent_bid.total, self.donation.amount, msg='parent bid total is wrong')
+        self.assertEqual(self.parent_bid.count, 1, msg='parent bid count is wrong')
+
+    def test_changed_donation_bid(self):
+        donation_bid = models.DonationBid.objects.create(donation=self.donation, bid=self.opened_bid, amount=2)
+        donation_bid = models.DonationBid.objects.get(pk=donation_bid.pk)
+        donation_bid.bid = self.closed_bid
+        donation_bid.amount = 3
+        donation_bid.save()
+        self.opened_bid.refresh_from_db()
+        self.closed_bid.refresh_from_db()
+        self.parent_bid.refresh_from_db()
+        self.assertEqual(self.opened_bid.total, 0, msg='opened bid total is wrong')
+        self.assertEqual(self.closed_bid.total, 3, msg='closed bid total is wrong')
+        self.assertEqual(self.parent_bid.total, 3, msg='parent bid total is wrong')
+        donation_bid.delete()
+        self.parent_bid.refresh_from_db()
+        self.assertEqual(self.parent_bid.total, 0, msg='parent bid total is wrong')
+        self.assertEqual(self.parent_bid.count, 0, msg='parent bid count is wrong')
+
+    def test_rebuild_totals(self):
+        models.DonationBid.objects.create(donation=self.donation, bid=self.opened_bid, amount=self.donation.amount)
+        self.assertEqual(rebuild_bid_totals(), [])
+        models.Bid.objects.filter(pk__in=[self.opened_bid.pk, self.parent_bid.pk]).update(total=1, count=7)
+        drifted = rebuild_bid_totals(commit=False)
+        self.assertEqual(sorted(d[0] for d in drifted), sorted([self.opened_bid.pk, self.parent_bid.pk]))
+        rebuild_bid_totals()
+        self.parent_bid.refresh_from_db()
+        self.assertEqual(self.parent_bid.total, self.donation.amount, msg='parent bid total is wrong')
+        self.assertEqual(self.parent_bid.count, 1, msg='parent bid count is wrong')
+        self.assertEqual(rebuild_bid_totals(), [])
+
+
+class TestBidTree(TestBid):
+    def setUp(self):
+        super(TestBidTree, self).setUp()
+        self.run.event = self.event
+        self.run.save()
+        self.challenge = models.Bid.objects.create(name='Challenge', speedrun=self.run, istarget=True, goal=10)
+        self.choice = models.Bid.objects.create(
+            name='Choice', istarget=False, parent=self.parent_bid, state='OPENED')
+        self.nested_bid = models.Bid.objects.create(
+            name='Nested Test', istarget=True, parent=self.choice, state='OPENED')
+        self.hidden_choice = models.Bid.objects.create(
+            name='Hidden Choice', istarget=False, parent=self.parent_bid, state='HIDDEN')
+        models.Bid.objects.create(name='Hidden Nested', istarget=True, parent=self.hidden_choice, state='OPENED')
+
+    def test_tree(self):
+        bids = models.Bid.objects.filter(state__in=('OPENED', 'CLOSED')).order_by('-name')
+        with self.assertNumQueries(1):
+            roots = viewutil.bid_tree(bids)
+        self.assertEqual([self.parent_bid, self.challenge], roots)
+        parent = roots[0]
+        self.assertEqual([self.choice, self.closed_bid, self.opened_bid], parent.tree_children)
+        nested, = parent.tree_children[0].tree_children
+        self.assertEqual(self.nested_bid, nested)
+        self.assertEqual([self.parent_bid, self.choice], nested.tree_ancestors)
+        self.assertEqual([], roots[1].tree_children)
+
+    def test_upcoming_bids_feed(self):
+        response = self.client.get(reverse('tracker:feed_upcoming_bids', args=(self.event.id,)))
+        results = response.json()['results']
+        self.assertEqual(['Challenge', 'Parent Test'], sorted(result['bid'] for result in results))
+        parent = [result for result in results if result['bid'] == 'Parent Test'][0]
+        self.assertEqual(['Choice', 'Closed Test', 'Opened Test'], [option['name'] for option in parent['options']])
+
 
 class TestBidAdmin(TestBid):
     def setUp(self):
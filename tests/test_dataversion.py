@@ -0,0 +1,70 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+import tracker.models as models
+
+
+class TestDataVersion(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.other = models.Event.objects.create(short='other', targetamount=5, datetime=timezone.now())
+
+    def test_bump(self):
+        before = models.DataVersion.get(('donations', 'donors'), self.event.id)
+        other = models.DataVersion.key(('donations',), self.other.id)
+        models.Donation.objects.create(event=self.event, amount=5, domain='LOCAL', transactionstate='COMPLETED')
+        after = models.DataVersion.get(('donations', 'donors'), self.event.id)
+        self.assertGreater(after['donations'], before['donations'])
+        self.assertEqual(after['donors'], before['donors'])
+        # other events keep their versions
+        self.assertEqual(other, models.DataVersion.key(('donations',), self.other.id))
+
+
+class TestVersionedPageCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.url = reverse('tracker:runindex', args=(self.event.short,))
+
+    def add_run(self, name, order):
+        return models.SpeedRun.objects.create(event=self.event, name=name, run_time='0:10:00', order=order)
+
+    def test_cached_until_changed(self):
+        run = self.add_run('First Run', 1)
+        self.assertContains(self.client.get(self.url), 'First Run')
+        # updates skip the signals, so the cached page is served
+        models.SpeedRun.objects.filter(id=run.id).update(name='Renamed Run')
+        self.assertContains(self.client.get(self.url), 'First Run')
+        self.add_run('Second Run', 2)
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Renamed Run')
+        self.assertContains(response, 'Second Run')
+
+    def test_other_event_unaffected(self):
+        run = self.add_run('First Run', 1)
+        other = models.Event.objects.create(short='other', targetamount=5, datetime=timezone.now())
+        self.client.get(self.url)
+        models.SpeedRun.objects.filter(id=run.id).update(name='Renamed Run')
+        models.SpeedRun.objects.create(event=other, name='Other Run', run_time='0:10:00', order=1)
+        self.assertContains(self.client.get(self.url), 'First Run')
+
+    def test_logged_in_not_cached(self):
+        User.objects.create_user('staff', password='password', is_staff=True)
+        self.client.login(username='staff', password='password')
+        self.assertIn('private', self.client.get(self.url)['Cache-Control'])
+        self.client.logout()
+        self.assertNotIn('private', self.client.get(self.url)['Cache-Control'])
+
+    def test_fragment_cached_for_logged_in(self):
+        User.objects.create_user('staff', password='password', is_staff=True)
+        self.client.login(username='staff', password='password')
+        run = self.add_run('First Run', 1)
+        self.assertContains(self.client.get(self.url), 'First Run')
+        models.SpeedRun.objects.filter(id=run.id).update(name='Renamed Run')
+        self.assertContains(self.client.get(self.url), 'First Run')
+        self.add_run('Second Run', 2)
+        self.assertContains(self.client.get(self.url), 'Renamed Run')
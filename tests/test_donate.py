@@ -1,8 +1,13 @@
 import tracker.models as models
 import tracker.forms as forms
+import tracker.views.donateviews as donateviews
 
-from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.utils import timezone
 
+import json
 from decimal import Decimal
 
 
@@ -19,3 +24,46 @@ class TestDonorNameAssignment(TransactionTestCase):
         self.assertTrue(form.is_valid())
         self.assertEqual(form.cleaned_data['requestedvisibility'], 'ANON')
         self.assertFalse(bool(form.cleaned_data['requestedalias']))
+
+
+class TestDonatePageQueries(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        for i in range(3):
+            run = models.SpeedRun.objects.create(event=self.event, name='Run %d' % i, run_time='0:10:00', order=i + 1)
+            war = models.Bid.objects.create(speedrun=run, name='War %d' % i, state='OPENED')
+            # create skips clean, which would copy the run down to the options
+            choice = models.Bid.objects.create(parent=war, speedrun=run, name='Choice %d' % i, state='OPENED')
+            for j in range(2):
+                option = models.Bid.objects.create(parent=choice, speedrun=run, name='Option %d' % j, istarget=True,
+                                                   state='OPENED')
+                models.BidSuggestion.objects.create(bid=option, name='Suggestion %d' % j)
+        self.factory = RequestFactory()
+
+    def test_bids_json(self):
+        with self.assertNumQueries(4):
+            bidsJson, ticketPrizesJson = donateviews.donate_json(self.event)
+        bids = json.loads(bidsJson)
+        self.assertEqual(6, len(bids))
+        option = [bid for bid in bids if bid['label'].startswith('Run 1')][0]
+        self.assertEqual('Run 1 : War 1 -- Choice 1 -- Option 0 $0.00', option['label'])
+        self.assertEqual('War 1', option['parent']['parent']['name'])
+        self.assertEqual(['Suggestion 0'], option['suggested'])
+        self.assertEqual('[]', ticketPrizesJson)
+        with self.assertNumQueries(0):
+            self.assertEqual(bidsJson, donateviews.donate_json(self.event)[0])
+        models.Bid.objects.create(event=self.event, speedrun=models.SpeedRun.objects.get(name='Run 0'), name='Challenge',
+                                  istarget=True, goal=10)
+        self.assertEqual(7, len(json.loads(donateviews.donate_json(self.event)[0])))
+
+    def test_v2_context(self):
+        request = self.factory.get('/donate')
+        request.user = AnonymousUser()
+        view = donateviews.DonateViewV2(request=request, kwargs={'event': self.event})
+        # the bids with their runs, and their options
+        with self.assertNumQueries(2):
+            context = view.get_context_data(event=self.event)
+        self.assertTrue(context['hasBids'])
+        self.assertEqual(['Run 0', 'Run 1', 'Run 2'], [run.name for run in context['bids_by_run']])
+        self.assertEqual(['Choice 0'], [option.name for option in context['bids_by_run'][0].bid_list[0].options_list])
@@ -145,6 +145,36 @@ class TestDonorTotals(TransactionTestCase):
         self.assertEqual(0, models.DonorCache.objects.count())
 
 
+    def test_deferred_donor_cache(self):
+        with models.DonorCache.deferred():
+            for i in range(3):
+                models.Donation.objects.create(donor=self.john, event=self.ev1, amount=5, domainId='d%d' % i,
+                                               transactionstate='COMPLETED')
+            models.Donation.objects.create(donor=self.jane, event=self.ev2, amount=20, domainId='d3',
+                                           transactionstate='COMPLETED')
+            self.assertEqual(0, models.DonorCache.objects.count())
+        self.assertEqual(4, models.DonorCache.objects.count())
+        cache = models.DonorCache.objects.get(donor=self.john, event=self.ev1)
+        self.assertEqual((15, 3, 5, 5), (cache.donation_total, cache.donation_count, cache.donation_max, cache.donation_avg))
+        self.assertEqual(20, models.DonorCache.objects.get(donor=self.jane, event=None).donation_total)
+
+    def test_rebuild_donor_cache(self):
+        models.Donation.objects.create(donor=self.john, event=self.ev1, amount=5, domainId='d1',
+                                       transactionstate='COMPLETED')
+        models.Donation.objects.create(donor=self.john, event=self.ev2, amount=10, domainId='d2',
+                                       transactionstate='COMPLETED')
+        models.DonorCache.objects.filter(event=self.ev1).update(donation_total=50, donation_count=7)
+        models.DonorCache.objects.filter(event=self.ev2).delete()
+        models.DonorCache.objects.create(donor=self.jane, event=self.ev1, donation_total=1, donation_count=1)
+        models.DonorCache.rebuild(models.Event.objects.filter(pk=self.ev1.pk))
+        cache = models.DonorCache.objects.get(donor=self.john, event=self.ev1)
+        self.assertEqual((5, 1), (cache.donation_total, cache.donation_count))
+        self.assertFalse(models.DonorCache.objects.filter(donor=self.jane).exists())
+        self.assertFalse(models.DonorCache.objects.filter(event=self.ev2).exists())
+        models.DonorCache.rebuild()
+        self.assertEqual(10, models.DonorCache.objects.get(donor=self.john, event=self.ev2).donation_total)
+        self.assertEqual(15, models.DonorCache.objects.get(donor=self.john, event=None).donation_total)
+
 class TestDonorEmailSave(TransactionTestCase):
 
     def testSaveWithExistingDoesNotThrow(self):
@@ -173,6 +203,7 @@ class TestDonorMerge(TransactionTestCase):
         self.assertEqual(len(donationList), rootDonor.donation_set.count())
         for donation in rootDonor.donation_set.all():
             self.assertTrue(donation in donationList)
+        self.assertFalse(models.DonorCache.objects.exclude(donor=rootDonor).exists())
 
 
 class TestDonorLink(TransactionTestCase):
@@ -1,10 +1,14 @@
 import datetime
+import json
+import random
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory
 
 from . import TestMigrations
-from .. import models
+from .. import models, pubsub
+from ..views.feedviews import EventStreamView
 
 noon = datetime.time(12, 0)
 today = datetime.date.today()
@@ -77,3 +81,160 @@ class TestEventMigrations(TestMigrations):
         event2 = Event.objects.get(pk=self.event2.id)
         self.assertEqual(event1.datetime, event1.timezone.localize(today_noon - datetime.timedelta(minutes=30)))
         self.assertEqual(event2.datetime, event2.timezone.localize(tomorrow_noon))
+
+
+class TestEventTotals(TestCase):
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev1', targetamount=5, datetime=today_noon)
+        self.donor = models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+
+    def make_donation(self, amount, transactionstate='COMPLETED'):
+        return models.Donation.objects.create(donor=self.donor, event=self.event, amount=amount,
+                                              domainId=str(random.getrandbits(64)),
+                                              transactionstate=transactionstate)
+
+    def assertLedger(self, total, count, max):
+        ledger = models.EventTotal.objects.get(event=self.event)
+        self.assertEqual((ledger.total, ledger.count, ledger.max), (total, count, max))
+        self.assertEqual(models.EventTotal.reconcile(commit=False), [])
+
+    def test_completed_donations(self):
+        self.make_donation(5)
+        self.make_donation(20)
+        pending = self.make_donation(50, transactionstate='PENDING')
+        self.assertLedger(25, 2, 20)
+        pending.transactionstate = 'COMPLETED'
+        pending.save()
+        self.assertLedger(75, 3, 50)
+
+    def test_reversed_donation(self):
+        self.make_donation(5)
+        large = self.make_donation(20)
+        large = models.Donation.objects.get(pk=large.pk)
+        large.transactionstate = 'CANCELLED'
+        large.save()
+        self.assertLedger(5, 1, 5)
+
+    def test_deleted_after_moving(self):
+        self.make_donation(5)
+        donation = self.make_donation(20)
+        donation.event = models.Event.objects.create(short='other', targetamount=5, datetime=today_noon)
+        donation.delete()
+        self.assertLedger(5, 1, 5)
+
+    def test_changed_amount(self):
+        donation = self.make_donation(5)
+        donation.amount = 15
+        donation.save()
+        self.assertLedger(15, 1, 15)
+
+    def test_reconcile(self):
+        self.make_donation(5)
+        models.EventTotal.objects.filter(event=self.event).update(total=1, count=3)
+        drifted = models.EventTotal.reconcile()
+        self.assertEqual([d[0] for d in drifted], [self.event.id])
+        self.assertLedger(5, 1, 5)
+
+
+class TestEventStream(TransactionTestCase):
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev1', targetamount=5, datetime=today_noon)
+        self.donor = models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com', visibility='ALIAS', alias='JD')
+        self.factory = RequestFactory()
+
+    def read(self, stream):
+        kind, data = next(stream).decode('utf-8').rstrip('\n').split('\n')[-2:]
+        return kind[len('event: '):], json.loads(data[len('data: '):])
+
+    def test_stream(self):
+        response = EventStreamView.as_view()(self.factory.get('/feed/stream/ev1'), event='ev1')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertEqual(('total', {'total': 0.0, 'count': 0}), self.read(stream))
+        donation = models.Donation.objects.create(donor=self.donor, event=self.event, amount=5, domainId='1',
+                                                  transactionstate='COMPLETED', comment='hi', commentstate='PENDING')
+        kind, data = self.read(stream)
+        self.assertEqual(('donation', donation.id, 'JD', '', 5.0), (kind, data['id'], data['donor'], data['comment'], data['amount']))
+        self.assertEqual(('total', {'total': 5.0, 'count': 1}), self.read(stream))
+        donation.commentstate = 'APPROVED'
+        donation.save()
+        self.assertEqual(('donation', 'hi'), (lambda kind, data: (kind, data['comment']))(*self.read(stream)))
+        response.close()
+        self.assertEqual({}, dict(pubsub.get_broker()._subscriptions))
+
+    def test_rolled_back_changes_are_not_published(self):
+        subscription = pubsub.get_broker().subscribe(pubsub.event_channel(self.event.id))
+        try:
+            with transaction.atomic():
+                models.Donation.objects.create(donor=self.donor, event=self.event, amount=5, domainId='1', transactionstate='COMPLETED')
+                transaction.set_rollback(True)
+            self.assertIsNone(subscription.get(timeout=0))
+        finally:
+            subscription.close()
+
+    def test_test_donations_are_not_published(self):
+        subscription = pubsub.get_broker().subscribe(pubsub.event_channel(self.event.id))
+        try:
+            models.Donation.objects.create(donor=self.donor, event=self.event, amount=5, domainId='1',
+                                           transactionstate='COMPLETED', testdonation=True)
+            self.assertIsNone(subscription.get(timeout=0))
+            models.Donation.objects.create(donor=self.donor, event=self.event, amount=5, domainId='2',
+                                           transactionstate='COMPLETED')
+            self.assertTrue(subscription.get(timeout=0).startswith('event: donation\n'))
+        finally:
+            subscription.close()
+
+
+class TestEventRegistry(TransactionTestCase):
+    def setUp(self):
+        self.event1 = models.Event.objects.create(short='ev1', name='Event 1', targetamount=5, datetime=long_ago_noon)
+        self.event2 = models.Event.objects.create(short='ev2', name='Event 2', targetamount=5, datetime=today_noon)
+
+    def test_lookups(self):
+        self.assertEqual([self.event1, self.event2], models.EventRegistry.events())
+        with self.assertNumQueries(0):
+            self.assertEqual('Event 1', models.EventRegistry.get(self.event1.id).name)
+            self.assertEqual(self.event1, models.EventRegistry.get(str(self.event1.id)))
+            self.assertEqual(self.event2, models.EventRegistry.get('ev2'))
+            self.assertEqual(self.event2, models.EventRegistry.latest())
+            self.assertEqual(self.event2, models.event.LatestEvent())
+            for key in ('missing', '\u00b2', '\u0663'):
+                with self.assertRaises(models.Event.DoesNotExist):
+                    models.EventRegistry.get(key)
+            # every lookup gets its own instance
+            models.EventRegistry.get('ev1').name = 'Changed'
+            self.assertEqual('Event 1', models.EventRegistry.get('ev1').name)
+
+    def test_invalidation(self):
+        models.EventRegistry.events()
+        self.event1.name = 'Renamed'
+        self.event1.save()
+        self.assertEqual('Renamed', models.EventRegistry.get('ev1').name)
+        event3 = models.Event.objects.create(short='ev3', targetamount=5, datetime=tomorrow_noon)
+        self.assertEqual(event3, models.EventRegistry.latest())
+        event3.delete()
+        self.assertEqual(self.event2, models.EventRegistry.latest())
+
+        # another process changing the version stamp, or the copy getting too old, reloads it
+        models.Event.objects.filter(pk=self.event1.pk).update(name='Updated')
+        self.assertEqual('Renamed', models.EventRegistry.get('ev1').name)
+        models.EventRegistry.invalidate()
+        self.assertEqual('Updated', models.EventRegistry.get('ev1').name)
+        models.Event.objects.filter(pk=self.event1.pk).update(name='Expired')
+        with self.settings(TRACKER_EVENT_REGISTRY_TTL=0):
+            models.EventRegistry.invalidate()
+            models.EventRegistry.events()
+            models.Event.objects.filter(pk=self.event1.pk).update(name='Reloaded')
+            self.assertEqual('Reloaded', models.EventRegistry.get('ev1').name)
+
+    def test_transaction(self):
+        # rows read inside a transaction are only kept once it commits
+        with transaction.atomic():
+            models.EventRegistry.events()
+            self.assertIsNone(models.EventRegistry._state)
+        self.assertIsNotNone(models.EventRegistry._state)
+        with transaction.atomic():
+            models.Event.objects.create(short='ev3', targetamount=5, datetime=tomorrow_noon)
+            self.assertEqual('ev3', models.EventRegistry.latest().short)
+            transaction.set_rollback(True)
+        self.assertEqual(self.event2, models.EventRegistry.latest())
@@ -0,0 +1,40 @@
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.test import TestCase
+from django.utils import timezone
+
+import tracker.filters as filters
+import tracker.models as models
+
+
+class TestFilterPlans(TestCase):
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.donor = models.Donor.objects.create(alias='Mario', visibility='ANON', email='mario@example.com')
+        models.Donation.objects.create(event=self.event, donor=self.donor, amount=5, domain='LOCAL',
+                                       transactionstate='COMPLETED', comment='hype', commentstate='PENDING')
+        self.staff = User.objects.create_user('staff', password='password', is_staff=True)
+        self.staff.user_permissions.add(*Permission.objects.filter(
+            codename__in=('view_usernames', 'view_comments', 'view_emails')))
+        self.staff = User.objects.get(id=self.staff.id)
+
+    def search(self, model, params, user):
+        return list(filters.run_model_query(model, params, user=user).values_list('id', flat=True))
+
+    def test_permissions(self):
+        for user in (None, AnonymousUser()):
+            self.assertEqual([], self.search('donor', {'q': 'mario'}, user))
+            self.assertEqual([], self.search('donation', {'comment': 'hype'}, user))
+        self.assertEqual([self.donor.id], self.search('donor', {'q': 'mario'}, self.staff))
+        self.assertEqual(1, len(self.search('donation', {'comment': 'hype'}, self.staff)))
+
+    def test_compiled_once(self):
+        filters.specific_filter_plan.cache_clear()
+        for value in ('hype', 'other', ['hype', 'other']):
+            filters.model_specific_filter('donation', {'comment': value, 'event': self.event.id})
+        info = filters.specific_filter_plan.cache_info()
+        self.assertEqual((1, 2), (info.misses, info.hits))
+
+    def test_list_values(self):
+        other = models.Event.objects.create(short='other', targetamount=5, datetime=timezone.now())
+        self.assertEqual(sorted([self.event.id, other.id]),
+                         sorted(self.search('event', {'short': ['ev', 'other']}, None)))
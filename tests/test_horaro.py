@@ -0,0 +1,135 @@
+import copy
+import datetime
+import http.server
+import json
+import os
+import threading
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import tracker.horaro as horaro
+import tracker.models as models
+
+with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'horaro_schedules.json')) as f:
+    SCHEDULES = json.load(f)
+
+
+class HoraroHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the fixture schedules at the paths of the Horaro API."""
+
+    def do_GET(self):
+        if self.path == '/-/api/v1/events/test-event/schedules':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.server.schedules).encode('utf-8'))
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHoraroMerge(TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), HoraroHandler)
+        self.server.schedules = copy.deepcopy(SCHEDULES)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings = override_settings(TRACKER_HORARO_URL='http://127.0.0.1:%d' % self.server.server_port)
+        self.settings.enable()
+        self.event = models.Event.objects.create(
+            short='ev', targetamount=5, datetime=timezone.now(), horaro_id='test-event', horaro_game_col=0,
+            horaro_category_col=1, horaro_runners_col=2, horaro_commentators_col=3)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def runners(self, name):
+        return sorted(r.name for r in models.SpeedRun.objects.get(event=self.event, name=name).runners.all())
+
+    def test_merge(self):
+        self.assertEqual(4, horaro.merge_event_schedule(self.event))
+        runs = list(models.SpeedRun.objects.filter(event=self.event).order_by('order'))
+        self.assertEqual(['Super Metroid', 'Mega Man 2', 'Tetris', 'Zelda'], [r.name for r in runs])
+        self.assertEqual([2, 3, 4, 5], [r.order for r in runs])
+        metroid = runs[0]
+        self.assertEqual(('any%', 'Gamma', '1:00:00', '0:10:00'),
+                         (metroid.category, metroid.commentators, metroid.run_time, metroid.setup_time))
+        self.assertEqual(datetime.datetime(2019, 1, 5, 12, 40, tzinfo=datetime.timezone.utc), metroid.starttime)
+        self.assertEqual(datetime.datetime(2019, 1, 5, 13, 50, tzinfo=datetime.timezone.utc), metroid.endtime)
+        self.assertEqual(['alpha'], self.runners('Super Metroid'))
+        self.assertEqual(['Beta', 'alpha'], self.runners('Mega Man 2'))
+        self.assertEqual([], self.runners('Tetris'))
+        self.assertEqual(['Delta', 'Epsilon'], self.runners('Zelda'))
+        # the later mention renames the runner, but keeps the stream from the first
+        alpha = models.Runner.objects.get(name__iexact='alpha')
+        self.assertEqual(('alpha', 'https://twitch.tv/alpha'), (alpha.name, alpha.stream))
+        self.assertEqual('Beta, alpha', runs[1].deprecated_runners)
+        self.event.refresh_from_db()
+        self.assertEqual(metroid.starttime, self.event.datetime)
+
+    def test_remerge(self):
+        horaro.merge_event_schedule(self.event)
+        kept = models.SpeedRun.objects.get(event=self.event, name='Zelda')
+        items = self.server.schedules['data'][0]['items']
+        items[1], items[2] = items[2], items[1]
+        items[2]['data'][2] = 'Beta'
+        del items[3]
+        self.server.schedules['data'][1]['items'][0]['data'][2] = 'Delta, zeta'
+
+        diff = horaro.diff_event_schedule(self.event)
+        lines = list(diff.lines())
+        self.assertIn("Unschedule run 'Tetris'", lines)
+        self.assertIn("Create runner 'zeta'", lines)
+        self.assertIn("Remove runner 'Epsilon' from 'Zelda'", lines)
+        self.assertIn("Add runner 'Beta' to 'Super Metroid'", lines)
+        self.assertIn("Remove runner 'alpha' from 'Super Metroid'", lines)
+        self.assertFalse(diff.created_runs)
+
+        self.assertEqual(3, diff.apply())
+        self.assertEqual(kept.pk, models.SpeedRun.objects.get(event=self.event, name='Zelda').pk)
+        self.assertEqual(['Mega Man 2', 'Super Metroid', 'Zelda'],
+                         [r.name for r in models.SpeedRun.objects.filter(event=self.event).exclude(order=None)
+                         .order_by('order')])
+        self.assertIsNone(models.SpeedRun.objects.get(event=self.event, name='Tetris').order)
+        self.assertEqual(['Beta'], self.runners('Super Metroid'))
+        self.assertEqual(['Delta', 'zeta'], self.runners('Zelda'))
+
+        # nothing left to change
+        self.assertFalse(horaro.diff_event_schedule(self.event))
+
+    def test_dry_run(self):
+        self.assertEqual(4, horaro.merge_event_schedule(self.event, dry_run=True))
+        self.assertFalse(models.SpeedRun.objects.filter(event=self.event).exists())
+        self.assertFalse(models.Runner.objects.exists())
+
+    def test_query_count(self):
+        items = self.server.schedules['data'][1]['items']
+        start = datetime.datetime(2019, 1, 6, 14, 5, tzinfo=datetime.timezone.utc)
+        for n in range(100):
+            items.append({'length': 'PT25M', 'scheduled': (start + datetime.timedelta(minutes=30 * n)).isoformat(),
+                          'data': ['Game %d' % n, 'any%', 'Runner %d, Runner %d' % (n, n + 1), '']})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(104, horaro.merge_event_schedule(self.event))
+        self.assertLess(len(queries), 25)
+        self.assertEqual(['Runner 41', 'Runner 42'], self.runners('Game 41'))
+        items[0]['data'][2] = 'Delta'
+        with CaptureQueriesContext(connection) as queries:
+            horaro.merge_event_schedule(self.event)
+        self.assertLess(len(queries), 25)
+        self.assertEqual(['Delta'], self.runners('Zelda'))
+
+    def test_errors(self):
+        self.event.horaro_game_col = 9
+        with self.assertRaises(horaro.HoraroError):
+            horaro.merge_event_schedule(self.event)
+        self.event.horaro_id = 'missing'
+        self.event.horaro_game_col = 0
+        with self.assertRaises(horaro.HoraroError):
+            horaro.merge_event_schedule(self.event)
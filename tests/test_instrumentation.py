@@ -0,0 +1,88 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, modify_settings, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+import tracker.instrumentation as instrumentation
+import tracker.models as models
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = instrumentation.Histogram((1, 5))
+        for value in (0, 1, 3, 7):
+            histogram.observe(value)
+        self.assertEqual([(1, 2), (5, 3), (float('inf'), 4)], histogram.cumulative())
+        self.assertEqual((4, 11), (histogram.count, histogram.sum))
+
+    def test_bounded(self):
+        registry = instrumentation.Registry(max_series=2)
+        for view in ('a', 'b', 'a', 'c'):
+            registry.observe(view, '', {'queries': 1})
+        self.assertEqual(['a', 'c'], [view for view, event, metrics in registry.snapshot()])
+
+
+@modify_settings(MIDDLEWARE={'append': 'tracker.instrumentation.InstrumentationMiddleware'})
+class TestInstrumentationMiddleware(TestCase):
+    def setUp(self):
+        instrumentation.registry.reset()
+        # the public pages are cached
+        cache.clear()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        for i in range(3):
+            models.SpeedRun.objects.create(event=self.event, name='Run %d' % i, run_time='0:10:00', order=i + 1)
+        self.staff = User.objects.create_user('staff', password='password', is_staff=True)
+
+    def series(self, view):
+        return [(event, metrics) for v, event, metrics in instrumentation.registry.snapshot() if v.endswith(view)]
+
+    def test_streamed_search(self):
+        response = self.client.get('/tracker/search', {'type': 'run', 'event': self.event.id})
+        # the work of a streamed response is only recorded once it has been sent
+        self.assertEqual([], self.series('api.search'))
+        self.assertEqual(3, len(json.loads(b''.join(response.streaming_content).decode('utf-8'))))
+        (event, metrics), = self.series('api.search')
+        self.assertEqual(str(self.event.id), event)
+        cumulative, count, queries = metrics['queries']
+        self.assertEqual(1, count)
+        self.assertGreater(queries, 0)
+        self.assertGreater(metrics['serialize_time'][2], 0)
+
+    def test_rendered_page(self):
+        self.client.get(reverse('tracker:runindex', args=(self.event.short,)))
+        (event, metrics), = self.series('runindex')
+        self.assertEqual('ev', event)
+        self.assertGreater(metrics['render_time'][2], 0)
+
+    @override_settings(TRACKER_REPEATED_QUERY_THRESHOLD=3)
+    def test_repeated_queries(self):
+        def view(request):
+            # one event query per run
+            return HttpResponse(','.join(run.event.short for run in models.SpeedRun.objects.all()))
+
+        with self.assertLogs('tracker.instrumentation', 'WARNING') as logs:
+            instrumentation.InstrumentationMiddleware(view)(RequestFactory().get('/runs'))
+        self.assertIn('unresolved', logs.output[0])
+        self.assertIn('\n  3x ', logs.output[0])
+
+    @override_settings(TRACKER_SLOW_REQUEST_SECONDS=0)
+    def test_slow_request(self):
+        with self.assertLogs('tracker.instrumentation', 'WARNING') as logs:
+            self.client.get(reverse('tracker:runindex', args=(self.event.short,)))
+        self.assertIn('runindex', logs.output[0])
+
+    def test_endpoint(self):
+        self.client.get(reverse('tracker:runindex', args=(self.event.short,)))
+        self.assertEqual(302, self.client.get(reverse('tracker:metrics')).status_code)
+        self.client.login(username='staff', password='password')
+        data = json.loads(self.client.get(reverse('tracker:metrics')).content.decode('utf-8'))
+        runindex = [s for s in data if s['view'].endswith('runindex')][0]
+        self.assertEqual(1, runindex['metrics']['total_time']['count'])
+        self.assertEqual('+Inf', runindex['metrics']['queries']['buckets'][-1][0])
+        text = self.client.get(reverse('tracker:metrics'), {'format': 'prometheus'}).content.decode('utf-8')
+        self.assertIn('# TYPE tracker_request_queries histogram', text)
+        self.assertIn('tracker_request_total_time_count{view="tracker:runindex",event="ev"} 1', text)
@@ -0,0 +1,65 @@
+import datetime
+import http.server
+import json
+import threading
+
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+import tracker.models as models
+import tracker.postbackutil as postbackutil
+
+
+class PostbackHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.received.append(json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+        self.send_response(200 if self.path == '/ok' else 500)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPostbackDelivery(TransactionTestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), PostbackHandler)
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.good = models.PostbackURL.objects.create(event=self.event, url=base + '/ok')
+        self.bad = models.PostbackURL.objects.create(event=self.event, url=base + '/fail')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_delivery(self):
+        models.PostbackDelivery.enqueue(self.event, json.dumps({'id': 1}))
+        results = postbackutil.deliver_postbacks()
+        self.assertEqual(2, len(results))
+        self.assertEqual([{'id': 1}] * 2, self.server.received)
+        delivered = models.PostbackDelivery.objects.get(postback=self.good)
+        self.assertEqual(('DELIVERED', 1), (delivered.state, delivered.attempts))
+        failed = models.PostbackDelivery.objects.get(postback=self.bad)
+        self.assertEqual(('PENDING', 1), (failed.state, failed.attempts))
+        self.assertIn('500', failed.last_error)
+        self.assertGreater(failed.next_attempt, timezone.now())
+        # nothing else is due until the retry
+        self.assertEqual([], postbackutil.deliver_postbacks())
+
+    def test_circuit_breaker(self):
+        for i in range(postbackutil.CIRCUIT_THRESHOLD):
+            models.PostbackDelivery.objects.create(postback=self.bad, payload='{}')
+        postbackutil.deliver_postbacks()
+        self.bad.refresh_from_db()
+        self.assertEqual(postbackutil.CIRCUIT_THRESHOLD, self.bad.consecutive_failures)
+        self.assertGreater(self.bad.disabled_until, timezone.now())
+        models.PostbackDelivery.objects.update(next_attempt=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual([], postbackutil.deliver_postbacks())
+
+    def test_gives_up(self):
+        delivery = models.PostbackDelivery.objects.create(postback=self.bad, payload='{}', attempts=postbackutil.MAX_ATTEMPTS - 1)
+        postbackutil.deliver_postbacks()
+        delivery.refresh_from_db()
+        self.assertEqual('FAILED', delivery.state)
@@ -1,3 +1,4 @@
+import collections
 import datetime
 import random
 from decimal import Decimal
@@ -427,6 +428,164 @@ class TestDonorPrizeEntryDraw(TransactionTestCase):
             self.assertTrue(donorId in donors)
 
 
+class TestPrizeTicketDraw(TransactionTestCase):
+
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=parse_date("2012-01-01 01:00:00+00:00"))
+        self.prize = models.Prize.objects.create(name='Ticket Prize', event=self.event, ticketdraw=True, sumdonations=True, randomdraw=True,
+                                                 minimumbid=Decimal('5.00'), maximumbid=None)
+        self.donors = [models.Donor.objects.create(email='donor%d@example.com' % i) for i in range(3)]
+
+    def donate(self, donor, amount, ticket=None):
+        donation = models.Donation.objects.create(event=self.event, donor=donor, amount=Decimal(amount), domainId=str(random.getrandbits(64)),
+                                                  transactionstate='COMPLETED', timereceived=self.event.datetime)
+        if ticket:
+            models.PrizeTicket.objects.create(prize=self.prize, donation=donation, amount=Decimal(ticket))
+
+    def testTicketAmounts(self):
+        self.donate(self.donors[0], '50.00', ticket='10.00')
+        self.donate(self.donors[0], '20.00', ticket='5.00')
+        self.donate(self.donors[1], '100.00', ticket='2.00')
+        self.donate(self.donors[2], '100.00')
+        self.assertEqual(([self.donors[0].id, self.donors[1].id], [Decimal('15.00'), Decimal('2.00')]),
+                         tuple(map(list, zip(*sorted(zip(*self.prize.eligible_amounts()))))))
+        eligible = self.prize.eligible_donors()
+        self.assertEqual([{'donor': self.donors[0].id, 'amount': Decimal('15.00'), 'weight': 3.0}], eligible)
+
+    def testAutoTickets(self):
+        self.prize.auto_tickets = True
+        self.prize.save()
+        self.donate(self.donors[0], '50.00')
+        self.donate(self.donors[1], '10.00', ticket='10.00')
+        eligible = self.prize.eligible_donors()
+        self.assertEqual([10.0, 2.0], [e['weight'] for e in eligible])
+
+    def testDrawWeights(self):
+        amounts = [Decimal(random.randint(1, 100000)) / 100 for i in range(2000)]
+        weights = [models.prize.draw_weights(amounts[:i + 1], Decimal('3.33'), Decimal('500.00'))[i] for i in range(0, 2000, 400)]
+        self.assertEqual(weights, models.prize.draw_weights(amounts, Decimal('3.33'), Decimal('500.00'))[0:2000:400])
+
+class TestPrizeEligibility(TransactionTestCase):
+
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=parse_date("2012-01-01 01:00:00+00:00"))
+        self.donors = [models.Donor.objects.create(email='donor%d@example.com' % i) for i in range(3)]
+        for i, donor in enumerate(self.donors):
+            self.donate(donor, Decimal(5 + i))
+        self.prize = models.Prize.objects.create(event=self.event, name='Prize', minimumbid=Decimal('5.00'), maximumbid=None)
+
+    def donate(self, donor, amount):
+        return models.Donation.objects.create(event=self.event, donor=donor, amount=amount, domainId=str(random.getrandbits(32)),
+                                              transactionstate='COMPLETED', timereceived=self.event.datetime)
+
+    def testSnapshotIsStable(self):
+        snapshot = self.prize.eligibility_snapshot()
+        self.assertEqual(len(snapshot.digest), 64)
+        self.assertEqual([{'donor': d['donor'], 'amount': str(d['amount']), 'weight': d['weight']} for d in self.prize.eligible_donors()],
+                         snapshot.eligible_donors())
+        models.PrizeEligibility.objects.all().delete()
+        self.assertEqual(snapshot.digest, self.prize.eligibility_snapshot().digest)
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshot.digest, self.prize.eligibility_snapshot().digest)
+
+    def testInvalidation(self):
+        first = self.prize.eligibility_snapshot().digest
+        donation = self.donate(self.donors[0], Decimal('20.00'))
+        self.assertFalse(models.PrizeEligibility.objects.exists())
+        second = self.prize.eligibility_snapshot().digest
+        self.assertNotEqual(first, second)
+        donation.delete()
+        self.assertEqual(first, self.prize.eligibility_snapshot().digest)
+        models.DonorPrizeEntry.objects.create(prize=self.prize, donor=models.Donor.objects.create(email='entry@example.com'))
+        self.assertFalse(models.PrizeEligibility.objects.exists())
+        self.prize.eligibility_snapshot()
+        models.PrizeWinner.objects.create(prize=self.prize, winner=self.donors[0])
+        self.assertFalse(models.PrizeEligibility.objects.exists())
+
+    def testDrawUsesSnapshot(self):
+        eligible = self.prize.eligibility_snapshot().eligible_donors()
+        result, data = prizeutil.draw_prize(self.prize, seed=1, eligible=eligible)
+        self.assertTrue(result)
+        self.assertIn(data['winner'], [d['donor'] for d in eligible])
+
+
+class TestPrizeBatchDraw(TransactionTestCase):
+
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=parse_date("2012-01-01 01:00:00+00:00"))
+        self.donors = [models.Donor.objects.create(email='donor%d@example.com' % i) for i in range(20)]
+        for i, donor in enumerate(self.donors):
+            models.Donation.objects.create(event=self.event, donor=donor, amount=Decimal(5 + i), domainId=str(i),
+                                           transactionstate='COMPLETED', timereceived=self.event.datetime)
+
+    def make_prize(self, **kwargs):
+        kwargs.setdefault('minimumbid', Decimal('5.00'))
+        return models.Prize.objects.create(event=self.event, maximumbid=None, **kwargs)
+
+    def testDrawAllWinners(self):
+        prize = self.make_prize(name='Multi', maxwinners=12, maxmultiwin=2)
+        result = prizeutil.draw_prizes([prize], seed=12345)[0]
+        self.assertIsNone(result['error'])
+        self.assertEqual(12, len(result['winners']))
+        self.assertTrue(prize.maxed_winners())
+        for winner in prize.prizewinner_set.all():
+            self.assertLessEqual(winner.sumcount, 2)
+            self.assertEqual(winner.pendingcount, result['winners'].count(winner.winner_id))
+
+    def testReproducible(self):
+        prizes = [self.make_prize(name='Prize %d' % i, maxwinners=3) for i in range(2)]
+        first = [r['winners'] for r in prizeutil.draw_prizes(prizes, seed=666)]
+        models.PrizeWinner.objects.all().delete()
+        second = [r['winners'] for r in prizeutil.draw_prizes(prizes, seed=666)]
+        self.assertEqual(first, second)
+        self.assertEqual(len(set(first[0])), 3)
+
+    def testCategoryExclusion(self):
+        category = models.PrizeCategory.objects.create(name='Category')
+        prizes = [self.make_prize(name='Prize %d' % i, category=category, maxwinners=5) for i in range(4)]
+        results = prizeutil.draw_prizes(prizes, seed=1)
+        winners = [w for r in results for w in r['winners']]
+        self.assertEqual(20, len(winners))
+        self.assertEqual(20, len(set(winners)))
+        self.assertEqual('Prize: Prize 0 already has the maximum number of winners allowed.',
+                         prizeutil.draw_prizes(prizes[:1])[0]['error'])
+
+    def testCategoryInvalidation(self):
+        category = models.PrizeCategory.objects.create(name='Category')
+        prizes = [self.make_prize(name='Prize %d' % i, category=category, maxwinners=5) for i in range(2)]
+        for prize in prizes:
+            prize.eligibility_snapshot()
+        version = models.DataVersion.get(('prizes',), self.event.id)
+        winners = prizeutil.draw_prizes(prizes[:1], seed=1)[0]['winners']
+        self.assertNotEqual(version, models.DataVersion.get(('prizes',), self.event.id))
+        eligible = [d['donor'] for d in prizes[1].eligibility_snapshot().eligible_donors()]
+        self.assertEqual(15, len(eligible))
+        self.assertFalse(set(winners) & set(eligible))
+        second = prizeutil.draw_prizes(prizes[1:], seed=1)[0]['winners']
+        self.assertFalse(set(winners) & set(second))
+
+    def testNonRandomDraw(self):
+        prize = self.make_prize(name='Top', randomdraw=False, maxwinners=3)
+        result = prizeutil.draw_prizes([prize])[0]
+        self.assertEqual([d.id for d in self.donors[:-4:-1]], result['winners'])
+
+    def testNoEligibleDonors(self):
+        prize = self.make_prize(name='Expensive', minimumbid=Decimal('100.00'))
+        result = prizeutil.draw_prizes([prize])[0]
+        self.assertEqual([], result['winners'])
+        self.assertEqual('Prize: Expensive has no eligible donors.', result['error'])
+
+    def testSampler(self):
+        sampler = prizeutil.WeightedSampler([0, 3, 0, 1])
+        rand = random.Random(5)
+        counts = collections.Counter(sampler.draw(rand) for i in range(4000))
+        self.assertEqual({1, 3}, set(counts))
+        self.assertAlmostEqual(3.0, counts[1] / float(counts[3]), delta=0.5)
+        sampler.remove(1)
+        self.assertEqual({3}, set(sampler.draw(rand) for i in range(100)))
+        sampler.remove(3)
+        self.assertIsNone(sampler.draw(rand))
+
 class TestPrizeMultiWin(TransactionTestCase):
 
     def setUp(self):
@@ -0,0 +1,98 @@
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.db import connections, router
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+import tracker.models as models
+import tracker.routers as routers
+import tracker.views.common as views_common
+
+
+def routing():
+    return router.db_for_read(models.Event), router.db_for_write(models.Event)
+
+
+@routers.read_replica
+def read_view(request):
+    return HttpResponse(','.join(routing()))
+
+
+@routers.read_replica
+def write_view(request):
+    router.db_for_write(models.Event)
+    return HttpResponse(router.db_for_read(models.Event))
+
+
+@routers.read_replica
+def streamed_view(request):
+    return StreamingHttpResponse(router.db_for_read(models.Event) for i in range(1))
+
+
+# what each database has of a run's name, with the replica a write behind
+run_names = {}
+
+
+@views_common.cache_versioned_page('runs')
+@routers.read_replica
+def versioned_view(request):
+    return HttpResponse(run_names[router.db_for_read(models.SpeedRun)])
+
+
+@override_settings(DATABASE_ROUTERS=['tracker.routers.ReplicaRouter'], TRACKER_READ_REPLICAS=['replica'])
+class TestReplicaRouter(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestReplicaRouter, cls).setUpClass()
+        # another alias of the test database, which the views below only route to without querying
+        connections.databases['replica'] = dict(connections.databases['default'])
+
+    @classmethod
+    def tearDownClass(cls):
+        del connections.databases['replica']
+        super(TestReplicaRouter, cls).tearDownClass()
+
+    def setUp(self):
+        routers._lags.clear()
+        self.factory = RequestFactory()
+
+    def test_reads(self):
+        self.assertEqual(b'replica,default', read_view(self.factory.get('/')).content)
+        self.assertEqual(b'default,default', read_view(self.factory.post('/')).content)
+        # outside of the views, and after them
+        self.assertEqual(('default', 'default'), routing())
+
+    def test_write_pins_request(self):
+        self.assertEqual(b'default', write_view(self.factory.get('/')).content)
+
+    def test_streamed(self):
+        self.assertEqual([b'replica'], list(streamed_view(self.factory.get('/')).streaming_content))
+
+    @override_settings(TRACKER_REPLICA_MAX_LAG=-1)
+    def test_lagging(self):
+        self.assertEqual(b'default,default', read_view(self.factory.get('/')).content)
+
+    def test_staff_pin(self):
+        staff = User.objects.create_user('staff', password='password', is_staff=True)
+        middleware = routers.ReplicaMiddleware(write_view)
+        for user, pinned in ((AnonymousUser(), False), (staff, True)):
+            request = self.factory.post('/')
+            request.user = user
+            self.assertEqual(pinned, routers.PIN_COOKIE in middleware(request).cookies)
+        request = self.factory.get('/')
+        request.COOKIES[routers.PIN_COOKIE] = '1'
+        self.assertEqual(b'default,default', read_view(request).content)
+
+    @override_settings(TRACKER_REPLICA_MAX_LAG=0)
+    def test_lagging_page_not_cached(self):
+        cache.clear()
+        run_names.update(default='Renamed Run', replica='First Run')
+        self.assertEqual(b'First Run', versioned_view(self.factory.get('/')).content)
+        # the version was bumped by the write already, so only the lag keeps the replica's page from being kept
+        run_names['replica'] = 'Renamed Run'
+        self.assertEqual(b'Renamed Run', versioned_view(self.factory.get('/')).content)
+        # while pages read from the default database are still kept until the next bump
+        with override_settings(TRACKER_READ_REPLICAS=[]):
+            versioned_view(self.factory.get('/'))
+            run_names['default'] = 'Third Name'
+            self.assertEqual(b'Renamed Run', versioned_view(self.factory.get('/')).content)
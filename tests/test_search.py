@@ -0,0 +1,89 @@
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import tracker.filters as filters
+import tracker.models as models
+
+
+@override_settings(TRACKER_SEARCH_DOCUMENTS=True)
+class TestSearchDocuments(TestCase):
+    def setUp(self):
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now())
+        self.donor = models.Donor.objects.create(alias='Mario', visibility='ANON', email='m@example.com')
+        self.donation = models.Donation.objects.create(
+            event=self.event, donor=self.donor, amount=5, domain='LOCAL', transactionstate='COMPLETED',
+            comment='Hype Train', commentstate='PENDING')
+        self.usernames = self.user('usernames', 'view_usernames')
+        self.emails = self.user('emails', 'view_emails')
+
+    def user(self, username, *perms):
+        user = User.objects.create_user(username, password='password', is_staff=True)
+        user.user_permissions.add(*Permission.objects.filter(codename__in=perms))
+        return User.objects.get(id=user.id)
+
+    def search(self, model, text, user=None):
+        return list(filters.run_model_query(model, {'q': text}, user=user).values_list('id', flat=True))
+
+    def test_visibility(self):
+        for user in (None, AnonymousUser(), self.emails):
+            self.assertEqual([], self.search('donor', 'mario', user))
+        self.assertEqual([self.donor.id], self.search('donor', 'MARIO', self.usernames))
+        self.donor.visibility = 'ALIAS'
+        self.donor.save()
+        self.assertEqual([self.donor.id], self.search('donor', 'mario', None))
+
+    def test_emails(self):
+        self.assertEqual([], self.search('donor', 'example.com', self.usernames))
+        self.assertEqual([self.donor.id], self.search('donor', 'example.com', self.emails))
+        self.assertEqual([self.donation.id], self.search('donation', 'example.com', self.emails))
+        self.donor.email = 'luigi@example.com'
+        self.donor.save()
+        self.assertEqual([], self.search('donation', 'm@', self.emails))
+        self.assertEqual([self.donation.id], self.search('donation', 'luigi@', self.emails))
+
+    def test_approved_comment(self):
+        self.assertEqual([], self.search('donation', 'hype', None))
+        self.donation.commentstate = 'APPROVED'
+        self.donation.save()
+        self.assertEqual([self.donation.id], self.search('donation', 'hype', None))
+
+    def test_mass_assign(self):
+        superuser = User.objects.create_superuser('super', 'super@example.com', 'password')
+        self.client.force_login(superuser)
+        self.client.post(reverse('admin:tracker_donation_changelist'),
+                         {'action': 'set_commentstate_approved', '_selected_action': [self.donation.id]})
+        self.assertEqual('APPROVED', models.Donation.objects.get(id=self.donation.id).commentstate)
+        self.assertEqual([self.donation.id], self.search('donation', 'hype', None))
+
+    def test_short_text(self):
+        run = models.SpeedRun.objects.create(event=self.event, name='Super Metroid', run_time='0:10:00', order=1)
+        models.SpeedRun.objects.create(event=self.event, name='Zelda', run_time='0:10:00', order=2)
+        # two characters are searched with LIKE, longer text through the text index where there is one
+        for text in ('me', 'metroid', 'super metroid', '  SUPER   Metroid '):
+            self.assertEqual([run.id], self.search('run', text))
+        self.assertEqual([], self.search('run', 'metroid super'))
+
+    def test_unchanged(self):
+        run = models.SpeedRun.objects.create(event=self.event, name='Zelda', run_time='0:10:00', order=1)
+        run.order = 2
+        with CaptureQueriesContext(connection) as queries:
+            run.save()
+        self.assertFalse([query for query in queries if 'tracker_searchdocument' in query['sql']])
+
+    def test_delete(self):
+        self.donation.delete()
+        self.assertFalse(models.SearchDocument.objects.filter(model='donation').exists())
+
+    def test_dependencies(self):
+        # every field the documents of a model take from a related model has to rebuild them when it changes
+        related = set()
+        for kind in models.SearchDocument.MODELS:
+            for field, column, condition in models.SearchDocument.plan(kind):
+                if '__' in field:
+                    related.add((kind,) + tuple(field.rsplit('__', 1)))
+        self.assertEqual(related, set((kind, path, field)
+                                      for model, field, kind, path in models.SearchDocument.DEPENDENCIES))
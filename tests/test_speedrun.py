@@ -4,7 +4,9 @@ from django.contrib.sessions.middleware import SessionMiddleware
 
 import tracker.models as models
 
+from django.db import connection
 from django.test import TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 
 import datetime
 
@@ -65,6 +67,28 @@ class TestSpeedRun(TransactionTestCase):
         self.assertEqual(self.run2.starttime, self.event1.datetime)
 
 
+    def test_recalculate_schedule(self):
+        models.SpeedRun.objects.filter(pk=self.run1.pk).update(run_time='1:45:00')
+        changed = models.SpeedRun.recalculate_schedule(self.event1)
+        self.assertEqual([self.run1.id, self.run2.id, self.run3.id], [run.id for run in changed])
+        self.run3.refresh_from_db()
+        self.assertEqual(self.run3.starttime, self.event1.datetime + datetime.timedelta(minutes=130))
+        self.assertEqual(self.run3.endtime, self.event1.datetime + datetime.timedelta(minutes=135))
+        self.assertEqual([], models.SpeedRun.recalculate_schedule(self.event1))
+
+    def test_gap_before_edited_run(self):
+        gap = datetime.timedelta(minutes=30)
+        models.SpeedRun.objects.filter(pk=self.run2.pk).update(starttime=self.run2.starttime + gap,
+                                                               endtime=self.run2.endtime + gap)
+        self.run3.refresh_from_db()
+        self.run3.run_time = '0:10:00'
+        self.run3.save()
+        self.run2.refresh_from_db()
+        self.assertEqual(self.run2.starttime, self.event1.datetime + datetime.timedelta(minutes=80))
+        self.assertEqual(self.run3.starttime, self.run2.endtime)
+        self.assertEqual(self.run3.endtime, self.run2.endtime + datetime.timedelta(minutes=10))
+
+
 class TestMoveSpeedRun(TransactionTestCase):
 
     def setUp(self):
@@ -157,6 +181,18 @@ class TestMoveSpeedRun(TransactionTestCase):
         self.assertEqual(self.run3.order, 4)
         self.assertEqual(self.run4.order, 3)
 
+    def test_long_schedule(self):
+        from tracker.views.commands import MoveSpeedRun
+        runs = [models.SpeedRun.objects.create(name='Run %d' % i, run_time='0:10:00', order=4 + i) for i in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            output, status = MoveSpeedRun({'moving': runs[-1].id, 'other': self.run1.id, 'before': True})
+        # a constant number of queries, rather than a few for every run that moved
+        self.assertLess(len(queries), 20)
+        self.assertEqual(len(output), 53)
+        runs[0].refresh_from_db()
+        self.assertEqual(runs[0].order, 5)
+        self.assertEqual(runs[0].starttime, self.event1.datetime + datetime.timedelta(minutes=105))
+
 class TestSpeedRunAdmin(TransactionTestCase):
     def setUp(self):
         noon = datetime.datetime.combine(datetime.date.today(), datetime.time(12, 0))
@@ -0,0 +1,134 @@
+import datetime
+import http.server
+import json
+import threading
+import urllib.parse
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import tracker.models as models
+import tracker.tiltify as tiltify
+
+
+class TiltifyHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a campaign and its donations, newest first, with cursor links like the Tiltify API."""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        self.server.requests.append(self.path)
+        if url.path == '/api/v2/campaign':
+            body = {'starts': '2019-01-05'}
+        elif url.path == '/api/v2/campaign/donations':
+            count = int(query['count'][0])
+            donations = self.server.donations
+            if 'before' in query:
+                donations = [d for d in donations if d['id'] < int(query['before'][0])]
+            page = donations[:count]
+            links = {}
+            if len(donations) > count:
+                links['next'] = '/api/v2/campaign/donations?' + urllib.parse.urlencode(
+                    {'count': count, 'before': page[-1]['id']})
+            body = {'data': page, 'links': links}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def tiltify_donation(id, name='Anonymous', amount=5, comment=None):
+    return {'id': id, 'name': name, 'amount': amount, 'currency_code': 'USD', 'comment': comment,
+            'created': '2019-01-05T12:%02d:00 +0000' % (id % 60)}
+
+
+class TestTiltifySync(TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), TiltifyHandler)
+        self.server.requests = []
+        self.server.donations = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings = override_settings(TRACKER_TILTIFY_URL='http://127.0.0.1:%d' % self.server.server_port)
+        self.settings.enable()
+        self.event = models.Event.objects.create(short='ev', targetamount=5, datetime=timezone.now(),
+                                                 tiltify_enable_sync=True, tiltify_api_key='key')
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_donations(self, *donations):
+        self.server.donations = sorted(self.server.donations + list(donations), key=lambda d: -d['id'])
+
+    def test_sync(self):
+        self.add_donations(*[tiltify_donation(i, name='Donor %d' % (i % 3), amount=i) for i in range(1, 251)])
+        self.add_donations(tiltify_donation(251, comment='hi'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(251, tiltify.sync_event_donations(self.event))
+        # three pages, each a fixed number of queries
+        self.assertEqual(4, len(self.server.requests))
+        self.assertLess(len(queries), 60)
+        self.assertEqual(251, models.Donation.objects.filter(event=self.event, domain='TILTIFY').count())
+        self.assertEqual(3, models.Donor.objects.count())
+        anonymous = models.Donation.objects.get(domainId='251')
+        self.assertEqual((None, 'hi', 'COMPLETED'), (anonymous.donor, anonymous.comment, anonymous.transactionstate))
+        self.assertEqual(datetime.datetime(2019, 1, 5, 12, 11, tzinfo=datetime.timezone.utc), anonymous.timereceived)
+        self.assertEqual(251, self.event.tiltify_last_donation)
+        self.event.refresh_from_db()
+        self.assertEqual(251, self.event.tiltify_last_donation)
+
+        # the caches the save signals would have maintained are up to date
+        total = models.EventTotal.objects.get(event=self.event)
+        self.assertEqual((Decimal(sum(range(1, 251)) + 5), 251, Decimal(250)), (total.total, total.count, total.max))
+        self.assertEqual([], models.EventTotal.reconcile(commit=False))
+        donor = models.Donor.objects.get(alias='Donor 1')
+        cache = models.DonorCache.objects.get(donor=donor, event=self.event)
+        self.assertEqual((Decimal(sum(range(1, 251, 3))), 84), (cache.donation_total, cache.donation_count))
+
+    def test_incremental(self):
+        self.add_donations(*[tiltify_donation(i, name='Donor') for i in range(1, 201)])
+        tiltify.sync_event_donations(self.event)
+        donor = models.Donor.objects.get()
+        self.server.requests = []
+
+        self.add_donations(tiltify_donation(201, name='donor', amount=20), tiltify_donation(202, name='New'))
+        self.assertEqual(2, tiltify.sync_event_donations(self.event))
+        # stops at the first page, which reaches the donations synced before
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(donor, models.Donation.objects.get(domainId='201').donor)
+        self.assertEqual(202, self.event.tiltify_last_donation)
+        self.assertEqual((Decimal(1025), 202), (models.EventTotal.objects.get(event=self.event).total,
+                                                 models.EventTotal.objects.get(event=self.event).count))
+        self.assertEqual(Decimal(1025), models.DonorCache.objects.get(donor=donor, event=self.event).donation_total
+                         + models.DonorCache.objects.get(donor__alias='New', event=self.event).donation_total)
+
+        self.server.requests = []
+        self.assertEqual(0, tiltify.sync_event_donations(self.event))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_full_resync(self):
+        self.add_donations(tiltify_donation(1, amount=5), tiltify_donation(2, amount=10))
+        tiltify.sync_event_donations(self.event)
+        self.server.donations[1]['amount'] = 7.5
+        self.assertEqual(2, tiltify.sync_event_donations(self.event, full=True))
+        self.assertEqual(Decimal('7.50'), models.Donation.objects.get(domainId='1').amount)
+        self.assertEqual(Decimal('17.50'), models.EventTotal.objects.get(event=self.event).total)
+
+    def test_other_event(self):
+        other = models.Event.objects.create(short='other', targetamount=5, datetime=timezone.now())
+        models.Donation.objects.create(event=other, domain='TILTIFY', domainId='1', amount=5)
+        self.add_donations(tiltify_donation(1))
+        with self.assertRaises(ValidationError):
+            tiltify.sync_event_donations(self.event)
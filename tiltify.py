@@ -2,24 +2,39 @@
 
 import logging
 import re
+import urllib.parse
+from decimal import Decimal
 
 import requests
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db.models.functions import Lower
 from django.utils import dateparse
 
-from tracker.models import Donor, Donation
+from tracker.models import (DataVersion, Donor, Donation, DonorCache, Event, EventTotal, PrizeEligibility,
+                            SearchDocument)
+from tracker.models.donation import publish_donation
+from tracker.pubsub import publish
 
-CAMPAIGN_URL = 'https://tiltify.com/api/v2/campaign'
-DONATIONS_URL = 'https://tiltify.com/api/v2/campaign/donations'
+# TRACKER_TILTIFY_URL points the sync at a different Tiltify instance, i.e. a local stand-in for testing.
+CAMPAIGN_URL = '{base}/api/v2/campaign'
+DONATIONS_URL = '{base}/api/v2/campaign/donations'
+
+# Donations requested per page.
+PAGE_SIZE = 100
 
 logger = logging.getLogger(__name__)
 
 
-def _get_tiltify_data(url, api_key):
+def _base_url():
+    return getattr(settings, 'TRACKER_TILTIFY_URL', 'https://tiltify.com').rstrip('/')
+
+
+def _get_tiltify_data(url, api_key, params=None):
     headers = {
         'Authorization': 'Token token="{}"'.format(api_key),
     }
-    r = requests.get(url, headers=headers)
+    r = requests.get(url, headers=headers, params=params)
 
     if r.status_code != 200:
         logger.error("Error getting URL {0!r} - {1}".format(url, r.status_code))
@@ -45,7 +60,7 @@ def get_campaign_data(api_key):
     :return: Donation data object.
     :rtype: dict
     """
-    return _get_tiltify_data(CAMPAIGN_URL, api_key)
+    return _get_tiltify_data(CAMPAIGN_URL.format(base=_base_url()), api_key)
 
 
 def get_donation_data(api_key):
@@ -56,14 +71,119 @@ def get_donation_data(api_key):
     :return: List of donations.
     :rtype: list[dict]
     """
-    return _get_tiltify_data(DONATIONS_URL, api_key)
+    return [donation for page in get_donation_pages(api_key) for donation in page]
+
+
+def get_donation_pages(api_key, since=None):
+    """Get pages of donations for the given Tiltify API key, newest first, following the cursor links
+    until the donation with the given ID is reached.
+
+    :param api_key: API key of the campaign to retrieve.
+    :type api_key: str
+    :param since: ID of a donation already synced, only newer donations are returned.
+    :type since: int
+    :return: Generator of lists of donations.
+    :rtype: collections.Iterable[list[dict]]
+    """
+    url = DONATIONS_URL.format(base=_base_url())
+    params = {'count': PAGE_SIZE}
+    while url:
+        data = _get_tiltify_data(url, api_key, params)
+        page = data['data']
+        if since is not None:
+            page = [d for d in page if int(d['id']) > since]
+        if page:
+            yield page
+        if since is not None and len(page) < len(data['data']):
+            break
+        next_url = (data.get('links') or {}).get('next')
+        # the cursor link carries its own query string
+        url = urllib.parse.urljoin(url, next_url) if next_url and data['data'] else None
+        params = None
+
+
+def _resolve_donors(t_donations):
+    """Find or create the donors for a page of donations, by alias, with a fixed number of queries."""
+    names = set(t['name'] for t in t_donations if t['name'] and t['name'] != 'Anonymous')
+    if not names:
+        return {}
+
+    def lookup():
+        donors = {}
+        for donor in (Donor.objects.annotate(lower_alias=Lower('alias'))
+                      .filter(lower_alias__in=set(n.lower() for n in names)).order_by('-id')):
+            donors[donor.alias.lower()] = donor
+        return donors
+
+    donors = lookup()
+    missing = dict((n.lower(), n) for n in names if n.lower() not in donors)
+    if missing:
+        Donor.objects.bulk_create(Donor(email=name, alias=name) for name in missing.values())
+        DataVersion.bump('donors')
+        donors = lookup()
+        SearchDocument.build('donor', [donors[name].pk for name in missing])
+    return dict((name, donors[name.lower()]) for name in names)
+
+
+def _sync_page(event, t_donations):
+    """Upsert one page of Tiltify donations. Returns the (donor, event) pairs whose caches need updating."""
+    donors = _resolve_donors(t_donations)
+    ids = [str(t['id']) for t in t_donations]
+    existing = dict((d.domainId, d) for d in Donation.objects.select_for_update()
+                    .filter(domain='TILTIFY', domainId__in=ids))
+
+    created = []
+    changed = []
+    for t_donation in t_donations:
+        values = {
+            'transactionstate': 'COMPLETED',
+            'amount': Decimal(str(t_donation['amount'])).quantize(Decimal('0.01')),
+            'currency': t_donation['currency_code'],
+            'timereceived': _parse_tiltify_datetime(t_donation['created']),
+            'testdonation': event.usepaypalsandbox,
+            # Comment might be null from Tiltify, but can't be null on our end.
+            'comment': t_donation['comment'] or '',
+        }
+        donation = existing.get(str(t_donation['id']))
+        if donation is None:
+            created.append(Donation(event=event, domain='TILTIFY', domainId=str(t_donation['id']),
+                                    readstate='PENDING', commentstate='PENDING',
+                                    donor=donors.get(t_donation['name']), **values))
+            continue
+
+        # Make sure this donation wasn't already imported for a different event.
+        if donation.event_id != event.id:
+            raise ValidationError("Donation {!r} already exists for a different event".format(donation.domainId))
+
+        if any(getattr(donation, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(donation, field, value)
+            changed.append(donation)
 
+    if created:
+        Donation.objects.bulk_create(created)
+    # Updates to donations that were already synced are rare, and may move bid totals, so they go through save().
+    for donation in changed:
+        donation.save()
+
+    pairs = set((d.donor_id, event.id) for d in created if d.donor_id)
+    if created:
+        createdIds = []
+        for donation in Donation.objects.filter(domainId__in=[d.domainId for d in created]).select_related('donor', 'event'):
+            createdIds.append(donation.pk)
+            publish_donation(donation)
+        SearchDocument.build('donation', createdIds)
+    return pairs
 
-def sync_event_donations(event):
-    """Sync donations from a Tiltify campaign with an event in our system.
+
+def sync_event_donations(event, full=False):
+    """Sync donations from a Tiltify campaign with an event in our system. Only donations newer than the
+    last one synced are fetched and processed, a page at a time, unless a full sync is requested.
 
     :param event: Event record to merge.
     :type event: tracker.models.Event
+    :param full: Re-sync every donation of the campaign, instead of only the new ones.
+    :type full: bool
     :return: Number of donations updated.
     :rtype: int
     """
@@ -75,48 +195,30 @@ def sync_event_donations(event):
 
     start = dateparse.parse_date(t_campaign['starts'])
     if start:
-        event.date = start
-
-    event.save()
+        # date is derived from datetime, so move the start date and keep the time of day
+        event.datetime = event.datetime.replace(year=start.year, month=start.month, day=start.day)
 
     # Get donations from Tiltify API.
-    t_donations = get_donation_data(event.tiltify_api_key)
+    since = None if full else event.tiltify_last_donation
     num_donations = 0
+    pairs = set()
+
+    with DonorCache.deferred():
+        for t_donations in get_donation_pages(event.tiltify_api_key, since):
+            pairs |= _sync_page(event, t_donations)
+            num_donations += len(t_donations)
+            newest = max(int(t['id']) for t in t_donations)
+            if event.tiltify_last_donation is None or newest > event.tiltify_last_donation:
+                event.tiltify_last_donation = newest
+
+        if num_donations:
+            # Bulk inserts skip the save signals, so bring the caches up to date in one pass.
+            DonorCache.recompute(pairs)
+            EventTotal.reconcile(Event.objects.filter(pk=event.pk))
+            publish(event.pk, 'total', lambda: EventTotal.stream_data(event.pk))
+            PrizeEligibility.invalidate(events=[event.pk])
+            DataVersion.bump('donations', [event.pk])
 
-    for t_donation in t_donations:
-        # Get donor based on alias.
-        donor = None
-        if t_donation['name'] and t_donation['name'] != 'Anonymous':
-            try:
-                donor = Donor.objects.get(alias__iexact=t_donation['name'])
-            except Donor.DoesNotExist:
-                donor = Donor(email=t_donation['name'], alias=t_donation['name'])
-                donor.save()
-
-        # Get donation based on payment reference.
-        try:
-            donation = Donation.objects.select_for_update().get(domain='TILTIFY', domainId=t_donation['id'])
-        except Donation.DoesNotExist:
-            donation = Donation(event=event, domain='TILTIFY', domainId=t_donation['id'], readstate='PENDING',
-                                commentstate='PENDING', donor=donor)
-
-        # Make sure this donation wasn't already imported for a different event.
-        if donation.event != event:
-            raise ValidationError("Donation {!r} already exists for a different event".format(donation.domainId))
-
-        donation.transactionstate = 'COMPLETED'
-        donation.amount = t_donation['amount']
-        donation.currency = t_donation['currency_code']
-        donation.timereceived = _parse_tiltify_datetime(t_donation['created'])
-        donation.testdonation = event.usepaypalsandbox
-
-        # Comment might be null from Tiltify, but can't be null on our end.
-        if t_donation['comment']:
-            donation.comment = t_donation['comment']
-        else:
-            donation.comment = ''
-
-        donation.save()
-        num_donations += 1
+    event.save()
 
     return num_donations
@@ -43,6 +43,7 @@ urlpatterns = [
     path('api/v1/delete', api.delete),
     path('api/v1/command', api.command),
     path('api/v1/me', api.me),
+    path('api/v1/metrics', api.metrics, name='metrics'),
     path('api/v2/', include('tracker.api.urls')),
 
     # AJAX calls
@@ -54,6 +55,7 @@ urlpatterns = [
     path('feed/current_donations/<slug:event>', feedviews.CurrentDonationsView.as_view(), name='feed_current_donations'),
     path('feed/donations/<slug:event>', feedviews.RecentDonationsView.as_view(), name='feed_recent_donations'),
     path('feed/prizes/<slug:event>', feedviews.ActivePrizesView.as_view(), name='feed_prizes'),
+    path('feed/stream/<slug:event>', feedviews.EventStreamView.as_view(), name='feed_stream'),
 
     path('user/index', user.user_index, name='user_index'),
     path('user/user_prize/<int:prize>', user.user_prize, name='user_prize'),
@@ -1,21 +1,26 @@
-import json
-
 import collections
+import datetime
+import decimal
+import itertools
+import json
 
 import django.core.serializers as serializers
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib import admin
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import FieldError, FieldDoesNotExist, ObjectDoesNotExist, ValidationError, PermissionDenied
 from django.db import transaction, connection
+from django.db.models import Q
 from django.db.utils import IntegrityError
-from django.http import HttpResponse
+from django.utils.encoding import is_protected_type
+from django.http import HttpResponse, StreamingHttpResponse
 from django.http.response import Http404
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
 from . import commands
-from .. import filters, viewutil, prizeutil, logutil
+from .. import filters, instrumentation, viewutil, prizeutil, logutil, routers
 from ..models import *
 
 site = admin.site
@@ -30,6 +35,7 @@ __all__ = [
     'draw_prize',
     'parse_value',
     'me',
+    'metrics',
     'api_v1',
 ]
 
@@ -60,8 +66,18 @@ related = {
     'prizewinner'  : [ 'prize', 'winner' ],
 }
 
+# keyset orderings for paging through search results with ?after=<cursor>, the last key must be unique
+search_keys = {
+    'donation' : [ '-timereceived', '-id' ],
+}
+
+# the most rows returned by a single search, or page of a search
+max_search_results = 1000
+
+# these used to be deferred, but serializing the related objects loaded them back one query at a time,
+# so they are selected up front and only listed after the other related fields, where they always ended up
 defer = {
-    'bid'    : [ 'speedrun__description', 'speedrun__endtime', 'speedrun__starttime', 'speedrun__runners', 'event__date'],
+    'bid'    : [ 'speedrun__description', 'speedrun__endtime', 'speedrun__starttime', 'speedrun__runners', 'event__datetime'],
 }
 
 def donor_privacy_filter(model, fields):
@@ -113,7 +129,8 @@ def donation_privacy_filter(model, fields):
     if prefix + 'requestedemail' in fields:
         del fields[prefix + 'requestedemail']
     del fields[prefix + 'requestedvisibility']
-    del fields[prefix + 'requestedsolicitemail']
+    if prefix + 'requestedsolicitemail' in fields:
+        del fields[prefix + 'requestedsolicitemail']
     del fields[prefix + 'testdonation']
     del fields[prefix + 'domainId']
 
@@ -148,7 +165,147 @@ class Filters:
         if not user.has_perm('tracker.can_view_tech_notes'):
             del fields['tech_notes']
 
+_json_encoder = DjangoJSONEncoder()
+
+
+def _field_json(obj, field):
+    # mirrors what serializers.serialize('json', ...) would produce for this field
+    value = field.value_from_object(obj)
+    if not is_protected_type(value):
+        return field.value_to_string(obj)
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+        return _json_encoder.default(value)
+    return value
+
+
+def _m2m_values(objs):
+    """
+    Fetches the related pks of every many to many field for a batch of objects, one query per field,
+    in the order the related manager would return them.
+    """
+    values = collections.defaultdict(dict)
+    if not objs:
+        return values
+    ids = [o.pk for o in objs]
+    for field in objs[0]._meta.concrete_model._meta.many_to_many:
+        if not field.serialize or not field.remote_field.through._meta.auto_created:
+            continue
+        reverse = field.related_query_name()
+        byObj = values[field.name]
+        for o in ids:
+            byObj[o] = []
+        for o, pk in field.related_model._base_manager.filter(**{reverse + '__in': ids}).values_list(reverse, 'pk'):
+            byObj[o].append(pk)
+    return values
+
+
+def _public_name(obj):
+    return obj.visible_name() if isinstance(obj, Donor) else str(obj)
+
+
+def _search_rows(searchtype, qs, user, authorizedUser, batch_size=200):
+    """
+    Builds the serialized dictionaries for a search directly from the model instances, a batch at a time,
+    yielding (instance, dictionary) pairs
+    """
+    annotations = list(viewutil.ModelAnnotations.get(searchtype, {}))
+    trailing = collections.defaultdict(list)
+    for d in defer.get(searchtype, []):
+        r, f = d.rsplit('__', 1)
+        trailing[r].append(f)
+    clean_fields = getattr(Filters, searchtype, None)
+    objs = qs.iterator()
+    while True:
+        batch = list(itertools.islice(objs, batch_size))
+        if not batch:
+            return
+        m2m = _m2m_values(batch)
+        for obj in batch:
+            opts = obj._meta.concrete_model._meta
+            fields = collections.OrderedDict()
+            for field in opts.local_fields:
+                if field.serialize:
+                    fields[field.name] = _field_json(obj, field)
+            for name, byObj in m2m.items():
+                fields[name] = byObj[obj.pk]
+            fields['public'] = _public_name(obj)
+            for a in annotations:
+                fields[a] = str(getattr(obj, a))
+            for r in related.get(searchtype, []):
+                ro = obj
+                for f in r.split('__'):
+                    if not ro: break
+                    ro = getattr(ro, f)
+                if not ro: continue
+                late = trailing.get(r, [])
+                names = [f for f in ro.__dict__ if f not in late] + \
+                        [field.attname for field in ro._meta.concrete_fields if field.name in late]
+                for f in names:
+                    if f[0] == '_' or f.endswith('id'): continue
+                    fields[r + '__' + f] = _field_json(ro, ro._meta.get_field(f))
+                fields[r + '__public'] = _public_name(ro)
+            if not authorizedUser:
+                donor_privacy_filter(searchtype, fields)
+                donation_privacy_filter(searchtype, fields)
+                prize_privacy_filter(searchtype, fields)
+            if clean_fields:
+                clean_fields(user, fields)
+            yield obj, collections.OrderedDict((('model', str(opts)), ('pk', _field_json(obj, opts.pk)), ('fields', fields)))
+
+
+def _stream_json_array(rows):
+    # produces the same text as json.dumps(list(rows), ensure_ascii=False), one row at a time
+    yield '['
+    for i, row in enumerate(rows):
+        with instrumentation.timer('serialize'):
+            chunk = json.dumps(row, ensure_ascii=False)
+        yield (', ' if i else '') + chunk
+    yield ']'
+
+
+def _search_cursor(obj, keys):
+    return ','.join(obj._meta.get_field(key.lstrip('-')).value_to_string(obj) for key in keys)
+
+
+def _keyset_filter(Model, keys, cursor):
+    """
+    Matches the rows that come after the cursor when ordered by keys
+    """
+    values = cursor.split(',', len(keys) - 1)
+    if len(values) != len(keys):
+        raise ValueError('Cursor "%s" does not have a value for each of %s' % (cursor, ','.join(keys)))
+    after = Q()
+    equal = Q()
+    for key, value in zip(keys, values):
+        name = key.lstrip('-')
+        value = Model._meta.get_field(name).to_python(value)
+        after |= equal & Q(**{name + ('__lt' if key[0] == '-' else '__gt'): value})
+        equal &= Q(**{name: value})
+    return after
+
+
+def _page_rows(rows, limit, page):
+    # stops after limit rows, noting the last object returned and whether there were any more
+    for i, (obj, row) in enumerate(rows):
+        if i == limit:
+            page['more'] = True
+            return
+        page['last'] = obj
+        yield row
+
+
+def _stream_json_page(rows, page, keys, count=None):
+    yield '{'
+    if count is not None:
+        yield '"count": %d, ' % count
+    yield '"results": '
+    for chunk in _stream_json_array(rows):
+        yield chunk
+    yield ', "next": %s}' % json.dumps(_search_cursor(page['last'], keys) if page.get('more') else None, ensure_ascii=False)
+
+
 @never_cache
+@routers.read_replica
 def search(request):
     authorizedUser = request.user.has_perm('tracker.can_search')
     #  return HttpResponse('Access denied',status=403,content_type='text/plain;charset=utf-8')
@@ -158,47 +315,36 @@ def search(request):
         qs = filters.run_model_query(searchtype, searchParams, user=request.user, mode='admin' if authorizedUser else 'user')
         if searchtype in related:
             qs = qs.select_related(*related[searchtype])
-        if searchtype in defer:
-            qs = qs.defer(*defer[searchtype])
         qs = qs.annotate(**viewutil.ModelAnnotations.get(searchtype,{}))
-        if qs.count() > 1000:
-            qs = qs[:1000]
-        jsonData = json.loads(serializers.serialize('json', qs, ensure_ascii=False))
-        objs = dict([(o.id,o) for o in qs])
-        for o in jsonData:
-            baseObj = objs[int(o['pk'])]
-            if isinstance(baseObj, Donor):
-                o['fields']['public'] = baseObj.visible_name()
-            else:
-                o['fields']['public'] = str(baseObj)
-            for a in viewutil.ModelAnnotations.get(searchtype,{}):
-                o['fields'][a] = str(getattr(objs[int(o['pk'])],a))
-            for r in related.get(searchtype,[]):
-                ro = objs[int(o['pk'])]
-                for f in r.split('__'):
-                    if not ro: break
-                    ro = getattr(ro,f)
-                if not ro: continue
-                relatedData = json.loads(serializers.serialize('json', [ro], ensure_ascii=False))[0]
-                for f in ro.__dict__:
-                    if f[0] == '_' or f.endswith('id') or f in defer.get(searchtype,[]): continue
-                    v = relatedData["fields"][f]
-                    o['fields'][r + '__' + f] = relatedData["fields"][f]
-                if isinstance(ro, Donor):
-                    o['fields'][r + '__public'] = ro.visible_name()
-                else:
-                    o['fields'][r + '__public'] = str(ro)
-            if not authorizedUser:
-                donor_privacy_filter(searchtype, o['fields'])
-                donation_privacy_filter(searchtype, o['fields'])
-                prize_privacy_filter(searchtype, o['fields'])
-            clean_fields = getattr(Filters, searchtype, None)
-            if clean_fields:
-                clean_fields(request.user, o['fields'])
-        resp = HttpResponse(json.dumps(jsonData,ensure_ascii=False),content_type='application/json;charset=utf-8')
+        paged = 'limit' in searchParams or 'after' in searchParams
+        if paged:
+            if not qs.query.can_filter():
+                raise ValueError('Searches of type "%s" with a feed cannot be paged' % searchtype)
+            keys = search_keys.get(searchtype, ('id',))
+            limit = int(searchParams.get('limit', max_search_results))
+            if limit <= 0:
+                raise ValueError('Page size must be positive')
+            limit = min(limit, max_search_results)
+            count = qs.count() if filters.canonical_bool(searchParams.get('withcount')) else None
+            qs = qs.order_by(*keys)
+            if searchParams.get('after'):
+                qs = qs.filter(_keyset_filter(qs.model, keys, searchParams['after']))
+            qs = qs[:limit + 1]
+        else:
+            qs = qs[:max_search_results]
+        rows = _search_rows(searchtype, qs, request.user, authorizedUser)
+        # run the first batch up front so that malformed searches are still reported as errors
+        first = next(rows, None)
+        rows = itertools.chain([first], rows) if first is not None else iter([])
+        if paged:
+            page = {}
+            content = _stream_json_page(_page_rows(rows, limit, page), page, keys, count)
+        else:
+            content = _stream_json_array(row for obj, row in rows)
         if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
+            list(content)
             return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
-        return resp
+        return StreamingHttpResponse(content,content_type='application/json;charset=utf-8')
     except ValueError as e:
         return HttpResponse(json.dumps({'error': 'Value Error, malformed search parameters'}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
     except KeyError as e:
@@ -430,7 +576,7 @@ def prize_donors(request):
             return HttpResponse('Access denied',status=403,content_type='text/plain;charset=utf-8')
         requestParams = viewutil.request_params(request)
         id = int(requestParams['id'])
-        resp = HttpResponse(json.dumps(Prize.objects.get(pk=id).eligible_donors()),content_type='application/json;charset=utf-8')
+        resp = HttpResponse(Prize.objects.get(pk=id).eligibility_snapshot().donors,content_type='application/json;charset=utf-8')
         if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
             return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
         return resp
@@ -456,20 +602,17 @@ def draw_prize(request):
 
         skipKeyCheck = requestParams.get('skipkey', False)
 
+        snapshot = prize.eligibility_snapshot()
+        eligible = snapshot.eligible_donors()
+
         if not skipKeyCheck:
-            eligible = prize.eligible_donors()
             if not eligible:
                 return HttpResponse(json.dumps({'error': 'Prize has no eligible donors'}),status=409,content_type='application/json;charset=utf-8')
-            key = hash(json.dumps(eligible))
+            key = snapshot.digest
             if 'key' not in requestParams:
                 return HttpResponse(json.dumps({'key': key}),content_type='application/json;charset=utf-8')
-            else:
-                try:
-                    inputKey = type(key)(requestParams['key'])
-                    if inputKey != key:
-                        return HttpResponse(json.dumps({'error': 'Key field did not match expected value'},ensure_ascii=False),status=400,content_type='application/json;charset=utf-8')
-                except (ValueError,KeyError) as e:
-                    return HttpResponse(json.dumps({'error': 'Key field was missing or malformed', 'exception': '%s %s' % (type(e),e)},ensure_ascii=False),status=400,content_type='application/json;charset=utf-8')
+            elif requestParams['key'] != key:
+                return HttpResponse(json.dumps({'error': 'Key field did not match expected value'},ensure_ascii=False),status=400,content_type='application/json;charset=utf-8')
 
 
         if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
@@ -483,7 +626,7 @@ def draw_prize(request):
         status = True
         results = []
         while status and currentCount < limit:
-            status, data = prizeutil.draw_prize(prize, seed=requestParams.get('seed',None))
+            status, data = prizeutil.draw_prize(prize, seed=requestParams.get('seed',None), eligible=eligible)
             if status:
                 currentCount += 1
                 results.append(data)
@@ -505,7 +648,8 @@ def command(request):
     if func:
         if request.user.has_perm(func.permission):
             output, status = func(data)
-            output = serializers.serialize('json', output, ensure_ascii=False)
+            with instrumentation.timer('serialize'):
+                output = serializers.serialize('json', output, ensure_ascii=False)
         else:
             output = json.dumps({'error': 'permission denied'})
             status = 403
@@ -537,3 +681,11 @@ def me(request):
     if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
         return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1), status=200, content_type='application/json;charset=utf-8')
     return resp
+
+
+@never_cache
+@user_passes_test(lambda u: u.is_staff)
+def metrics(request):
+    if request.GET.get('format') == 'prometheus':
+        return HttpResponse(instrumentation.registry.as_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    return HttpResponse(json.dumps(instrumentation.registry.as_json(), ensure_ascii=False), content_type='application/json;charset=utf-8')
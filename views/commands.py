@@ -1,3 +1,6 @@
+from django.db import transaction
+from django.db.models import F
+
 from tracker.models import *
 
 __all__ = [
@@ -5,6 +8,7 @@ __all__ = [
 ]
 
 
+@transaction.atomic
 def MoveSpeedRun(data):
     moving = SpeedRun.objects.get(pk=data['moving'])
     other = SpeedRun.objects.get(pk=data['other'])
@@ -16,7 +20,6 @@ def MoveSpeedRun(data):
         else:
             runs = SpeedRun.objects.filter(event=moving.event, order__gt=other.order)
             final = other.order + 1
-        runs = runs.reverse()  # otherwise fixing the order goes in the wrong direction
         first = final
         diff = 1
     elif moving.order < other.order:
@@ -35,17 +38,18 @@ def MoveSpeedRun(data):
         else:
             runs = SpeedRun.objects.filter(event=moving.event, order__gt=other.order, order__lt=moving.order)
             final = other.order + 1
-        runs = runs.reverse()  # otherwise fixing the order goes in the wrong direction
         first = final
         diff = 1
     moving.order = None
     moving.save(fix_time=False)
-    for s in runs:
-        s.order += diff
-        s.save(fix_time=False)
+    # shift through negative orders, so that no two runs ever share an order partway through the update
+    runs.update(order=-(F('order') + diff))
+    SpeedRun.objects.filter(event=moving.event, order__lt=0).update(order=-F('order'))
     moving.order = final
     moving.save(fix_time=False)
-    models = SpeedRun.objects.get(event=moving.event, order=first).save()
+    changed = SpeedRun.recalculate_schedule(moving.event, first)
+    firstRun = next((run for run in changed if run.order == first), None) or SpeedRun.objects.get(event=moving.event, order=first)
+    models = [firstRun] + [run for run in changed if run.pk != firstRun.pk]
     return models, 200
 
 MoveSpeedRun.permission = 'tracker.change_speedrun'
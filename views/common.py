@@ -1,4 +1,5 @@
 import datetime
+import functools
 import json
 import sys
 import time
@@ -9,10 +10,14 @@ from django.shortcuts import render
 from django.http import HttpResponse
 from django.db import connection
 from django.template import Context
-from django.utils.cache import patch_cache_control
+from django.core.cache import cache
+from django.http import Http404
+from django.utils.cache import get_cache_key, learn_cache_key, patch_cache_control
 
 from django.conf import settings
 
+import tracker.instrumentation as instrumentation
+import tracker.routers as routers
 import tracker.viewutil as viewutil
 import tracker.models
 
@@ -43,7 +48,7 @@ def tracker_context(request, qdict=None):
         'profile' : profile,
         'next' : request.POST.get('next', request.GET.get('next', request.path)),
         'starttime' : starttime,
-        'events': tracker.models.Event.objects.all(),
+        'events': tracker.models.EventRegistry.events(),
     })
     qdict.setdefault('event',viewutil.get_event(None))
     qdict.setdefault('user',request.user)
@@ -58,6 +63,7 @@ def tracker_response(request, template='tracker/index.html', qdict=None, status=
         else:
             resp = render(request, template, context=qdict, status=status)
         render_time = time.time() - starttime
+        instrumentation.record('render', render_time)
         if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
             resp = HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
         cache_control = {}
@@ -73,3 +79,33 @@ def tracker_response(request, template='tracker/index.html', qdict=None, status=
         if request.user.is_staff and not settings.DEBUG:
             return HttpResponse(str(type(e)) + '\n\n' + str(e), content_type='text/plain', status=500)
         raise
+
+def cache_versioned_page(*kinds):
+    """
+    Caches a public page under the data versions of the given kinds (and of the events themselves) for
+    the page's event, or for all events when it has none, so it is rebuilt as soon as that data changes
+    and otherwise kept for TRACKER_PAGE_CACHE_TIMEOUT seconds.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            try:
+                event = viewutil.get_event(kwargs.get('event'))
+            except Http404:
+                return view(request, *args, **kwargs)
+            prefix = 'tracker.page.' + tracker.models.DataVersion.key(('events',) + kinds, event.id)
+            key = get_cache_key(request, prefix, 'GET', cache=cache)
+            response = cache.get(key) if key else None
+            if response is not None:
+                return response
+            response = view(request, *args, **kwargs)
+            # pages for logged in users are private, same as with cache_page
+            if response.status_code == 200 and not response.streaming and not response.cookies and \
+                    'private' not in response.get('Cache-Control', ''):
+                timeout = routers.cache_timeout(getattr(settings, 'TRACKER_PAGE_CACHE_TIMEOUT', 3600), response)
+                cache.set(learn_cache_key(request, response, timeout, prefix, cache=cache), response, timeout)
+            return response
+        return wrapped
+    return decorator
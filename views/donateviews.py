@@ -3,17 +3,14 @@ import datetime
 import json
 import random
 import traceback
-import urllib.error
-import urllib.parse
-import urllib.request
 from decimal import Decimal
 
 import post_office.mail
 import pytz
 from django.conf import settings
 from django.core import serializers
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Sum
 from django.http import HttpResponse, Http404
 from django.urls import reverse
 from django.views.decorators.cache import never_cache, cache_page
@@ -24,6 +21,7 @@ import tracker.filters as filters
 import tracker.forms as forms
 import tracker.models as models
 import tracker.paypalutil as paypalutil
+import tracker.routers as routers
 import tracker.viewutil as viewutil
 from . import common as views_common
 
@@ -42,6 +40,70 @@ def paypal_cancel(request):
 def paypal_return(request):
   return views_common.tracker_response(request, "tracker/paypal_return.html")
 
+# the bids and prizes on the donate page also depend on the time, through the current prize feed
+DONATE_JSON_TIMEOUT = 300
+
+def donate_bid_targets(event):
+  """
+  The open bid targets of the event, with their runs, suggestions and parents all loaded, in three
+  queries however deep the bids are.
+  """
+  bids = list(filters.run_model_query('bidtarget', {'state':'OPENED', 'event':event.id }).distinct().select_related('speedrun').prefetch_related('suggestions'))
+  # targets cannot have options, so every parent is a non-target in the same tree
+  parents = models.Bid.objects.filter(tree_id__in=set(bid.tree_id for bid in bids), istarget=False)
+  byId = dict((parent.id, parent) for parent in parents)
+  for bid in list(byId.values()) + bids:
+    if bid.parent_id:
+      bid.parent = byId[bid.parent_id]
+  return bids
+
+def donate_json(event):
+  """The JSON of the bids and ticket prizes on the donate page, kept until the data behind it changes."""
+  key = 'tracker.donate.%s' % models.DataVersion.key(('events', 'bids', 'prizes', 'runs'), event.id)
+  result = cache.get(key)
+  if result is not None:
+    return result
+
+  def bid_parent_info(bid):
+    if bid != None:
+      return {'name': bid.name, 'description': bid.description, 'parent': bid_parent_info(bid.parent) }
+    else:
+      return None
+
+  def bid_info(bid):
+    result = {
+      'id': bid.id,
+      'name': bid.name,
+      'description': bid.description,
+      'label': bid.full_label(not bid.allowuseroptions),
+      'count': bid.count,
+      'amount': bid.total,
+      'goal': Decimal(bid.goal or '0.00'),
+      'parent': bid_parent_info(bid.parent)
+    }
+    if bid.speedrun:
+      result['runname'] = bid.speedrun.name
+    suggestions = bid.suggestions.all()
+    if suggestions:
+      result['suggested'] = list([x.name for x in suggestions])
+    if bid.allowuseroptions:
+      result['custom'] = ['custom']
+      result['label'] += ' (select and add a name next to "New Option Name")'
+    return result
+
+  def prize_info(prize):
+    result = {'id': prize.id, 'name': prize.name, 'description': prize.description, 'minimumbid': prize.minimumbid, 'maximumbid': prize.maximumbid, 'sumdonations': prize.sumdonations}
+    return result
+
+  ticketPrizes = filters.run_model_query('prize', {'feed': 'current', 'event': event.id }).filter(ticketdraw=True, auto_tickets=False)
+
+  result = (
+    json.dumps([bid_info(o) for o in donate_bid_targets(event)], ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder),
+    json.dumps([prize_info(o) for o in ticketPrizes], ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder),
+  )
+  cache.set(key, result, routers.cache_timeout(DONATE_JSON_TIMEOUT))
+  return result
+
 @csrf_exempt
 @cache_page(300)
 def donate_orig(request, event):
@@ -111,59 +173,17 @@ def donate_orig(request, event):
     bidsform = forms.DonationBidFormSet(amount=Decimal('0.00'), prefix=bidsFormPrefix)
     prizesform = forms.PrizeTicketFormSet(amount=Decimal('0.00'), prefix=prizeFormPrefix)
 
-  def bid_parent_info(bid):
-    if bid != None:
-      return {'name': bid.name, 'description': bid.description, 'parent': bid_parent_info(bid.parent) }
-    else:
-      return None
-
-  def bid_info(bid):
-    result = {
-      'id': bid.id,
-      'name': bid.name,
-      'description': bid.description,
-      'label': bid.full_label(not bid.allowuseroptions),
-      'count': bid.count,
-      'amount': bid.total,
-      'goal': Decimal(bid.goal or '0.00'),
-      'parent': bid_parent_info(bid.parent)
-    }
-    if bid.speedrun:
-      result['runname'] = bid.speedrun.name
-    if bid.suggestions.exists():
-      result['suggested'] = list([x.name for x in bid.suggestions.all()])
-    if bid.allowuseroptions:
-      result['custom'] = ['custom']
-      result['label'] += ' (select and add a name next to "New Option Name")'
-    return result
-
-  bids = filters.run_model_query('bidtarget', {'state':'OPENED', 'event':event.id }, user=request.user).distinct().select_related('parent').prefetch_related('suggestions')
-
-  allPrizes = filters.run_model_query('prize', {'feed': 'current', 'event': event.id })
-
-  prizes = allPrizes.filter(ticketdraw=False)
-
-  dumpArray = [bid_info(o) for o in bids]
-
-  bidsJson = json.dumps(dumpArray, ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder)
-
-  ticketPrizes = allPrizes.filter(ticketdraw=True, auto_tickets=False)
-
-  def prize_info(prize):
-    result = {'id': prize.id, 'name': prize.name, 'description': prize.description, 'minimumbid': prize.minimumbid, 'maximumbid': prize.maximumbid, 'sumdonations': prize.sumdonations}
-    return result
-
-  dumpArray = [prize_info(o) for o in ticketPrizes.all()]
-  ticketPrizesJson = json.dumps(dumpArray, ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder)
+  bidsJson, ticketPrizesJson = donate_json(event)
+  prizes = filters.run_model_query('prize', {'feed': 'current', 'event': event.id }).filter(ticketdraw=False)
 
   return views_common.tracker_response(request, "tracker/donate.html", {
     'event': event,
     'bidsform': bidsform,
     'prizesform': prizesform,
     'commentform': commentform,
-    'hasBids': bids.count() > 0,
+    'hasBids': bidsJson != '[]',
     'bidsJson': bidsJson,
-    'hasTicketPrizes': ticketPrizes.count() > 0,
+    'hasTicketPrizes': ticketPrizesJson != '[]',
     'ticketPrizesJson': ticketPrizesJson,
     'prizes': prizes,
     'site_name': settings.SITE_NAME,
@@ -192,11 +212,11 @@ class DonateViewV2(TemplateView):
       amount = Decimal('0.00')
 
     # Bid selection form
-    bids = filters.run_model_query(
+    bids = list(filters.run_model_query(
       'bid', {'state': 'OPENED', 'event': event.id}, user=self.request.user).select_related(
-      'speedrun').prefetch_related('options')
+      'speedrun').prefetch_related('options'))
     context['bidsform'] = forms.DonationBidFormV2(amount=amount, bids=bids, data=self.request.POST or None)
-    context['hasBids'] = bids.count() > 0
+    context['hasBids'] = len(bids) > 0
     context['bids'] = bids
 
     # Group bids by run for the revamped donate page display.
@@ -205,7 +225,9 @@ class DonateViewV2(TemplateView):
       if bid.speedrun not in bids_by_run:
         bids_by_run[bid.speedrun] = []
 
-      bid.options_list = list(bid.options.filter(state='OPENED').order_by('-total', 'name'))
+      # the prefetched options, so that this doesn't cost a query per bid
+      bid.options_list = sorted((option for option in bid.options.all() if option.state == 'OPENED'),
+                                key=lambda option: (-option.total, option.name))
       bids_by_run[bid.speedrun].append(bid)
 
     context['bids_by_run'] = []
@@ -248,10 +270,10 @@ class DonateViewV2(TemplateView):
 
             if bids_form.cleaned_data.get(amt_field) and bids_form.cleaned_data.get(opt_field):
               try:
-                option = models.Bid.objects.get(event=bid.event, speedrun=bid.speedrun,
+                option = models.Bid.objects.get(event=context['event'], speedrun=bid.speedrun,
                                                 name__iexact=bids_form.cleaned_data[opt_field], parent=bid)
               except models.Bid.DoesNotExist:
-                option = models.Bid.objects.create(event=bid.event, speedrun=bid.speedrun,
+                option = models.Bid.objects.create(event=context['event'], speedrun=bid.speedrun,
                                                    name=bids_form.cleaned_data[opt_field], parent=bid,
                                                   state='PENDING', istarget=True)
               donation.bids.add(models.DonationBid(bid=option, amount=Decimal(bids_form.cleaned_data[amt_field])),
@@ -298,9 +320,9 @@ class DonateViewV2(TemplateView):
 # Are we using the original view page or the revamped version?
 # Define donate view based on this setting so the URLs
 if settings.USE_NEW_DONATE_LAYOUT:
-  donate = DonateViewV2.as_view()
+  donate = routers.read_replica(DonateViewV2.as_view())
 else:
-  donate = donate_orig
+  donate = routers.read_replica(donate_orig)
 
 
 @csrf_exempt
@@ -342,7 +364,7 @@ def ipn(request):
         }
         post_office.mail.send(recipients=[donation.donor.email], sender=donation.event.donationemailsender, template=donation.event.donationemailtemplate, context=formatContext)
 
-      agg = filters.run_model_query('donation', {'event': donation.event.id }).aggregate(amount=Sum('amount'))
+      agg = models.EventTotal.event_aggregate(donation.event.id)
 
       # TODO: this should eventually share code with the 'search' method, to
       postbackData = {
@@ -354,12 +376,8 @@ def ipn(request):
         'donor__visiblename': donation.donor.visible_name(),
         'new_total': agg['amount']
       }
-      postbackJSon = json.dumps(postbackData, ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder).encode('utf-8')
-      postbacks = models.PostbackURL.objects.filter(event=donation.event)
-      for postback in postbacks:
-        opener = urllib.request.build_opener()
-        req = urllib.request.Request(postback.url, postbackJSon, headers={'Content-Type': 'application/json; charset=utf-8'})
-        response = opener.open(req, timeout=5)
+      # sent by the deliver_postbacks command, so that slow receivers cannot hold up the IPN
+      models.PostbackDelivery.enqueue(donation.event, json.dumps(postbackData, ensure_ascii=False, cls=serializers.json.DjangoJSONEncoder))
     elif donation.transactionstate == 'CANCELLED':
       # eventually we may want to send out e-mail for some of the possible cases
       # such as payment reversal due to double-transactions (this has happened before)
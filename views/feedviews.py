@@ -2,15 +2,17 @@
 
 from decimal import Decimal
 
-from django.db.models import Sum
-from django.db.models.functions import Coalesce
-from django.http import JsonResponse
+from django.db import connection
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.views.generic.base import View
 
-from tracker import viewutil, filters
+from tracker import viewutil, filters, pubsub, routers
+from tracker.models import Bid, EventTotal
 
 
+@method_decorator(routers.read_replica, name='get')
 class UpcomingRunsView(View):
     def get(self, request, event, *args, **kwargs):
         # Get the next 3 upcoming runs for the event that haven't finished yet.
@@ -34,6 +36,7 @@ class UpcomingRunsView(View):
         return JsonResponse({'results': results})
 
 
+@method_decorator(routers.read_replica, name='get')
 class UpcomingBidsView(View):
     def get(self, request, event, *args, **kwargs):
         # Get the upcoming bids and their options + totals.
@@ -43,11 +46,13 @@ class UpcomingBidsView(View):
             'event': event.id,
         }
         # .filter(speedrun__endtime__gte=now)
-        bids = filters.run_model_query('bid', params).filter(state__in=['OPENED','CLOSED']).select_related(
-            'speedrun').prefetch_related('options').order_by('speedrun__endtime')
+        bids = list(filters.run_model_query('bid', params).filter(state__in=['OPENED','CLOSED']).select_related(
+            'speedrun').order_by('speedrun__endtime'))
+        options = Bid.objects.filter(tree_id__in=[bid.tree_id for bid in bids], level=1,
+                                     state__in=['OPENED','CLOSED'])
         results = []
 
-        for bid in bids:
+        for bid in viewutil.bid_tree(bids + list(options)):
             # ignore bids for no game for now
             if bid.speedrun == None:
                 continue
@@ -61,7 +66,7 @@ class UpcomingBidsView(View):
                 'run_started': bid.speedrun.starttime < now,
                 'options': [],
             }
-            for option in bid.options.filter(state__in=['OPENED','CLOSED']):
+            for option in bid.tree_children:
                 result['options'].append({
                     'name': option.name,
                     'amount_raised': float(option.total),
@@ -72,6 +77,7 @@ class UpcomingBidsView(View):
 
         return JsonResponse({'results': results})
 
+@method_decorator(routers.read_replica, name='get')
 class RecentDonationsView(View):
     def get(self, request, event, *args, **kwargs):
         event = viewutil.get_event(event)
@@ -92,6 +98,7 @@ class RecentDonationsView(View):
         return JsonResponse({'results':results})
 
 
+@method_decorator(routers.read_replica, name='get')
 class ActivePrizesView(View):
     def get(self, request, event, *args, **kwargs):
         event = viewutil.get_event(event)
@@ -120,16 +127,46 @@ class ActivePrizesView(View):
         return JsonResponse({'results':results})
 
 
+@method_decorator(routers.read_replica, name='get')
 class CurrentDonationsView(View):
     def get(self, request, event, *args, **kwargs):
         event = viewutil.get_event(event)
-        params = {
-            'event': event.id,
-            'transactionstate':'COMPLETED',
-        }
-        agg = filters.run_model_query('donation', params).aggregate(amount=Coalesce(Sum('amount'), Decimal('0.00')))
+        # answered from the event's running totals ledger rather than summing every donation
+        ledger = EventTotal.objects.filter(event=event).first()
 
         return JsonResponse({
-            'total': float(agg['amount']),
+            'total': float(ledger.total if ledger else Decimal('0.00')),
         })
 
+
+class EventStreamView(View):
+    """
+    A server-sent event stream of the changes to an event: 'donation' for completed donations (sent again
+    whenever their states change), 'total' for the event total and 'bids' for bid totals and state changes.
+    The stream starts with the current total. Each viewer holds a request open, so this needs a threaded
+    or asynchronous server.
+    """
+    keepalive = 15  # seconds between comments sent to keep idle connections open
+    retry = 5000  # milliseconds browsers wait before reconnecting
+
+    def get(self, request, event, *args, **kwargs):
+        event = viewutil.get_event(event)
+        # subscribe before reading the total, so that nothing published in between is missed
+        subscription = pubsub.get_broker().subscribe(pubsub.event_channel(event.id))
+        initial = 'retry: %d\n' % self.retry + pubsub.encode('total', EventTotal.stream_data(event.id))
+        # the stream itself never touches the database, so don't hold a connection for its lifetime
+        if not connection.in_atomic_block:
+            connection.close()
+        response = StreamingHttpResponse(self.stream(subscription, initial), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream(self, subscription, initial):
+        try:
+            yield initial
+            while True:
+                message = subscription.get(timeout=self.keepalive)
+                yield message if message is not None else ':\n\n'
+        finally:
+            subscription.close()
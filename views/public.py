@@ -2,12 +2,12 @@ import json
 
 import django.core.paginator as paginator
 from django.core import serializers
-from django.db.models import Count, Sum, Max, Avg, F
+from django.db.models import Count, Sum, Max, Avg, F, Subquery
 from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import reverse
-from django.views.decorators.cache import cache_page
 
 import tracker.filters as filters
+import tracker.routers as routers
 import tracker.viewutil as viewutil
 from tracker.forms import *
 from tracker.models import *
@@ -28,9 +28,11 @@ __all__ = [
   'prize',
   ]
 
+@routers.read_replica
 def eventlist(request):
   return views_common.tracker_response(request, 'tracker/eventlist.html', { 'events' : Event.objects.all() })
 
+@routers.read_replica
 def index(request,event=None):
   event = viewutil.get_event(event)
   eventParams = {}
@@ -38,7 +40,7 @@ def index(request,event=None):
   if event.id:
     eventParams['event'] = event.id
 
-  agg = filters.run_model_query('donation', eventParams).aggregate(amount=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
+  agg = EventTotal.event_aggregate(event.id)
   agg['target'] = event.targetamount
   count = {
     'runs' : filters.run_model_query('run', eventParams).count(),
@@ -52,21 +54,16 @@ def index(request,event=None):
 
   return views_common.tracker_response(request, 'tracker/index.html', { 'agg' : agg, 'count' : count, 'event': event })
 
-def get_bid_children(bid, bids):
-  return sorted((bid_info(child, bids) for child in bids if child.parent_id == bid.id), key=lambda child: -child['total'])
+def public_bids(**filters):
+  return Bid.objects.filter(state__in=('OPENED', 'CLOSED'), **filters).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name'))
 
-def get_bid_ancestors(bid, bids):
-  while bid.parent_id:
-    if bid.parent_id:
-      bid = next(filter(lambda parent: parent.id == bid.parent_id, bids))
-      yield bid
-
-def bid_info(bid, bids, speedrun=None, event=None):
+def bid_info(bid):
+  """The template view of a bid linked up by viewutil.bid_tree, and of its options."""
   return {
     'id': bid.id,
     'name': bid.name,
-    'children': get_bid_children(bid, bids),
-    'ancestors': list(get_bid_ancestors(bid, bids))[::-1],
+    'children': sorted((bid_info(child) for child in bid.tree_children), key=lambda child: -child['total']),
+    'ancestors': bid.tree_ancestors,
     'speedrun': bid.speedrun_name,
     'event': bid.event_name if not bid.speedrun_name else '',
     'description': bid.description,
@@ -75,23 +72,20 @@ def bid_info(bid, bids, speedrun=None, event=None):
     'istarget': bid.istarget,
   }
 
-@cache_page(60)
+@views_common.cache_versioned_page('bids')
+@routers.read_replica
 def bidindex(request, event=None):
   event = viewutil.get_event(event)
 
   if not event.id:
     return HttpResponseRedirect(reverse('tracker:bidindex', args=(Event.objects.latest().short,)))
 
-  bids = Bid.objects.filter(state__in=('OPENED', 'CLOSED')).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name'))
-  if event.id:
-    bids = bids.filter(event=event)
-
-  toplevel = [b for b in bids if b.parent_id == None]
+  toplevel = viewutil.bid_tree(public_bids(event=event))
   total = sum((b.total for b in toplevel), 0)
   choiceTotal = sum((b.total for b in toplevel if not b.goal), 0)
   challengeTotal = sum((b.total for b in toplevel if b.goal), 0)
 
-  bids = [bid_info(bid, bids) for bid in bids if bid.parent_id == None]
+  bids = [bid_info(bid) for bid in toplevel]
 
   if event.id:
     bidNameSpan = 2
@@ -99,7 +93,8 @@ def bidindex(request, event=None):
     bidNameSpan = 1
   return views_common.tracker_response(request, 'tracker/bidindex.html', { 'bids': bids, 'total': total, 'event': event, 'bidNameSpan' : bidNameSpan, 'choiceTotal': choiceTotal, 'challengeTotal': challengeTotal })
 
-@cache_page(60)
+@views_common.cache_versioned_page('bids', 'donations', 'donors')
+@routers.read_replica
 def bid(request, id):
   try:
     orderdict = {
@@ -116,11 +111,14 @@ def bid(request, id):
     except ValueError:
       order = -1
 
-    bid = Bid.objects.filter(pk=id,state__in=('OPENED', 'CLOSED')).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name')).first()
+    # the whole tree the bid belongs to, in one query
+    tree = list(public_bids(tree_id=Subquery(Bid.objects.filter(pk=id).values('tree_id'))))
+    viewutil.bid_tree(tree)
+    bid = next((b for b in tree if b.id == int(id) and hasattr(b, 'tree_children')), None)
     if not bid:
       raise Bid.DoesNotExist
-    event = bid.event
-    bid = bid_info(bid, (bid.get_ancestors() | bid.get_descendants()).filter(state__in=('OPENED', 'CLOSED')).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name')))
+    event = viewutil.get_event(bid.event_id)
+    bid = bid_info(bid)
 
     if not bid['istarget']:
       return views_common.tracker_response(request, 'tracker/bid.html', { 'event': event, 'bid' : bid})
@@ -135,7 +133,8 @@ def bid(request, id):
     return views_common.tracker_response(request, template='tracker/badobject.html', status=404)
 
 
-@cache_page(60)
+@views_common.cache_versioned_page('donations', 'donors')
+@routers.read_replica
 def donorindex(request,event=None):
   event = viewutil.get_event(event)
   orderdict = {
@@ -173,7 +172,8 @@ def donorindex(request,event=None):
   return views_common.tracker_response(request, 'tracker/donorindex.html', { 'donors' : donors, 'event' : event, 'pageinfo' : pageinfo, 'page' : page, 'sort' : sort, 'order' : order })
 
 
-@cache_page(60)
+@views_common.cache_versioned_page('donations', 'donors')
+@routers.read_replica
 def donor(request, id, event=None):
   try:
     event = viewutil.get_event(event)
@@ -192,7 +192,8 @@ def donor(request, id, event=None):
     return views_common.tracker_response(request, template='tracker/badobject.html', status=404)
 
 
-@cache_page(60)
+@views_common.cache_versioned_page('donations', 'donors')
+@routers.read_replica
 def donationindex(request,event=None):
   event = viewutil.get_event(event)
   orderdict = {
@@ -227,7 +228,8 @@ def donationindex(request,event=None):
 
   return views_common.tracker_response(request, 'tracker/donationindex.html', { 'donations' : donations, 'pageinfo' :  pageinfo, 'page' : page, 'agg' : agg, 'sort' : sort, 'order' : order, 'event': event })
 
-@cache_page(300)
+@views_common.cache_versioned_page('donations', 'donors', 'bids', 'runs')
+@routers.read_replica
 def donation(request,id):
   try:
     donation = Donation.objects.get(pk=id)
@@ -244,7 +246,8 @@ def donation(request,id):
   except Donation.DoesNotExist:
     return views_common.tracker_response(request, template='tracker/badobject.html', status=404)
 
-@cache_page(300)
+@views_common.cache_versioned_page('runs', 'runners', 'bids')
+@routers.read_replica
 def runindex(request,event=None):
   event = viewutil.get_event(event)
   searchForm = RunSearchForm(request.GET)
@@ -264,22 +267,22 @@ def runindex(request,event=None):
 
   return views_common.tracker_response(request, 'tracker/runindex.html', { 'searchForm': searchForm, 'runs' : runs, 'event': event })
 
-@cache_page(300)
+@views_common.cache_versioned_page('runs', 'runners', 'bids')
+@routers.read_replica
 def run(request,id):
   try:
     run = SpeedRun.objects.get(pk=id)
     runners = run.runners.all()
     event = run.event
-    bids = Bid.objects.filter(state__in=('OPENED', 'CLOSED'), speedrun_id=id).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name'))
-    # bids = filters.run_model_query('bid', {'run': id}).annotate(speedrun_name=F('speedrun__name'), event_name=F('event__name'))
-    bids = [bid_info(bid, bids) for bid in bids if bid.parent_id == None]
+    bids = [bid_info(bid) for bid in viewutil.bid_tree(public_bids(speedrun_id=id))]
 
     return views_common.tracker_response(request, 'tracker/run.html', { 'event': event, 'run' : run, 'runners': runners, 'bids' : bids })
 
   except SpeedRun.DoesNotExist:
     return views_common.tracker_response(request, template='tracker/badobject.html', status=404)
 
-@cache_page(1800)
+@views_common.cache_versioned_page('prizes', 'runs', 'prizecategories', 'donors')
+@routers.read_replica
 def prizeindex(request,event=None):
   event = viewutil.get_event(event)
   searchForm = PrizeSearchForm(request.GET)
@@ -298,7 +301,8 @@ def prizeindex(request,event=None):
   prizes = prizes.select_related('startrun','endrun','category').prefetch_related('prizewinner_set')
   return views_common.tracker_response(request, 'tracker/prizeindex.html', { 'searchForm': searchForm, 'prizes' : prizes, 'event': event })
 
-@cache_page(1800)
+@views_common.cache_versioned_page('prizes', 'runs', 'prizecategories', 'donors')
+@routers.read_replica
 def prize(request,id):
   try:
     prize = Prize.objects.get(pk=id)
@@ -47,10 +47,7 @@ def get_event(event):
     if isinstance(event, Event):
         return event
     try:
-      if re.match(r'^\d+$', event):
-        return Event.objects.get(id=event)
-      else:
-        return Event.objects.get(short=event)
+      return EventRegistry.get(event)
     except Event.DoesNotExist:
       raise Http404
   e = Event()
@@ -101,6 +98,27 @@ def get_tree_queryset_ancestors(model, nodes):
       query |= Q(lft__lt=node.lft, rght__gt=node.rght, tree_id=node.tree_id)
     return model.objects.filter(query).order_by(*model._meta.ordering)
 
+def bid_tree(bids):
+  """
+  Links up bids loaded by a single query, usually whole trees in the default ordering, in one pass
+  over them in tree order. Every linked bid gets tree_children, in tree order, and tree_ancestors,
+  from the root down. Bids whose parent was not loaded are left out, along with their descendants.
+  Returns the top level bids, in the order they were given.
+  """
+  bids = list(bids)
+  path = []
+  for bid in sorted(bids, key=lambda bid: (bid.tree_id, bid.lft)):
+    while path and (path[-1].tree_id != bid.tree_id or path[-1].rght < bid.lft):
+      path.pop()
+    if bid.parent_id is not None and not (path and path[-1].id == bid.parent_id):
+      continue
+    bid.tree_ancestors = path[:]
+    bid.tree_children = []
+    if path:
+      path[-1].tree_children.append(bid)
+    path.append(bid)
+  return [bid for bid in bids if bid.parent_id is None]
+
 def get_tree_queryset_all(model, nodes):
   filters = []
   for node in nodes:
@@ -153,7 +171,7 @@ EVENT_SELECT = 'admin-event'
 def get_selected_event(request):
   evId = request.session.get(EVENT_SELECT, None)
   if evId:
-    return Event.objects.get(pk=evId)
+    return EventRegistry.get(evId)
   else:
     return None
 
@@ -202,15 +220,18 @@ def merge_bids(rootBid, bids):
   return rootBid
 
 def merge_donors(rootDonor, donors):
-  for other in donors:
-    if other != rootDonor:
+  others = [other for other in donors if other != rootDonor]
+  with DonorCache.deferred():
+    for other in others:
       for donation in other.donation_set.all():
         donation.donor = rootDonor
         donation.save()
       for prizewin in other.prizewinner_set.all():
         prizewin.winner = rootDonor
         prizewin.save()
-      other.delete()
+  # the merged donors' caches are only gone once the deferred recompute has run
+  for other in others:
+    other.delete()
   rootDonor.save()
   return rootDonor
 